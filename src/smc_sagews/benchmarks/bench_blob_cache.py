@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+bench_blob_cache.py -- cost of re-showing an identical plot in a worksheet.
+
+Shows the same Graphics object many times (as an interact that redraws an
+unchanged plot does) through salvus.file, talking to a fake hub over a
+socketpair that acknowledges every blob after a simulated latency.  Reports
+the time per show and the number of blobs and bytes sent for:
+
+   - serial:    no blob index, wait for each acknowledgement (as salvus.file used to)
+   - pipelined: no blob index, acknowledgements are handled asynchronously
+   - indexed:   blobs already saved by the hub are not sent again
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_blob_cache.py [--count 1000] [--latency 0.005]
+"""
+
+import os, socket, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server, sage_salvus
+from sage_server import ConnectionJSON, MessageQueue, Salvus
+
+
+class FakeHub(threading.Thread):
+    """
+    Reads messages from the session, and answers each blob with a save_blob
+    acknowledgement after latency seconds.
+    """
+    def __init__(self, sock, latency):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = ConnectionJSON(sock)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.blobs = self.blob_bytes = self.mesgs = 0
+
+    def run(self):
+        try:
+            while True:
+                typ, mesg = self.conn.recv()
+                if typ == 'blob':
+                    self.blobs += 1
+                    self.blob_bytes += len(mesg)
+                    sha1 = str(mesg[:36])
+                    def ack(sha1=sha1):
+                        with self.lock:
+                            self.conn.send_json({'event':'save_blob', 'sha1':sha1, 'ttl':86400})
+                    threading.Timer(self.latency, ack).start()
+                else:
+                    self.mesgs += 1
+        except EOFError:
+            pass
+
+
+def run(g, count, latency, index, serial, svg):
+    a, b = socket.socketpair()
+    hub = FakeHub(b, latency)
+    hub.start()
+    conn = ConnectionJSON(a)
+    sage_server.blob_index = sage_server.BlobIndex(maxsize=sage_server.BLOB_INDEX_SIZE if index else 0)
+    salvus = Salvus(conn=conn, id='bench', message_queue=MessageQueue(conn))
+    sage_salvus.salvus = salvus
+    tm = time.time()
+    for i in range(count):
+        sage_salvus.show(g, svg=svg)
+        if serial:
+            salvus._wait_for_blob_acks()
+    salvus._wait_for_blob_acks()
+    elapsed = time.time() - tm
+    a.close(); b.close()
+    return elapsed, hub.blobs, hub.blob_bytes
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="blob index and pipelined acknowledgement benchmark")
+    parser.add_argument("--count", dest="count", type=int, default=1000,
+                        help="number of times to show the plot (default: 1000)")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.005,
+                        help="seconds until the fake hub acknowledges a blob (default: 0.005)")
+    parser.add_argument("--svg", dest="svg", default=False, action="store_const", const=True,
+                        help="show the plot as svg instead of png")
+    args = parser.parse_args()
+
+    sage_server.log = lambda *args: None
+    sage_server.MAX_OUTPUT_MESSAGES = sage_server.MAX_OUTPUT = 10**9
+    import sage.all
+    g = sage.all.plot(sage.all.sin, (0, 10))
+
+    print "%10s %12s %10s %14s"%('mode', 'ms per show', 'blobs', 'blob bytes')
+    for mode, index, serial in [('serial', False, True), ('pipelined', False, False), ('indexed', True, False)]:
+        elapsed, blobs, nbytes = run(g, args.count, args.latency, index, serial, args.svg)
+        print "%10s %12.3f %10d %14d"%(mode, elapsed / args.count * 1000, blobs, nbytes)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+bench_compile_cache.py -- cost of executing the same cell again.
+
+Executes a generated cell of the given number of lines (assignments,
+function definitions and loops) repeatedly, as happens when an interact is
+updated or an %auto cell is rerun, and reports the time per execution with
+and without the compiled-block cache (sage_server.compile_cache).
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_compile_cache.py [--lines 500] [--count 100] [--no-preparse]
+"""
+
+import os, socket, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+from sage_server import ConnectionJSON, MessageQueue
+
+
+class FakeHub(threading.Thread):
+    """
+    Reads and discards all messages from the session.
+    """
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = ConnectionJSON(sock)
+
+    def run(self):
+        try:
+            while True:
+                self.conn.recv()
+        except EOFError:
+            pass
+
+
+def cell(lines):
+    v = []
+    while len(v) < lines:
+        i = len(v)
+        if i % 20 == 0:
+            v.extend(["def f%s(a, b=2):"%i, "    c = a*b + %s"%i, "    return c - 1"])
+        elif i % 20 == 10:
+            v.extend(["for k in range(3):", "    t%s = f0(k, %s)"%(i, i)])
+        else:
+            v.append("x%s = [%s, %s/3, (%s, 'abc')]"%(i, i, i, i))
+    return '\n'.join(v)
+
+def run(code, count, preparse, cache_size):
+    sage_server.compile_cache = sage_server.CompileCache(maxsize=cache_size)
+    a, b = socket.socketpair()
+    FakeHub(b).start()
+    conn = ConnectionJSON(a)
+    mq = MessageQueue(conn)
+    tm = time.time()
+    for i in range(count):
+        sage_server.execute(conn=conn, id='bench', code=code, data=None, cell_id=None,
+                            preparse=preparse, message_queue=mq)
+    elapsed = time.time() - tm
+    a.close(); b.close()
+    return elapsed
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="compiled block cache benchmark")
+    parser.add_argument("--lines", dest="lines", type=int, default=500,
+                        help="number of lines of the cell (default: 500)")
+    parser.add_argument("--count", dest="count", type=int, default=100,
+                        help="number of times to execute the cell (default: 100)")
+    parser.add_argument("--no-preparse", dest="preparse", default=True, action="store_const", const=False,
+                        help="do not preparse the cell")
+    args = parser.parse_args()
+
+    sage_server.logger.quiet = True
+    code = cell(args.lines)
+
+    print "%10s %16s"%('cache', 'ms per execute')
+    for name, cache_size in [('off', 0), ('on', sage_server.COMPILE_CACHE_SIZE)]:
+        elapsed = run(code, args.count, args.preparse, cache_size)
+        print "%10s %16.3f"%(name, elapsed / args.count * 1000)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+bench_completion.py -- latency of completion requests.
+
+Fills a namespace with the given number of names (the Sage namespace has
+several thousand) and completes identifiers and attributes in it, as happens
+on each keystroke in the editor, by filtering the keys of the namespace or
+dir() of the object, as introspect did, and with a sage_parsing.CompletionIndex.
+Reports the time per completion.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_completion.py [--names 5000] [--count 200]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_parsing
+
+QUERIES = ['', 'a', 'ab', 'var_12', 'os.', 'os.pa', 'os.path.', 'big.', 'big.m', 'Big.method_1']
+
+class Namespace(dict):
+    # like sage_server.Namespace between executions of code, when it does not change
+    def on(self, event, x, f):
+        pass
+
+def make_namespace(names):
+    namespace = Namespace()
+    exec "import os\nclass Big(object): pass\nbig = Big()\nobj = Big()" in namespace
+    for i in range(names):
+        namespace['%s_%s'%(['var', 'ab', 'Abc', 'a'][i%4], i)] = i
+    for i in range(500):
+        setattr(namespace['Big'], 'method_%s'%i, lambda self: None)
+    return namespace
+
+def complete(namespace, query, index):
+    i = query.rfind('.')
+    if i == -1:
+        if index is not None:
+            return index.names(query)
+        return sorted(x for x in namespace.keys() + sage_parsing._builtin_completions if x.startswith(query))
+    obj, target = eval(query[:i], namespace), query[i+1:]
+    if index is not None:
+        return index.attributes(obj, target)
+    return sorted(x for x in dir(obj) if x.startswith(target) and not x.startswith('_'))
+
+def run(namespace, query, count, index):
+    tm = time.time()
+    for i in range(count):
+        complete(namespace, query, index)
+    return (time.time() - tm) / count
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="completion latency benchmark")
+    parser.add_argument("--names", dest="names", type=int, default=5000,
+                        help="number of names in the namespace (default: 5000)")
+    parser.add_argument("--count", dest="count", type=int, default=200,
+                        help="number of times to complete each query (default: 200)")
+    args = parser.parse_args()
+
+    namespace = make_namespace(args.names)
+    index = sage_parsing.CompletionIndex(namespace)
+    print "%12s %12s %12s %12s"%('query', 'results', 'dir() ms', 'index ms')
+    for query in QUERIES:
+        results = len(complete(namespace, query, index))
+        t0 = run(namespace, query, args.count, None)
+        t1 = run(namespace, query, args.count, index)
+        print "%12r %12d %12.3f %12.3f"%(query, results, t0*1000, t1*1000)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
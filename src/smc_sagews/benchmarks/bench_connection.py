@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+bench_connection.py -- frame throughput of sage_server.ConnectionJSON.
+
+Sends blobs of 1KB up to 100MB from one end of a socketpair to the other
+and reports frames and megabytes per second, both for the current codec
+and for the old one that built every message with string concatenation.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_connection.py [--max-size 100000000]
+"""
+
+import os, socket, struct, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+from sage_server import ConnectionJSON, uuidsha1
+
+
+class OldConnectionJSON(ConnectionJSON):
+    """
+    The codec as it was before frames were received with recv_into and sent
+    without joining the header onto the payload.
+    """
+    def _send(self, *parts):
+        s = ''.join(parts)
+        self._conn.sendall(struct.pack(">L", len(s)) + s)
+
+    def _recv(self, n):
+        return self._conn.recv(n)
+
+    def recv(self):
+        n = self._recv(4)
+        if len(n) < 4:
+            raise EOFError
+        n = struct.unpack('>L', n)[0]
+        s = self._recv(n)
+        while len(s) < n:
+            t = self._recv(n - len(s))
+            if len(t) == 0:
+                raise EOFError
+            s += t
+        return 'blob', s[1:]
+
+
+def run(cls, size, count):
+    a, b = socket.socketpair()
+    sender, receiver = cls(a), cls(b)
+    blob = os.urandom(min(size, 1 << 20)) * (size // (1 << 20) or 1)
+    blob = blob[:size] + '\0' * (size - len(blob))
+    # the sha1 hash is computed once, so that only framing and transfer are measured
+    sha1 = uuidsha1(blob)
+
+    def read():
+        for i in range(count):
+            receiver.recv()
+
+    t = threading.Thread(target=read)
+    t.start()
+    tm = time.time()
+    for i in range(count):
+        sender._send('b', sha1, blob)
+    t.join()
+    elapsed = time.time() - tm
+    a.close(); b.close()
+    return elapsed
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="ConnectionJSON frame throughput benchmark")
+    parser.add_argument("--max-size", dest="max_size", type=int, default=100*10**6,
+                        help="largest payload size in bytes (default: 100000000)")
+    parser.add_argument("--total", dest="total", type=int, default=200*10**6,
+                        help="approximate number of bytes to send per payload size (default: 200000000)")
+    args = parser.parse_args()
+
+    sage_server.log = lambda *args: None   # only measure the codec
+
+    print "%12s %8s %14s %14s %14s %14s"%('size', 'frames', 'old frames/s', 'old MB/s', 'new frames/s', 'new MB/s')
+    size = 1000
+    while size <= args.max_size:
+        count = max(3, min(20000, args.total // size))
+        row = [size, count]
+        for cls in [OldConnectionJSON, ConnectionJSON]:
+            elapsed = run(cls, size, count)
+            row.extend([count / elapsed, size * count / elapsed / 1e6])
+        print "%12d %8d %14.1f %14.1f %14.1f %14.1f"%tuple(row)
+        sys.stdout.flush()
+        size *= 10
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+bench_divide_into_blocks.py -- cost of dividing a large cell into blocks.
+
+Divides generated cells of increasing numbers of lines (assignments, function
+definitions, loops with else clauses, multi-line calls and comments) into
+blocks with sage_parsing.divide_into_blocks, and with the previous
+implementation (which scanned backwards, slicing the list of lines and
+inserting each block at the front of the list of blocks), and reports the
+time each takes and whether they find the same blocks.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_divide_into_blocks.py [--lines 10,100,1000,10000,50000]
+"""
+
+import os, string, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_parsing
+
+
+def divide_into_blocks_old(code):
+    """
+    The previous implementation of sage_parsing.divide_into_blocks, without
+    the code decorators (the generated cells have none).
+    """
+    code, literals, state = sage_parsing.strip_string_literals(code)
+    code = [x for x in code.splitlines() if x.strip()]
+    i = len(code)-1
+    blocks = []
+    while i >= 0:
+        stop = i
+        paren_depth = code[i].count('(') - code[i].count(')')
+        brack_depth = code[i].count('[') - code[i].count(']')
+        curly_depth = code[i].count('{') - code[i].count('}')
+        while i>=0 and ((len(code[i]) > 0 and (code[i][0] in string.whitespace or code[i][:2] == '%(')) or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
+            i -= 1
+            if i >= 0:
+                paren_depth += code[i].count('(') - code[i].count(')')
+                brack_depth += code[i].count('[') - code[i].count(']')
+                curly_depth += code[i].count('{') - code[i].count('}')
+        for k, v in literals.iteritems():
+            if v.startswith('#'):
+                literals[k] = ''
+        block = ('\n'.join(code[i:]))%literals
+        bs = block.strip()
+        if bs:
+            blocks.insert(0, [i, stop, bs])
+        code = code[:i]
+        i = len(code)-1
+
+    i = 1
+    def merge():
+        blocks[i-1][-1] += '\n' + blocks[i][-1]
+        blocks[i-1][1] = blocks[i][1]
+        del blocks[i]
+    while i < len(blocks):
+        s = blocks[i][-1].lstrip()
+        if (s.startswith('finally') or s.startswith('except')) and blocks[i-1][-1].lstrip().startswith('try'):
+            merge()
+        elif s.startswith('def') and blocks[i-1][-1].splitlines()[-1].lstrip().startswith('@'):
+            merge()
+        elif s.startswith('else') and (blocks[i-1][-1].lstrip().startswith('if') or blocks[i-1][-1].lstrip().startswith('while') or blocks[i-1][-1].lstrip().startswith('for') or blocks[i-1][-1].lstrip().startswith('elif')):
+            merge()
+        elif s.startswith('elif') and blocks[i-1][-1].lstrip().startswith('if'):
+            merge()
+        else:
+            i += 1
+    return blocks
+
+
+def cell(lines):
+    v = []
+    while len(v) < lines:
+        i = len(v)
+        if i % 20 == 0:
+            v.extend(["def f%s(a, b=2):"%i, "    # the product", "    c = a*b + %s"%i, "    return c - 1"])
+        elif i % 20 == 10:
+            v.extend(["for k in range(3):", "    t%s = f0(k, %s)"%(i, i), "else:", "    t = 0"])
+        elif i % 20 == 15:
+            v.extend(["z%s = f0(1,"%i, "       '(')"])
+        else:
+            v.append("x%s = [%s, %s/3, (%s, 'abc')]  # x%s"%(i, i, i, i, i))
+    return '\n'.join(v[:lines])
+
+def timeit(f, code):
+    count = 0
+    tm = time.time()
+    while True:
+        blocks = f(code)
+        count += 1
+        elapsed = time.time() - tm
+        if elapsed >= 0.2:
+            return elapsed / count, blocks
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="divide_into_blocks benchmark")
+    parser.add_argument("--lines", dest="lines", type=str, default="10,100,1000,10000,50000",
+                        help="comma separated numbers of lines of the cells (default: 10,100,1000,10000,50000)")
+    args = parser.parse_args()
+
+    print "%10s %10s %12s %12s %8s"%('lines', 'blocks', 'old ms', 'new ms', 'same')
+    for lines in [int(n) for n in args.lines.split(',')]:
+        code = cell(lines)
+        t_old, old = timeit(divide_into_blocks_old, code)
+        t_new, new = timeit(sage_parsing.divide_into_blocks, code)
+        print "%10d %10d %12.2f %12.2f %8s"%(lines, len(new), t_old*1000, t_new*1000, old == new)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+bench_fork.py -- latency of forking a function, and throughput of its result.
+
+Runs functions in forked children of a session with sage_server.ForkEngine
+(which %fork uses), sending their output to a fake hub over a socketpair,
+and reports the time until the result arrives in the parent for a trivial
+function, and the throughput for functions returning large NumPy arrays.
+For comparison, the same is done the way %fork used to, with the child
+saving its result to a temporary file that the parent loads after waiting for
+the child (without the compression of Sage's save, so this is optimistic).
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_fork.py [--count 50] [--sizes 1,10,100]
+"""
+
+import cPickle, os, socket, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+from sage_server import ConnectionJSON
+
+
+class FakeHub(threading.Thread):
+    """
+    Reads and discards all messages from the session.
+    """
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = ConnectionJSON(sock)
+
+    def run(self):
+        try:
+            while True:
+                self.conn.recv()
+        except EOFError:
+            pass
+
+
+def run_engine(f, salvus):
+    done = threading.Event()
+    v = []
+    def callback(result, error):
+        v.append((result, error))
+        done.set()
+    tm = time.time()
+    sage_server.fork_engine.start(f, callback, salvus=salvus)
+    done.wait()
+    assert v[0][1] is None, v[0][1]
+    return time.time() - tm
+
+def run_file(f, salvus):
+    filename = tempfile.mktemp(suffix='.pickle')
+    tm = time.time()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            cPickle.dump(f(), open(filename, 'wb'), cPickle.HIGHEST_PROTOCOL)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    cPickle.load(open(filename, 'rb'))
+    elapsed = time.time() - tm
+    os.unlink(filename)
+    return elapsed
+
+def trivial():
+    print "hello"
+    return 1
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="fork latency and result throughput benchmark")
+    parser.add_argument("--count", dest="count", type=int, default=50,
+                        help="number of trivial functions to fork (default: 50)")
+    parser.add_argument("--sizes", dest="sizes", type=str, default="1,10,100",
+                        help="comma separated sizes in MB of the arrays to return (default: 1,10,100)")
+    args = parser.parse_args()
+
+    import numpy
+    sage_server.logger.quiet = True
+    a, b = socket.socketpair()
+    FakeHub(b).start()
+    salvus = sage_server.Salvus(conn=ConnectionJSON(a), id='bench')
+
+    print "%8s %10s %14s %14s"%('method', 'MB', 'ms', 'MB per second')
+    for name, run in [('file', run_file), ('engine', run_engine)]:
+        v = sorted([run(trivial, salvus) for i in range(args.count)])
+        print "%8s %10s %14.2f %14s"%(name, '-', v[len(v)//2]*1000, '-')
+        sys.stdout.flush()
+    for mb in [int(x) for x in args.sizes.split(',')]:
+        array = numpy.random.rand(mb * 2**20 // 8)
+        for name, run in [('file', run_file), ('engine', run_engine)]:
+            elapsed = run(lambda: array, salvus)
+            print "%8s %10d %14.2f %14.1f"%(name, mb, elapsed*1000, mb/elapsed)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
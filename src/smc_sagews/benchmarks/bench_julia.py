@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+bench_julia.py -- latency and array throughput of the Julia interface.
+
+Evaluates a trivial expression the given number of times in Julia, through
+pipes (julia.Julia(), the default) and through the REPL in a pseudo-terminal
+(julia.Julia(pipe=False), as it used to), and reports the time per round
+trip.  Then transfers arrays of Float64 of the given sizes to Julia and back:
+through pipes in binary with set_array and get_array, and through the
+pseudo-terminal as text (assigning a literal, and printing the entries).
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_julia.py [--count 100] [--sizes 1000,100000,1000000] [--text-max 100000]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import julia
+
+
+def latency(J, count):
+    J.eval('1')   # start julia
+    tm = time.time()
+    for i in range(count):
+        J.eval('1')
+    return (time.time() - tm) / count
+
+def transfer_binary(J, a):
+    tm = time.time()
+    J.set_array('x', a)
+    b = J.get_array('x')
+    assert (a == b).all()
+    return time.time() - tm
+
+def transfer_text(J, a):
+    tm = time.time()
+    J.eval('x = [%s];'%', '.join([repr(t) for t in a]))
+    b = [float(t) for t in J.eval('println(join(x, " "))').split()]
+    assert b == list(a)
+    return time.time() - tm
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Julia interface benchmark")
+    parser.add_argument("--count", dest="count", type=int, default=100,
+                        help="number of round trips (default: 100)")
+    parser.add_argument("--sizes", dest="sizes", type=str, default="1000,100000,1000000",
+                        help="comma separated numbers of entries of the arrays (default: 1000,100000,1000000)")
+    parser.add_argument("--text-max", dest="text_max", type=int, default=100000,
+                        help="largest array to transfer as text (default: 100000)")
+    args = parser.parse_args()
+
+    import numpy
+    pipe = julia.Julia()
+    expect = julia.Julia(pipe=False)
+    print "%12s %14s %14s"%('', 'pexpect ms', 'pipe ms')
+    print "%12s %14.3f %14.3f"%('round trip', latency(expect, args.count)*1000, latency(pipe, args.count)*1000)
+    sys.stdout.flush()
+    for n in [int(x) for x in args.sizes.split(',')]:
+        a = numpy.random.rand(n)
+        t0 = "%14.1f"%(transfer_text(expect, a)*1000) if n <= args.text_max else "%14s"%'-'
+        print "%12d %s %14.1f"%(n, t0, transfer_binary(pipe, a)*1000)
+        sys.stdout.flush()
+    pipe.quit()
+    expect.quit()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+bench_kernels.py -- latency of evaluating code with %python3, %perl and %ruby.
+
+Evaluates a small statement the given number of times in each language with
+sage_salvus.python3, perl and ruby: in a new interpreter for each evaluation
+(persistent=False, as these modes always used to), and in the persistent
+kernel of the language.  Reports the time per evaluation.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_kernels.py [--count 100] [--languages python3,perl,ruby]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_salvus
+
+CODE = {'python3':'x = 1', 'perl':'$x = 1;', 'ruby':'x = 1'}
+
+def run(f, code, count, persistent):
+    tm = time.time()
+    for i in range(count):
+        f(code, persistent=persistent)
+    return (time.time() - tm) / count
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="language kernel latency benchmark")
+    parser.add_argument("--count", dest="count", type=int, default=100,
+                        help="number of evaluations in each language (default: 100)")
+    parser.add_argument("--languages", dest="languages", type=str, default="python3,perl,ruby",
+                        help="comma separated languages (default: python3,perl,ruby)")
+    args = parser.parse_args()
+
+    print "%10s %16s %16s"%('language', 'one-shot ms', 'kernel ms')
+    for language in args.languages.split(','):
+        f = getattr(sage_salvus, language)
+        t0 = run(f, CODE[language], args.count, False)
+        f(CODE[language])   # start the kernel
+        t1 = run(f, CODE[language], args.count, True)
+        sage_salvus.language_kernel(language).restart()
+        print "%10s %16.2f %16.2f"%(language, t0*1000, t1*1000)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
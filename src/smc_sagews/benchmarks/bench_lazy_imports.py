@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+bench_lazy_imports.py -- server startup with and without lazy imports.
+
+In a new Python process, imports sage_server (and thereby sage_salvus and the
+Sage library) and then the given modules, either with import statements, as
+when the server initializes the library, or as sage_server.LazyModule's (see
+sage_server.LAZY_IMPORTS).  Reports the median time this takes and the max
+rss of the process, and the modules that took longest to import when the
+given modules are imported right away (see sage_server.ImportProfiler).
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_lazy_imports.py [--modules pylab,scipy,sympy] [--count 5]
+"""
+
+import json, os, subprocess, sys
+
+PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews')
+
+CODE = """
+import json, resource, sys, time
+sys.path.insert(0, %(path)r)
+tm = time.time()
+import sage_server
+profiler = sage_server.ImportProfiler().start()
+for name in %(modules)r:
+    if %(lazy)r:
+        sage_server.LazyModule(name)
+    else:
+        __import__(name)
+profiler.stop()
+print json.dumps({'seconds' : time.time() - tm,
+                  'maxrss'  : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'profile' : profiler.report()})
+"""
+
+def run(modules, lazy):
+    code = CODE%{'path':PATH, 'modules':modules, 'lazy':lazy}
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(out.splitlines()[-1])
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="lazy imports startup benchmark")
+    parser.add_argument("--modules", dest="modules", type=str, default='pylab,scipy,sympy',
+                        help="comma separated modules to import (default: pylab,scipy,sympy)")
+    parser.add_argument("--count", dest="count", type=int, default=5,
+                        help="number of processes to start for each mode (default: 5)")
+    parser.add_argument("--top", dest="top", type=int, default=10,
+                        help="number of slowest imports of the modules to list (default: 10)")
+    args = parser.parse_args()
+    modules = [name for name in args.modules.split(',') if name]
+
+    print "%8s %12s %14s"%('imports', 'median s', 'max rss MB')
+    for lazy in [False, True]:
+        v = [run(modules, lazy) for i in range(args.count)]
+        seconds = sorted([x['seconds'] for x in v])
+        maxrss = sorted([x['maxrss'] for x in v])
+        print "%8s %12.3f %14.1f"%('lazy' if lazy else 'eager', seconds[len(v)//2], maxrss[len(v)//2]/1024.)
+        sys.stdout.flush()
+        if not lazy:
+            profile = v[len(v)//2]['profile']
+    print
+    print "slowest imports of %s:"%', '.join(modules)
+    print ''.join(profile.splitlines(True)[:args.top + 1]),
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+bench_log.py -- per-message logging overhead of sage_server.
+
+Measures what ConnectionJSON.send_json spends on logging each outgoing
+message, for the old logger (which opened LOGFILE, wrote one line and
+closed it again on every call) and for the buffered logger: at DEBUG
+level, with the level set to INFO (so message dumps are filtered out),
+and in quiet mode.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_log.py [--count 100000]
+"""
+
+import json, os, sys, tempfile, time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+from sage_server import log_debug, logger, truncate_text, unicode8
+
+
+def old_log(*args):
+    try:
+        debug_log = open(sage_server.LOGFILE, 'a')
+        mesg = "%s (%s): %s\n"%(sage_server.PID, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], ' '.join([unicode8(x) for x in args]))
+        debug_log.write(mesg)
+        debug_log.flush()
+    except:
+        pass
+
+def old_send_json_log(m):
+    old_log(u"sending message '", truncate_text(m, 256), u"'")
+
+def new_send_json_log(m):
+    # exactly what ConnectionJSON.send_json does
+    if not logger.quiet:
+        log_debug(u"sending message '", truncate_text(m, 256)[0], u"'")
+
+def run(f, count, m):
+    tm = time.time()
+    for i in xrange(count):
+        f(m)
+    return time.time() - tm
+
+def main():
+    import argparse, logging
+    parser = argparse.ArgumentParser(description="sage_server logging overhead benchmark")
+    parser.add_argument("--count", dest="count", type=int, default=100000,
+                        help="number of messages to log (default: 100000)")
+    args = parser.parse_args()
+
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    m = json.dumps({'event':'output', 'id':'e0ec6a3b-7e41-4b8a-9b4b-e2ed22d2b4b6', 'stdout':'%s\n'%(10**20,), 'done':False})
+
+    try:
+        print "%28s %14s"%('logger', 'us per message')
+        for name, f, level, quiet in [('old', old_send_json_log, logging.DEBUG, False),
+                                      ('buffered, level DEBUG', new_send_json_log, logging.DEBUG, False),
+                                      ('buffered, level INFO', new_send_json_log, logging.INFO, False),
+                                      ('buffered, quiet', new_send_json_log, logging.DEBUG, True)]:
+            logger.level, logger.quiet = level, quiet
+            elapsed = run(f, args.count, m)
+            logger.flush()
+            print "%28s %14.3f"%(name, elapsed / args.count * 1e6)
+            sys.stdout.flush()
+    finally:
+        os.unlink(sage_server.LOGFILE)
+
+if __name__ == "__main__":
+    main()
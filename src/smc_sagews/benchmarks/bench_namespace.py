@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+bench_namespace.py -- cost of assigning globals in executed code.
+
+Executes a tight loop that assigns a global variable in a plain dict, in a
+sage_server.Namespace without listeners, in one with a change listener (for
+another variable, and for all variables), and in one with a listener for all
+variables inside Namespace.batch().  Reports the time per assignment.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_namespace.py [--count 1000000]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+
+CODE = "for i in xrange(%s):\n    x = i"
+
+
+def plain(ns):
+    return dict(ns)
+
+def fast(ns):
+    return sage_server.Namespace(ns)
+
+def listener_other(ns):
+    namespace = sage_server.Namespace(ns)
+    namespace.on('change', 'y', lambda y: None)
+    return namespace
+
+def listener_all(ns):
+    namespace = sage_server.Namespace(ns)
+    namespace.on('change', None, lambda x, y: None)
+    return namespace
+
+NAMESPACES = [('dict', plain), ('Namespace', fast), ('listener on y', listener_other),
+              ('listener on all', listener_all), ('batched', listener_all)]
+
+def run(namespace, code, batch):
+    compiled = compile(code, '', 'exec')
+    tm = time.time()
+    if batch:
+        with namespace.batch():
+            exec compiled in namespace
+    else:
+        exec compiled in namespace
+    return time.time() - tm
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="namespace assignment benchmark")
+    parser.add_argument("--count", dest="count", type=int, default=1000000,
+                        help="number of assignments (default: 1000000)")
+    args = parser.parse_args()
+
+    print "%16s %18s"%('namespace', 'ns per assignment')
+    for name, make in NAMESPACES:
+        elapsed = run(make({}), CODE%args.count, name == 'batched')
+        print "%16s %18.1f"%(name, elapsed / args.count * 1e9)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+bench_output.py -- cost of a cell that produces lots of small output.
+
+Executes cells that print many short lines (or output many small pieces of
+html) and sends their output to a fake hub over a socketpair.  Reports the
+time per cell and the number of output messages, frames, syscalls and bytes
+sent per cell, without output coalescing (OUTPUT_COALESCE_WINDOW = 0) and
+with the given coalescing window.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_output.py [--lines 100000] [--window 0.05]
+"""
+
+import os, socket, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+from sage_server import ConnectionJSON, MessageQueue
+
+
+class FakeHub(threading.Thread):
+    """
+    Reads and discards all messages from the session, until it gets the
+    message with done=True.
+    """
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = ConnectionJSON(sock)
+        self.mesgs = 0
+
+    def run(self):
+        try:
+            while True:
+                typ, mesg = self.conn.recv()
+                self.mesgs += 1
+                if typ == 'json' and mesg.get('done'):
+                    return
+        except EOFError:
+            pass
+
+
+CELLS = [('print', "for i in range(%s):\n    print i"),
+         ('html',  "for i in range(%s):\n    salvus.html('<b>%%s</b>'%%i)")]
+
+def run(code, window):
+    sage_server.OUTPUT_COALESCE_WINDOW = window
+    a, b = socket.socketpair()
+    hub = FakeHub(b)
+    hub.start()
+    conn = ConnectionJSON(a)
+    tm = time.time()
+    sage_server.execute(conn=conn, id='bench', code=code, data=None, cell_id=None,
+                        preparse=False, message_queue=MessageQueue(conn))
+    hub.join()
+    elapsed = time.time() - tm
+    stats = conn.stats()
+    stats['messages'] = hub.mesgs
+    a.close(); b.close()
+    return elapsed, stats
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="output coalescing benchmark")
+    parser.add_argument("--lines", dest="lines", type=int, default=100000,
+                        help="number of lines (or pieces of html) output by each cell (default: 100000)")
+    parser.add_argument("--window", dest="window", type=float, default=sage_server.OUTPUT_COALESCE_WINDOW,
+                        help="coalescing window in seconds (default: %s)"%sage_server.OUTPUT_COALESCE_WINDOW)
+    args = parser.parse_args()
+
+    sage_server.MAX_OUTPUT_MESSAGES = sage_server.MAX_OUTPUT = 10**9
+    sage_server.logger.quiet = True
+
+    print "%6s %8s %10s %10s %10s %10s %12s"%('cell', 'window', 's per cell', 'messages', 'frames', 'syscalls', 'bytes')
+    for name, code in CELLS:
+        for window in [0, args.window]:
+            elapsed, stats = run(code%args.lines, window)
+            print "%6s %8.3f %10.3f %10d %10d %10d %12d"%(name, window, elapsed, stats['messages'],
+                               stats['frames'], stats['syscalls'], stats['bytes'])
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
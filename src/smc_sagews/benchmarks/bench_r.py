@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+bench_r.py -- time to move a data frame to R and back.
+
+Transfers a data frame with a double, an integer and a logical column of the
+given numbers of rows to the R interface and back: in binary with
+r.set_data_frame and r.get_data_frame, and as text, the way values usually
+went (assigning each column as a literal vector with r.set, and parsing the
+printed vector returned by r.get, which also loses precision).  Reports the
+time each round trip takes.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_r.py [--rows 1000,100000,1000000] [--text-max 100000]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_salvus
+from sage.interfaces.r import r
+r.eval = sage_salvus.r_eval0   # without the graphics support, which needs a running session
+
+def make_columns(rows):
+    import collections, numpy
+    return collections.OrderedDict([('x', numpy.random.rand(rows)),
+                                    ('n', numpy.arange(rows, dtype='int32')),
+                                    ('b', numpy.arange(rows) % 3 == 0)])
+
+def transfer_binary(columns):
+    tm = time.time()
+    r.set_data_frame('d', columns)
+    d = r.get_data_frame('d')
+    assert all([(d[name] == x).all() for name, x in columns.items()])
+    return time.time() - tm
+
+def transfer_text(columns):
+    tm = time.time()
+    for name, x in columns.items():
+        r.set('d_%s'%name, 'c(%s)'%','.join([str(t).upper() for t in x]))
+    r.eval('d <- data.frame(%s)'%', '.join(['%s=d_%s'%(name, name) for name in columns]))
+    for name in columns:
+        s = r.get('d$%s'%name)
+        [t for line in s.splitlines() for t in line.split()[1:]]
+    return time.time() - tm
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="R data frame transfer benchmark")
+    parser.add_argument("--rows", dest="rows", type=str, default="1000,100000,1000000",
+                        help="comma separated numbers of rows (default: 1000,100000,1000000)")
+    parser.add_argument("--text-max", dest="text_max", type=int, default=100000,
+                        help="largest data frame to transfer as text (default: 100000)")
+    args = parser.parse_args()
+
+    r.eval('1')   # start R
+    print "%10s %14s %14s"%('rows', 'text ms', 'binary ms')
+    for rows in [int(x) for x in args.rows.split(',')]:
+        columns = make_columns(rows)
+        t0 = "%14.1f"%(transfer_text(columns)*1000) if rows <= args.text_max else "%14s"%'-'
+        print "%10d %s %14.1f"%(rows, t0, transfer_binary(columns)*1000)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+bench_session_memory.py -- memory used by each worksheet session.
+
+Starts a sage server (in a forked process, using the secret token in $SMC)
+for each setting of sage_server.PREIMPORT_GC, starts several sessions that
+each run a cell allocating many small objects (which triggers garbage
+collections), and then asks every session for its memory usage (see
+sage_server.smaps_memory).  Reports the mean pss and private dirty memory per
+session, and how many such sessions fit in 1GB.
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_session_memory.py [--sessions 10]
+"""
+
+import os, signal, socket, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+from sage_server import ConnectionJSON, message
+
+CODE = "v = [[i] for i in range(%s)]; del v"
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(port, preimport_gc):
+    pid = os.fork()
+    if pid == 0:
+        os.setpgrp()   # so that the server and all its sessions are killed together below
+        try:
+            sage_server.PREIMPORT_GC = preimport_gc
+            sage_server.serve(port, '127.0.0.1', pool_size=0)
+        finally:
+            os._exit(0)
+    # wait until the server accepts connections
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return pid
+        except socket.error:
+            time.sleep(0.1)
+
+def recv_until(conn, f):
+    while True:
+        typ, mesg = conn.recv()
+        if f(mesg):
+            return mesg
+
+def start_session(port, token, code):
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall(token)
+    assert s.recv(1) == 'y', "invalid secret token"
+    conn = ConnectionJSON(s)
+    conn.send_json(message.start_session())
+    conn.recv()  # session description
+    conn.send_json(message.execute_code(id='bench', code=code, preparse=False))
+    recv_until(conn, lambda mesg: mesg.get('done'))
+    return conn
+
+def run(preimport_gc, sessions, code, token):
+    port = free_port()
+    pid = start_server(port, preimport_gc)
+    try:
+        conns = [start_session(port, token, code) for i in range(sessions)]
+        usage = []
+        for conn in conns:
+            conn.send_json({'event':'session_status', 'id':'bench'})
+            usage.append(recv_until(conn, lambda mesg: mesg['event'] == 'session_status')['memory'])
+        for conn in conns:
+            conn.send_json(message.terminate_session())
+            conn.close()
+    finally:
+        os.killpg(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    return usage
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="session memory benchmark")
+    parser.add_argument("--sessions", dest="sessions", type=int, default=10,
+                        help="number of sessions to start (default: 10)")
+    parser.add_argument("--objects", dest="objects", type=int, default=300000,
+                        help="number of small objects each session allocates (default: 300000)")
+    args = parser.parse_args()
+
+    token = open(sage_server.secret_token_path).read().strip()
+    sage_server.logger.quiet = True
+
+    print "%14s %14s %18s %16s"%('preimport_gc', 'pss MB', 'private dirty MB', 'sessions per GB')
+    for preimport_gc in [None, 'limit', 'disable']:
+        usage = run(preimport_gc, args.sessions, CODE%args.objects, token)
+        pss = sum([u['pss'] for u in usage]) / 1024.0 / len(usage)
+        private_dirty = sum([u['private_dirty'] for u in usage]) / 1024.0 / len(usage)
+        print "%14s %14.1f %18.1f %16.1f"%(preimport_gc, pss, private_dirty, 1024 / pss)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
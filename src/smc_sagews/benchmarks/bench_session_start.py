@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+bench_session_start.py -- latency of starting a new worksheet session.
+
+Starts a sage server (in a forked process, using the secret token in $SMC),
+then repeatedly connects to it, unlocks the connection, starts a session and
+executes a trivial cell.  Reports the time from connecting until the reply to
+the execute request, with and without a pool of pre-forked session processes
+(see sage_server.SessionPool).
+
+Run it with the Python of the Sage install that runs the server:
+
+    sage -python benchmarks/bench_session_start.py [--count 50] [--pool_size 2]
+"""
+
+import os, signal, socket, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smc_sagews'))
+import sage_server
+from sage_server import ConnectionJSON, message
+
+
+def start_server(port, pool_size):
+    pid = os.fork()
+    if pid == 0:
+        os.setpgrp()   # so that the server and all its sessions are killed together below
+        try:
+            sage_server.serve(port, '127.0.0.1', pool_size=pool_size)
+        finally:
+            os._exit(0)
+    # wait until the server accepts connections
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return pid
+        except socket.error:
+            time.sleep(0.1)
+
+def start_session(port, token):
+    """
+    Connect and run a cell, returning the number of seconds until the reply
+    and the connection.
+    """
+    tm = time.time()
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall(token)
+    assert s.recv(1) == 'y', "invalid secret token"
+    conn = ConnectionJSON(s)
+    conn.send_json(message.start_session())
+    conn.recv()  # session description
+    conn.send_json(message.execute_code(id='bench', code='1+1', preparse=False))
+    while True:
+        typ, mesg = conn.recv()
+        if mesg.get('done'):
+            break
+    return time.time() - tm, conn
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def run(pool_size, count, delay, token):
+    port = free_port()
+    pid = start_server(port, pool_size)
+    v = []
+    try:
+        for i in range(count):
+            t, conn = start_session(port, token)
+            v.append(t)
+            conn.send_json(message.terminate_session())
+            conn.close()
+            time.sleep(delay)
+    finally:
+        os.killpg(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    v.sort()
+    return v
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="session start latency benchmark")
+    parser.add_argument("--count", dest="count", type=int, default=50,
+                        help="number of sessions to start (default: 50)")
+    parser.add_argument("--pool_size", dest="pool_size", type=int, default=sage_server.SESSION_POOL_SIZE,
+                        help="number of pre-forked session processes (default: %s)"%sage_server.SESSION_POOL_SIZE)
+    parser.add_argument("--delay", dest="delay", type=float, default=1.0,
+                        help="seconds to wait between starting sessions, which should be more than "
+                             "sage_server.SESSION_POOL_REFILL_DELAY (default: 1.0)")
+    args = parser.parse_args()
+
+    token = open(sage_server.secret_token_path).read().strip()
+    sage_server.logger.quiet = True
+
+    print "%10s %12s %12s %12s"%('pool size', 'median ms', 'mean ms', 'max ms')
+    for pool_size in [0, args.pool_size]:
+        v = run(pool_size, args.count, args.delay, token)
+        print "%10d %12.2f %12.2f %12.2f"%(pool_size, v[len(v)//2]*1000, sum(v)/len(v)*1000, v[-1]*1000)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
 r"""
-Pexpect-based interface to Julia
+Interface to Julia
+
+By default, Julia runs as a separate process that evaluates code sent
+to it through a pipe, replying through another pipe, and numeric
+arrays are transferred in binary (see JuliaPipe).  Julia(pipe=False)
+drives the Julia REPL in a pseudo-terminal with pexpect instead, and
+transfers arrays through temporary files.
 
 EXAMPLES::
 
@@ -19,7 +25,7 @@ AUTHORS:
 #
 ##########################################################################
 
-import os, pexpect, random, string
+import io, os, pexpect, random, select, shutil, signal, string, struct, subprocess, tempfile
 
 from uuid import uuid4
 def uuid():
@@ -30,16 +36,270 @@ from sage.structure.element import RingElement
 
 PROMPT_LENGTH = 16
 
+# The program that turns julia into the other end of a JuliaPipe.  It reads
+# messages from stdin and writes replies to file descriptor 3; both are a 4
+# byte big endian length, then a kind character, then the body.  The kinds
+# of messages are 'e' (evaluate the code in the body), 'g' (get the array
+# named in the body) and 's' (set an array: the body is a 4 byte big endian
+# length, a header "name dtype dim1 dim2 ..." of that length, and the array
+# in column major order); the kinds of replies are 'r' (the text of the value
+# of the code), 'e' (an error message) and 'a' (an array: a header as above
+# without the name, then the data).  Output of the code goes to stdout.
+# Works with Julia 0.5 and later.
+JULIA_DRIVER = r"""
+const SMC_TYPES = Dict("float64"=>Float64, "float32"=>Float32, "int64"=>Int64, "int32"=>Int32,
+                       "uint8"=>UInt8, "bool"=>Bool, "complex128"=>Complex{Float64})
+const SMC_NAMES = Dict([(v, k) for (k, v) in SMC_TYPES])
+
+smc_include(code) = VERSION >= v"0.7" ? include_string(Main, code, "cell") : include_string(code, "cell")
+smc_array(T, dims) = VERSION >= v"0.7" ? Array{T}(undef, dims...) : Array{T}(dims...)
+smc_text(x) = x === nothing ? "" : sprint(show, MIME"text/plain"(), x)
+
+function smc_reply(io, kind, parts...)
+    write(io, hton(UInt32(sizeof(kind) + sum(sizeof, parts))), kind)
+    for part in parts
+        write(io, part)
+    end
+    flush(io)
+end
+
+function smc_main()
+    @eval ccall(:jl_exit_on_sigint, $(isdefined(Base, :Cvoid) ? :Cvoid : :Void), (Cint,), 0)
+    input = Base.fdio(0)
+    output = Base.fdio(3)
+    streams = isdefined(Base, :stdout) ? (Base.stdout, Base.stderr) : (STDOUT, STDERR)
+    while !eof(input)
+        n = ntoh(read(input, UInt32))
+        kind = Char(read(input, UInt8))
+        if kind == 's'
+            fields = split(String(read(input, ntoh(read(input, UInt32)))))
+            array = smc_array(SMC_TYPES[fields[2]], [parse(Int, d) for d in fields[3:end]])
+            read!(input, array)
+        else
+            body = String(read(input, n - 1))
+        end
+        try
+            if kind == 'e'
+                x = smc_include(body)
+                Main.eval(Expr(:(=), :ans, QuoteNode(x)))
+                text = endswith(rstrip(body), ";") ? "" : smc_text(x)
+                map(flush, streams)
+                smc_reply(output, "r", text)
+            elseif kind == 'g'
+                a = getfield(Main, Symbol(body))
+                if !isa(a, Array) || !haskey(SMC_NAMES, eltype(a))
+                    error("$body is not an array of one of the types ", join(keys(SMC_TYPES), ", "))
+                end
+                header = join([SMC_NAMES[eltype(a)], size(a)...], " ")
+                smc_reply(output, "a", hton(UInt32(sizeof(header))), header, a)
+            else
+                Main.eval(Expr(:(=), Symbol(fields[1]), array))
+                smc_reply(output, "r", "")
+            end
+        catch err
+            map(flush, streams)
+            smc_reply(output, "e", "ERROR: " * sprint(showerror, err))
+        end
+    end
+end
+
+smc_main()
+"""
+
+# The numpy dtypes of arrays that can be transferred to and from julia.
+JULIA_DTYPES = ['float64', 'float32', 'int64', 'int32', 'uint8', 'bool', 'complex128']
+
+# The julia types of the entries of such arrays, and the dtypes of the names
+# that julia gives them (Complex{Float64} is ComplexF64 since julia 0.7).
+JULIA_TYPES = {'float64':'Float64', 'float32':'Float32', 'int64':'Int64', 'int32':'Int32',
+               'uint8':'UInt8', 'bool':'Bool', 'complex128':'Complex{Float64}'}
+JULIA_TYPE_DTYPES = dict([(v, k) for k, v in JULIA_TYPES.iteritems()] + [('ComplexF64', 'complex128')])
+
+def julia_array(a):
+    """
+    Return the numpy array a in column major order, as julia stores it.
+    Raise a TypeError if its dtype is not one of JULIA_DTYPES.
+    """
+    import numpy
+    a = numpy.asfortranarray(a)
+    if a.dtype.name not in JULIA_DTYPES:
+        raise TypeError("the dtype of the array must be one of %s"%', '.join(JULIA_DTYPES))
+    return a
+
+def julia_string(s):
+    """
+    Return a julia string literal for s.
+    """
+    return '"%s"'%s.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+
+# How long to wait, in seconds, for an interrupted evaluation to stop before
+# killing julia.
+JULIA_INTERRUPT_TIMEOUT = 2
+
+class JuliaPipe(object):
+    """
+    A julia process running JULIA_DRIVER, which evaluates code and
+    transfers arrays through pipes.
+    """
+    def __init__(self, command='julia'):
+        self._command = command
+        self._process = None
+
+    def start(self):
+        from sage_salvus import close_fds_on_exec
+        # fd 3 is open after this, so Popen does not report a failed exec on it
+        r, w = os.pipe()
+        def setup():
+            os.dup2(w, 3)
+            close_fds_on_exec(4)
+        try:
+            self._process = subprocess.Popen([self._command, '--startup-file=no', '-e', JULIA_DRIVER],
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT, preexec_fn=setup)
+        except:
+            os.close(r)
+            raise
+        finally:
+            os.close(w)
+        self._replies = io.open(r, 'rb', buffering=0)
+        self._pid = os.getpid()
+
+    def is_running(self):
+        # a process started before a fork is not ours to use
+        return (self._process is not None and self._pid == os.getpid()
+                and self._process.poll() is None)
+
+    def pid(self):
+        return self._process.pid if self.is_running() else None
+
+    def quit(self):
+        if self.is_running():
+            try:
+                self._process.stdin.close()
+                self._replies.close()
+            except IOError:
+                pass
+            try:
+                os.kill(self._process.pid, 9)
+            except OSError:
+                pass
+            self._process.wait()
+        self._process = None
+
+    def _send(self, kind, *parts):
+        if not self.is_running():
+            self.start()
+        stdin = self._process.stdin
+        stdin.write(struct.pack('>Lc', 1 + sum(map(len, parts)), kind))
+        for part in parts:
+            stdin.write(part)
+        stdin.flush()
+
+    def _read(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        pos = 0
+        while pos < n:
+            k = self._replies.readinto(view[pos:])
+            if not k:
+                raise EOFError
+            pos += k
+        return buf
+
+    def _receive(self, timeout=None):
+        """
+        Return the output and the kind and body of the reply to the
+        last message, or None if timeout seconds pass first.
+        """
+        out = self._process.stdout.fileno()
+        fds = [out, self._replies.fileno()]
+        output = []
+        while True:
+            r = select.select(fds, [], [], timeout)[0]
+            if not r:
+                return None
+            if out in r:
+                data = os.read(out, 65536)
+                if data:
+                    output.append(data)
+                else:
+                    fds = [self._replies.fileno()]
+            if self._replies.fileno() in r:
+                n, kind = struct.unpack('>Lc', str(self._read(5)))
+                body = self._read(n - 1)
+                # julia flushed its output before replying, so it is all in the pipe now
+                while out in fds and select.select([out], [], [], 0)[0]:
+                    data = os.read(out, 65536)
+                    if not data:
+                        break
+                    output.append(data)
+                return ''.join(output), kind, body
+
+    def _request(self, kind, *parts):
+        try:
+            try:
+                self._send(kind, *parts)
+                output, kind, body = self._receive()
+            except KeyboardInterrupt:
+                try:
+                    self._process.send_signal(signal.SIGINT)
+                    if self._receive(JULIA_INTERRUPT_TIMEOUT) is None:
+                        self.quit()
+                except (EOFError, IOError, OSError, struct.error):
+                    self.quit()
+                raise
+        except (EOFError, IOError, OSError, struct.error):
+            self.quit()
+            raise RuntimeError("julia exited; it will be restarted on the next evaluation")
+        if kind == 'e':
+            raise RuntimeError((output + str(body)).rstrip())
+        return output, body
+
+    def eval(self, code):
+        """
+        Evaluate code in julia and return its output followed by the text
+        of its value (unless the code ends in a semicolon), as in the REPL.
+        Raise a RuntimeError if julia reports an error.
+        """
+        if isinstance(code, unicode):
+            code = code.encode('utf8')
+        output, body = self._request('e', code)
+        return (output + str(body)).rstrip()
+
+    def set_array(self, var, a):
+        """
+        Set the julia variable var to an array with the entries of the
+        numpy array a, which must have one of the JULIA_DTYPES.
+        """
+        a = julia_array(a)
+        header = ' '.join([var, a.dtype.name] + [str(d) for d in a.shape])
+        self._request('s', struct.pack('>L', len(header)), header, buffer(a))
+
+    def get_array(self, var):
+        """
+        Return a numpy array with the entries of the julia array var.
+        """
+        import numpy
+        output, body = self._request('g', var)
+        n = struct.unpack_from('>L', body)[0]
+        fields = str(body[4:4+n]).split()
+        return numpy.frombuffer(buffer(body, 4+n), dtype=fields[0]).reshape(
+            [int(d) for d in fields[1:]], order='F')
+
+
 class Julia(Expect):
     def __init__(self,
                  maxread             = 100000,
                  script_subdirectory = None,
                  logfile             = None,
                  server              = None,
-                 server_tmpdir       = None):
+                 server_tmpdir       = None,
+                 pipe                = True):
         """
-        Pexpect-based interface to Julia
+        Interface to Julia, through pipes (see JuliaPipe), or if pipe is
+        False, through the REPL in a pseudo-terminal driven with pexpect.
         """
+        self._pipe = JuliaPipe() if pipe else None
         self._prompt = 'julia>'
         Expect.__init__(self,
                         name                = 'Julia',
@@ -62,6 +322,9 @@ class Julia(Expect):
     def _start(self):
         """
         """
+        if self._pipe is not None:
+            self._pipe.start()
+            return
         pexpect_env = dict(os.environ)
         pexpect_env['TERM'] = 'vt100'  # we *use* the codes. DUH.  I should have thought of this 10 years ago...
         self._expect = pexpect.spawn(self._Expect__command, logfile=self._Expect__logfile, env=pexpect_env)
@@ -71,6 +334,8 @@ class Julia(Expect):
     def eval(self, code, **ignored):
         """
         """
+        if self._pipe is not None:
+            return self._pipe.eval(code)
         if isinstance(code, unicode):
             code = code.encode('utf8')
 
@@ -103,6 +368,89 @@ class Julia(Expect):
                 raise RuntimeError(julia_error)
             return result
 
+    def is_running(self):
+        if self._pipe is not None:
+            return self._pipe.is_running()
+        return Expect.is_running(self)
+
+    def pid(self):
+        if self._pipe is not None:
+            return self._pipe.pid()
+        return Expect.pid(self)
+
+    def quit(self, verbose=False):
+        if self._pipe is not None:
+            self._pipe.quit()
+        else:
+            Expect.quit(self, verbose=verbose)
+
+    def interrupt(self, *args, **kwds):
+        if self._pipe is not None:
+            if self._pipe.is_running():
+                os.kill(self._pipe.pid(), signal.SIGINT)
+            return True
+        return Expect.interrupt(self, *args, **kwds)
+
+    def set_array(self, var, a):
+        """
+        Set the variable var to an array with the entries of the numpy
+        array a, which must have one of the JULIA_DTYPES, transferring
+        them in binary, through the pipe, or if there is none, through a
+        temporary file that julia reads.
+
+        EXAMPLES::
+
+            sage: import numpy
+            sage: julia.set_array('x', numpy.arange(6.).reshape(2,3))
+            sage: julia.eval('x[2,1]')
+            '3.0'
+        """
+        if self._pipe is not None:
+            self._pipe.set_array(var, a)
+            return
+        a = julia_array(a)
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'array')
+            a.ravel(order='F').tofile(filename)
+            self.eval('%s = read!(%s, zeros(%s));'%(var, julia_string(filename),
+                                                    ', '.join([JULIA_TYPES[a.dtype.name]] + [str(d) for d in a.shape])))
+        finally:
+            shutil.rmtree(tmp)
+
+    def get_array(self, var):
+        """
+        Return a numpy array with the entries of the array var,
+        transferred in binary, through the pipe, or if there is none,
+        through a temporary file that julia writes.
+
+        EXAMPLES::
+
+            sage: julia.eval('x = [1 2; 3 4];')
+            ''
+            sage: julia.get_array('x')
+            array([[1, 2],
+                   [3, 4]])
+        """
+        if self._pipe is not None:
+            return self._pipe.get_array(var)
+        import numpy
+        error = "%s is not an array of one of the types %s"%(var, ', '.join(JULIA_DTYPES))
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'array')
+            self.eval('let a = %s; isa(a, Array) || error(%s); '
+                      'open(io -> print(io, join([string(eltype(a)), size(a)...], " ")), %s, "w"); '
+                      'open(io -> write(io, a), %s, "w"); end;'%(
+                          var, julia_string(error), julia_string(filename + '.header'), julia_string(filename)))
+            fields = open(filename + '.header').read().split()
+            if fields[0] not in JULIA_TYPE_DTYPES:
+                raise RuntimeError("ERROR: " + error)
+            return numpy.fromfile(filename, dtype=JULIA_TYPE_DTYPES[fields[0]]).reshape(
+                [int(d) for d in fields[1:]], order='F')
+        finally:
+            shutil.rmtree(tmp)
+
     def _an_element_impl(self):
         """
         EXAMPLES::
@@ -195,6 +543,8 @@ class Julia(Expect):
             sage: julia.trait_names()
             ['ANY', ..., 'zip']
         """
+        if self._pipe is not None:
+            return sorted(self.eval('print(join(map(string, names(Base)), " "))').split())
         s = julia.eval('\t\t')
         v = []
         for x in s.split('\x1b[')[:-1]:
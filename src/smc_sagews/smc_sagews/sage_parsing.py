@@ -12,8 +12,13 @@ Code for parsing Sage code blocks sensibly.
 #                  http://www.gnu.org/licenses/                                         #
 #########################################################################################
 
+import bisect
+import collections
 import string
+import tokenize
 import traceback
+import types
+import weakref
 
 def get_input(prompt):
     try:
@@ -53,6 +58,15 @@ def preparse_code(code):
     import sage.all_cmdline
     return sage.all_cmdline.preparse(code, ignore_prompts=True)
 
+def preparse_state():
+    """
+    Return the settings of the Sage preparser that change what preparse_code
+    returns, e.g., whether implicit multiplication is on.
+    """
+    import sage.all_cmdline
+    g = getattr(sage.all_cmdline.preparse, 'func_globals', {})
+    return (g.get('implicit_mul_level'), g.get('numeric_literal_prefix'))
+
 def strip_string_literals(code, state=None):
     new_code = []
     literals = {}
@@ -63,10 +77,16 @@ def strip_string_literals(code, state=None):
         raw = False
     else:
         in_quote, raw = state
+    # the next quotes and hash at or after q; only searched for again once q passes
+    # them, so that code with many literals is not scanned to the end each time
+    sig_q = dbl_q = hash_q = -2
     while True:
-        sig_q = code.find("'", q)
-        dbl_q = code.find('"', q)
-        hash_q = code.find('#', q)
+        if -1 < sig_q < q or sig_q == -2:
+            sig_q = code.find("'", q)
+        if -1 < dbl_q < q or dbl_q == -2:
+            dbl_q = code.find('"', q)
+        if -1 < hash_q < q or hash_q == -2:
+            hash_q = code.find('#', q)
         q = min(sig_q, dbl_q)
         if q == -1: q = max(sig_q, dbl_q)
         if not in_quote and hash_q != -1 and (q == -1 or hash_q < q):
@@ -143,17 +163,12 @@ def end_of_expr(s):
         i += 1
     return i
 
-# NOTE: The dec_args dict will leak memory over time.  However, it only
-# contains code that was entered, so it should never get big.  It
-# seems impossible to know for sure whether a bit of code will be
-# eventually needed later, so this leakiness seems necessary.
-dec_counter = 0
-dec_args = {}
-
 # Divide the input code (a string) into blocks of code.
+#
+# Lines with code decorators are replaced by calls to salvus.execute_with_code_decorators,
+# with the decorators and the code to decorate as literal arguments, so they live exactly
+# as long as the code that uses them (which may be, e.g., the body of a function).
 def divide_into_blocks(code):
-    global dec_counter
-
     # strip string literals from the input, so that we can parse it without having to worry about strings
     code, literals, state = strip_string_literals(code)
 
@@ -181,15 +196,12 @@ def divide_into_blocks(code):
                 # then code decorators impacts the rest of the code.
                 sexpr = expr.strip()
                 if i == 0 and (len(sexpr) == 0 or sexpr.startswith('#')):
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])'%(line[:i], dec_counter)
                     expr = ('\n'.join(code[len(v)+1:]))%literals
                     done = True
-                else:
-                    # Expr is nonempty -- code decorator only impacts this line
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])'%(line[:i], dec_counter)
-
-                dec_args[dec_counter] = ([line[i+2:j]%literals], expr)
-                dec_counter += 1
+                # the arguments are stored as a literal, so they are not parsed as code below
+                label = "D%s"%len(v)
+                literals[label] = repr(([line[i+2:j]%literals], expr))
+                new_line = '%ssalvus.execute_with_code_decorators(*%%(%s)s)'%(line[:i], label)
             else:
                 new_line = line
             v.append(new_line)
@@ -204,67 +216,106 @@ def divide_into_blocks(code):
     ## so "2+2" breaks.
     ## return [[0,len(code)-1,('\n'.join(code))%literals]]
 
-
     # take only non-empty lines now for Python code.
     code = [x for x in code if x.strip()]
 
-    # Compute the blocks
-    i = len(code)-1
+    # remove comments
+    for k, v in literals.iteritems():
+        if v.startswith('#'):
+            literals[k] = ''
+
+    # Compute the blocks, merging try/except/finally/decorator/else/elif blocks
+    try:
+        starts = block_starts(code)
+    except (tokenize.TokenError, IndentationError):
+        # e.g., unbalanced parentheses or inconsistent indentation
+        starts = block_starts_by_counting(code)
     blocks = []
+    for start, end in zip(starts, starts[1:] + [len(code)]):
+        bs = ('\n'.join(code[start:end])%literals).strip()
+        if not bs: # has to not be only whitespace
+            continue
+        if blocks and continues_block(blocks[-1][-1], bs):
+            blocks[-1][-1] += '\n' + bs
+            blocks[-1][1] = end - 1
+        else:
+            blocks.append([start, end - 1, bs])
+    return blocks
+
+def block_starts(lines):
+    """
+    Return the indices of the lines that start a block, i.e., the lines that
+    start a logical line (according to the tokenize module) at column 0, except
+    for lines starting with a string or comment, which are stripped (see
+    strip_string_literals) and continue the previous block.  The first line
+    always starts a block.
+
+    Raises tokenize.TokenError or IndentationError if lines cannot be tokenized
+    or their parentheses and brackets do not match.
+    """
+    starts = [0]
+    logical_start = True
+    brackets = []
+    readline = iter([line + '\n' for line in lines]).next
+    for typ, tok, (row, col), end, line in tokenize.generate_tokens(readline):
+        if typ == tokenize.OP and tok in _BRACKETS:
+            if tok in '([{':
+                brackets.append(_BRACKETS[tok])
+            elif not brackets or brackets.pop() != tok:
+                raise tokenize.TokenError("unmatched '%s'"%tok, (row, col))
+        if typ == tokenize.NEWLINE:
+            logical_start = True
+        elif typ not in _NON_CODE_TOKENS and logical_start:
+            logical_start = False
+            if col == 0 and row > 1 and not line.startswith('%('):
+                starts.append(row - 1)
+    return starts
+
+_BRACKETS = {'(':')', '[':']', '{':'}', ')':None, ']':None, '}':None}
+_NON_CODE_TOKENS = (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER)
+
+def block_starts_by_counting(lines):
+    """
+    Like block_starts, but for lines that cannot be tokenized: going backwards,
+    a line starts a block unless it is indented or starts with a string or
+    comment, or the lines from it to the end of the block close more
+    parentheses or brackets than they open.  If no line starts the block,
+    its last line is a block by itself.
+    """
+    def depths(line):
+        return [line.count('(') - line.count(')'), line.count('[') - line.count(']'),
+                line.count('{') - line.count('}')]
+    starts = []
+    i = len(lines) - 1
     while i >= 0:
         stop = i
-        paren_depth = code[i].count('(') - code[i].count(')')
-        brack_depth = code[i].count('[') - code[i].count(']')
-        curly_depth = code[i].count('{') - code[i].count('}')
-        while i>=0 and ((len(code[i]) > 0 and (code[i][0] in string.whitespace or code[i][:2] == '%(')) or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
+        depth = depths(lines[i])
+        while i >= 0 and (lines[i][0] in string.whitespace or lines[i][:2] == '%(' or min(depth) < 0):
             i -= 1
             if i >= 0:
-                paren_depth += code[i].count('(') - code[i].count(')')
-                brack_depth += code[i].count('[') - code[i].count(']')
-                curly_depth += code[i].count('{') - code[i].count('}')
-        # remove comments
-        for k, v in literals.iteritems():
-            if v.startswith('#'):
-                literals[k] = ''
-        block = ('\n'.join(code[i:]))%literals
-        bs = block.strip()
-        if bs: # has to not be only whitespace
-            blocks.insert(0, [i, stop, bs])
-        code = code[:i]
-        i = len(code)-1
-
-    # merge try/except/finally/decorator/else/elif blocks
-    i = 1
-    def merge():
-        "Merge block i-1 with block i."
-        blocks[i-1][-1] += '\n' + blocks[i][-1]
-        blocks[i-1][1] = blocks[i][1]
-        del blocks[i]
-
-    while i < len(blocks):
-        s = blocks[i][-1].lstrip()
-
-        # finally/except lines after a try
-        if (s.startswith('finally') or s.startswith('except')) and blocks[i-1][-1].lstrip().startswith('try'):
-            merge()
-
-        # function definitions
-        elif s.startswith('def') and blocks[i-1][-1].splitlines()[-1].lstrip().startswith('@'):
-            merge()
-
-        # lines starting with else conditions (if *and* for *and* while!)
-        elif s.startswith('else') and (blocks[i-1][-1].lstrip().startswith('if') or blocks[i-1][-1].lstrip().startswith('while') or blocks[i-1][-1].lstrip().startswith('for') or blocks[i-1][-1].lstrip().startswith('elif')):
-            merge()
-
-        # lines starting with elif
-        elif s.startswith('elif') and blocks[i-1][-1].lstrip().startswith('if'):
-            merge()
-
-        # do not merge blocks -- move on to next one
-        else:
-            i += 1
+                depth = [a + b for a, b in zip(depth, depths(lines[i]))]
+        if i < 0:
+            i = stop
+        starts.append(i)
+        i -= 1
+    starts.reverse()
+    return starts
 
-    return blocks
+def continues_block(prev, block):
+    """
+    Return True if the (stripped) block continues the compound statement that
+    starts in the block prev, e.g., an except or else clause.
+    """
+    if block.startswith('finally') or block.startswith('except'):
+        return prev.startswith('try')
+    if block.startswith('def') or block.startswith('class'):
+        # decorated function or class
+        return prev[prev.rfind('\n')+1:].lstrip().startswith('@')
+    if block.startswith('else'):
+        return prev.startswith(('if', 'while', 'for', 'elif', 'try'))
+    if block.startswith('elif'):
+        return prev.startswith('if')
+    return False
 
 
 
@@ -293,7 +344,176 @@ def is_valid_identifier(target):
 # Keywords from http://docs.python.org/release/2.7.2/reference/lexical_analysis.html
 _builtin_completions = __builtins__.keys() + ['and', 'del', 'from', 'not', 'while', 'as', 'elif', 'global', 'or', 'with', 'assert', 'else', 'if', 'pass', 'yield', 'break', 'except', 'import', 'print', 'class', 'exec', 'in', 'raise', 'continue', 'finally', 'is', 'return', 'def', 'for', 'lambda', 'try']
 
-def introspect(code, namespace, preparse=True):
+_builtin_completions_set = set(_builtin_completions)
+
+class SortedNames(object):
+    """
+    A list of names, sorted case-insensitively, which can be completed by
+    bisection.
+    """
+    def __init__(self, names=()):
+        self._v = sorted(set((x.lower(), x) for x in names))
+
+    def __len__(self):
+        return len(self._v)
+
+    def add(self, x):
+        t = (x.lower(), x)
+        i = bisect.bisect_left(self._v, t)
+        if i == len(self._v) or self._v[i] != t:
+            self._v.insert(i, t)
+
+    def discard(self, x):
+        t = (x.lower(), x)
+        i = bisect.bisect_left(self._v, t)
+        if i < len(self._v) and self._v[i] == t:
+            del self._v[i]
+
+    def complete(self, prefix, private=True):
+        """
+        Return the sorted list of the rest of the names that start with
+        prefix; names starting with an underscore are only included if
+        private is True or the prefix starts with an underscore.
+        """
+        key = prefix.lower()
+        j = len(prefix)
+        v = []
+        for i in xrange(bisect.bisect_left(self._v, (key,)), len(self._v)):
+            lower, x = self._v[i]
+            if not lower.startswith(key):
+                break
+            if x.startswith(prefix) and (private or prefix or not x.startswith('_')):
+                v.append(x[j:])
+        return v
+
+_HEAPTYPE = 1 << 9   # Py_TPFLAGS_HEAPTYPE: set for classes defined in Python code
+
+class CompletionIndex(object):
+    """
+    Sorted names in a namespace (together with the builtins and keywords),
+    and the sorted attributes of recently completed objects, so that the
+    completions of an identifier are found by bisection instead of by calling
+    dir() and sorting on each request.
+
+    If the namespace has listeners (see sage_server.Namespace.on), the index
+    is invalidated after code is executed in it, and when its number of names
+    changed (e.g., a callback in another thread bound a new name), and
+    otherwise on each request.  Then the names are updated incrementally from
+    the difference between the keys of the namespace and those in the index,
+    once.  The attributes of an
+    object are cached by type if they only depend on its type, and otherwise
+    for the object itself (if it can be weakly referenced).  They are computed
+    again once the index was invalidated, unless they are the attributes of a
+    builtin or extension type, which cannot change.
+    """
+    def __init__(self, namespace, maxsize=128):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self._keys = set()
+        self._names = SortedNames(_builtin_completions)
+        self._attributes = collections.OrderedDict()  # key --> (reference, generation, SortedNames)
+        self._generation = 0        # incremented by invalidate
+        self._names_generation = None
+        self._size = None           # len(namespace) when last checked
+        self._listening = hasattr(namespace, 'on')
+        if self._listening:
+            namespace.on('execute', None, self.invalidate)
+
+    def __repr__(self):
+        return "Completion index of %s names and the attributes of %s objects"%(len(self._names), len(self._attributes))
+
+    def invalidate(self):
+        """
+        Note that the names in the namespace and the attributes of objects
+        may have changed.
+        """
+        self._generation += 1
+
+    def _current_generation(self):
+        if not self._listening:
+            self._generation += 1   # nothing tells us about changes
+        elif len(self.namespace) != self._size:
+            # names were bound or deleted other than by executed code
+            self._size = len(self.namespace)
+            self._generation += 1
+        return self._generation
+
+    def names(self, prefix, update=True):
+        """
+        Return the sorted list of the rest of the names in the namespace
+        (and builtins) that start with prefix.  If update is False, the
+        names in the index are used as they are, e.g., while code that may
+        change the namespace is running in another thread.
+        """
+        if not update or self._names_generation == self._current_generation():
+            return self._names.complete(prefix)
+        self._names_generation = self._generation
+        keys = set(self.namespace)
+        if keys != self._keys:
+            for x in self._keys - keys:
+                if x not in _builtin_completions_set:
+                    self._names.discard(x)
+            for x in keys - self._keys:
+                self._names.add(x)
+            self._keys = keys
+        return self._names.complete(prefix)
+
+    def attributes(self, obj, prefix):
+        """
+        Return the sorted list of the rest of the attributes of obj that
+        start with prefix (excluding private ones, unless prefix starts with
+        an underscore).
+        """
+        return self._attribute_names(obj).complete(prefix, private=False)
+
+    def cached_attributes(self, obj, prefix):
+        """
+        Like attributes, but only using the attributes of obj that are
+        already in the index, without calling dir() or any other code;
+        returns None if they are not there.
+        """
+        entry = self._attributes.get(id(obj))
+        if entry is None or entry[0]() is not obj:
+            entry = self._attributes.get(('type', type(obj)))
+            if entry is None or entry[0]() is not type(obj):
+                return None
+        return entry[2].complete(prefix, private=False)
+
+    def _attribute_names(self, obj):
+        has_trait_names = hasattr(obj, 'trait_names')
+        d = getattr(obj, '__dict__', None)
+        generation = self._current_generation()
+        if not has_trait_names and d is None and not hasattr(type(obj), '__dir__'):
+            # dir(obj) is the attributes of its class
+            key, ref = ('type', type(obj)), weakref.ref(type(obj))
+            if not type(obj).__flags__ & _HEAPTYPE:
+                generation = None   # a builtin or extension type, whose attributes do not change
+        else:
+            try:
+                key, ref = id(obj), weakref.ref(obj)
+            except TypeError:  # cannot be weakly referenced, so not cached
+                return SortedNames(self._dir(obj, has_trait_names))
+        entry = self._attributes.pop(key, None)
+        if entry is None or entry[0]() is None or entry[1] != generation:
+            entry = (ref, generation, SortedNames(self._dir(obj, has_trait_names)))
+        self._attributes[key] = entry   # most recently used
+        while len(self._attributes) > self.maxsize:
+            self._attributes.popitem(last=False)
+        return entry[2]
+
+    def _dir(self, obj, has_trait_names):
+        v = [x for x in dir(obj) if x]
+        if has_trait_names:
+            v += obj.trait_names()
+        return v
+
+def is_dotted_name(s):
+    """
+    Return True if s is of the form 'a.b.c', where a, b and c are valid identifiers.
+    """
+    return all(is_valid_identifier(t) for t in s.split('.'))
+
+def introspect(code, namespace, preparse=True, evaluate=True, index=None):
     """
     INPUT:
 
@@ -302,8 +522,18 @@ def introspect(code, namespace, preparse=True):
     - namespace -- a dictionary to complete in (we also complete using
       builtins such as 'def', 'for', etc.
 
+    - index -- a CompletionIndex of namespace, or None, to complete
+      identifiers using it
+
     - preparse -- a boolean
 
+    - evaluate -- a boolean (default: True); if False, do not run any code
+      (not even getattr or dir, which may call code of the user), and only
+      complete names, attributes of modules and attributes of objects that
+      are already in index.  This is safe to do in another thread while code
+      is running in the namespace.  Returns None if the answer cannot be
+      found that way, e.g., for docstrings and source code.
+
     OUTPUT:
 
     An object: {'result':, 'target':, 'expr':, 'status':, 'get_help':, 'get_completions':, 'get_source':}
@@ -377,6 +607,9 @@ def introspect(code, namespace, preparse=True):
                         target = expr
 
         if get_completions and target == expr:
+            if index is not None:
+                return {'result':index.names(expr, update=evaluate), 'target':target, 'expr':expr, 'status':'ok',
+                        'get_help':False, 'get_completions':True, 'get_source':False}
             j      = len(expr)
             v      = [x[j:] for x in (namespace.keys() + _builtin_completions) if x.startswith(expr)]
         else:
@@ -389,31 +622,55 @@ def introspect(code, namespace, preparse=True):
             # non-interruptable code is called, which should be rare.
 
             O = None
-            try:
-                import signal
-                def mysig(*args): raise KeyboardInterrupt
-                signal.signal(signal.SIGALRM, mysig)
-                signal.alarm(1)
-                import sage.all_cmdline
-                if before_expr.strip():
-                    try:
-                        exec (before_expr if not preparse else preparse_code(before_expr)) in namespace
-                    except Exception, msg:
-                        pass
-                        # uncomment for debugging only
-                        # traceback.print_exc()
-                # We first try to evaluate the part of the expression before the name
+            if not evaluate:
+                # Only look up a name, e.g., 'sage.all.ZZ', starting in the
+                # namespace and going through the __dict__ of modules;
+                # anything else could run code.
+                if not get_completions or before_expr.strip() or not is_dotted_name(obj):
+                    return None
+                v = obj.split('.')
+                d = namespace if v[0] in namespace else __builtins__
+                for attr in v:
+                    if d is None or attr not in d:
+                        return None
+                    O = d[attr]
+                    d = O.__dict__ if type(O) is types.ModuleType else None
+                if d is not None:
+                    v = SortedNames(list(d)).complete(target, private=False)
+                elif index is not None:
+                    v = index.cached_attributes(O, target)
+                else:
+                    v = None
+                if v is None:
+                    return None
+                return {'result':v, 'target':target, 'expr':expr, 'status':'ok',
+                        'get_help':False, 'get_completions':True, 'get_source':False}
+            else:
                 try:
-                    O = eval(obj if not preparse else preparse_code(obj), namespace)
-                except SyntaxError:
-                    # If that fails, we try on a subexpression.
-                    # TODO: This will not be needed when
-                    # this code is re-written to parse using an
-                    # AST, instead of using this lame hack.
-                    obj = guess_last_expression(obj)
-                    O = eval(obj if not preparse else preparse_code(obj), namespace)
-            finally:
-                signal.signal(signal.SIGALRM, signal.SIG_IGN)
+                    import signal
+                    def mysig(*args): raise KeyboardInterrupt
+                    signal.signal(signal.SIGALRM, mysig)
+                    signal.alarm(1)
+                    import sage.all_cmdline
+                    if before_expr.strip():
+                        try:
+                            exec (before_expr if not preparse else preparse_code(before_expr)) in namespace
+                        except Exception, msg:
+                            pass
+                            # uncomment for debugging only
+                            # traceback.print_exc()
+                    # We first try to evaluate the part of the expression before the name
+                    try:
+                        O = eval(obj if not preparse else preparse_code(obj), namespace)
+                    except SyntaxError:
+                        # If that fails, we try on a subexpression.
+                        # TODO: This will not be needed when
+                        # this code is re-written to parse using an
+                        # AST, instead of using this lame hack.
+                        obj = guess_last_expression(obj)
+                        O = eval(obj if not preparse else preparse_code(obj), namespace)
+                finally:
+                    signal.signal(signal.SIGALRM, signal.SIG_IGN)
 
             def get_file():
                 try:
@@ -463,6 +720,9 @@ def introspect(code, namespace, preparse=True):
                     result += "Unable to read source code (%s)"%err
 
             elif get_completions:
+                if O is not None and index is not None:
+                    return {'result':index.attributes(O, target), 'target':target, 'expr':expr, 'status':'ok',
+                            'get_help':False, 'get_completions':True, 'get_source':False}
                 if O is not None:
                     v = dir(O)
                     if hasattr(O, 'trait_names'):
@@ -478,7 +738,9 @@ def introspect(code, namespace, preparse=True):
             result = list(sorted(set(v), lambda x,y:cmp(x.lower(),y.lower())))
 
     except Exception, msg:
-        traceback.print_exc()
+        if evaluate:
+            # (otherwise, we may be in another thread, and must not print into the output of running code)
+            traceback.print_exc()
         result = []
         status = 'ok'
     else:
@@ -29,9 +29,121 @@ def uuid():
 ##########################################################################
 # New function interact implementation
 ##########################################################################
-import inspect
+import collections, gc, hashlib, inspect, weakref
+
+class InteractRegistry(object):
+    """
+    The interacts of this session, by id, so that the client can update
+    them.  The maxsize most recently created or used interacts are kept
+    alive; older ones are only weakly referenced, so they still work as long
+    as something else (e.g., the function returned by interact) refers to
+    them, but their controls, closures and the objects those refer to are
+    freed otherwise.
+    """
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._recent = collections.OrderedDict()        # id --> InteractCell
+        self._old = {}                                  # id --> weak reference to InteractCell
+        self._evicted = collections.OrderedDict()       # ids of freed interacts
+
+    def __repr__(self):
+        return "%s recent and %s older interacts"%(len(self._recent), len(self._old))
+
+    def __len__(self):
+        return len(self._recent) + len(self._old)
+
+    def __contains__(self, id):
+        return id in self._recent or (id in self._old and self._old[id]() is not None)
+
+    def __setitem__(self, id, I):
+        self._recent.pop(id, None)
+        self._old.pop(id, None)
+        self._recent[id] = I
+        while len(self._recent) > max(self.maxsize, 0):
+            old_id, old_I = self._recent.popitem(last=False)
+            self._old[old_id] = weakref.ref(old_I, lambda r, old_id=old_id: self._freed(old_id, r))
+
+    def _freed(self, id, r):
+        if self._old.get(id) is not r:
+            return
+        del self._old[id]
+        self._evicted[id] = True
+        while len(self._evicted) > 10*max(self.maxsize, 1):
+            self._evicted.popitem(last=False)
+
+    def __getitem__(self, id):
+        I = self._recent.get(id)
+        if I is None:
+            r = self._old.get(id)
+            I = r() if r is not None else None
+            if I is None:
+                raise KeyError(id)
+        self[id] = I   # most recently used
+        return I
+
+    def get(self, id, default=None):
+        try:
+            return self[id]
+        except KeyError:
+            return default
+
+    def evicted(self, id):
+        """
+        Return True if the interact with the given id was freed since it was
+        not among the maxsize most recently used ones.
+        """
+        return id in self._evicted
 
-interacts = {}
+    def clear(self):
+        self._recent.clear()
+        self._old.clear()
+
+    def memory(self):
+        """
+        Return a dictionary mapping the id of each interact to the approximate
+        number of bytes of memory it retains (see InteractCell.memory).
+        """
+        v = self._recent.items() + [(id, r()) for id, r in self._old.items()]
+        return dict((id, I.memory()) for id, I in v if I is not None)
+
+interacts = InteractRegistry()
+
+def retained_size(obj, max_objects=100000):
+    """
+    Return the approximate number of bytes used by obj and the objects it
+    refers to, not counting modules, classes and the globals of functions
+    (e.g., the worksheet namespace), and visiting at most max_objects
+    objects.  Objects that do not report what they refer to to the garbage
+    collector (e.g., many Cython objects) only count with their own size.
+    """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack and len(seen) < max_objects:
+        x = stack.pop()
+        if id(x) in seen or isinstance(x, (types.ModuleType, type, types.ClassType)):
+            continue
+        seen.add(id(x))
+        try:
+            size += sys.getsizeof(x)
+        except Exception:
+            pass
+        if isinstance(x, types.FunctionType):
+            stack.extend(c.cell_contents for c in (x.func_closure or ()) if _cell_has_contents(c))
+            stack.extend(x.func_defaults or ())
+            stack.append(x.func_dict)
+        elif isinstance(x, dict) and x.get('__builtins__') is not None:
+            continue   # globals of a module or of the worksheet
+        else:
+            stack.extend(gc.get_referents(x))
+    return size
+
+def _cell_has_contents(c):
+    try:
+        c.cell_contents
+        return True
+    except ValueError:
+        return False
 
 def jsonable(x):
     """
@@ -52,7 +164,7 @@ def jsonable(x):
 class InteractCell(object):
     def __init__(self, f, layout=None, width=None, style=None,
                  update_args=None, auto_update=True,
-                 flicker=False, output=True):
+                 flicker=False, output=True, incremental=False):
         """
         Given a function f, create an object that describes an interact
         for working with f interactively.
@@ -70,12 +182,16 @@ class InteractCell(object):
           never shrinks; it can only grow, which aleviates flicker.
         - ``output`` -- (default: True) if False, do not automatically
           provide any area to display output.
+        - ``incremental`` -- (default: False) if True, only call f if an input
+          changed, and only send the output that changed (see __call__).
         """
         self._flicker = flicker
         self._output = output
+        self._incremental = incremental
+        self._client_vals = {}       # values the client sent, before conversion (if incremental)
+        self._output_hashes = None   # see InteractOutput
         self._uuid = uuid()
-        # Prevent garbage collection until client specifically requests it,
-        # since we want to be able to store state.
+        # Keep the interact, so the client can update it (see InteractRegistry).
         interacts[self._uuid] = self
         self._f = f
         self._width = jsonable(width)
@@ -191,17 +307,43 @@ class InteractCell(object):
             X['layout'] = self._layout
         X['style'] = self._style
         X['flicker'] = self._flicker
+        if self._incremental:
+            X['incremental'] = True
         return X
 
+    def memory(self):
+        """
+        Return the approximate number of bytes of memory retained by this
+        interact: its function (with its closure and default arguments) and
+        its controls and their values, but not the worksheet namespace.
+        """
+        return retained_size([self._f, self._controls, self._last_vals])
+
     def __call__(self, vals):
         """
         Call self._f with inputs specified by vals.  Any input variables not
         specified in vals will have the value they had last time.
+
+        If the interact is incremental, a value that is the same as the one
+        the client sent last time is not converted again, f is not called if
+        no value changed since it last ran, and output that is the same as
+        that of the last run is not sent again (see InteractOutput).
         """
+        if self._incremental:
+            # only the inputs that changed, and buttons, which send the same value each time
+            vals = dict((k, v) for k, v in vals.iteritems()
+                        if k not in self._client_vals or self._client_vals[k] != v
+                           or getattr(self._controls.get(k), '_control_type', None) == 'button')
+            output = InteractOutput(self)
+            if salvus._output_filter is None:
+                salvus._output_filter = output
+
         self.changed = [str(x) for x in vals.keys()]
         for k, v in vals.iteritems():
             x = self._controls[k](v)
             self._last_vals[k] =  x
+            if self._incremental:
+                self._client_vals[k] = v
 
         if self._update_args is not None:
             do_it = False
@@ -209,14 +351,70 @@ class InteractCell(object):
                 if v in self.changed:
                     do_it = True
             if not do_it:
+                if self._incremental:
+                    output.keep_all()
                 return
 
+        if self._incremental and not vals and self._output_hashes is not None:
+            output.keep_all()
+            return
+
         interact_exec_stack.append(self)
         try:
             self._f(**dict([(k,self._last_vals[k]) for k in self._args]))
         finally:
             interact_exec_stack.pop()
 
+class InteractOutput(object):
+    """
+    Filter for the output messages of one update of an incremental interact
+    (see Salvus._send_output_now).  The client shows the output of each
+    message separately, and a message whose content is the same as that of
+    the message at the same position in the last update is not sent;
+    instead, the next message that is sent has interact_keep=[start, stop],
+    which tells the client to keep the output of those messages of the last
+    update.  Javascript, nested interacts, etc., are always sent.
+    """
+    KEEP = frozenset(['stdout', 'stderr', 'code', 'html', 'md', 'tex', 'd3', 'file', 'events', 'once'])
+    NOT_CONTENT = frozenset(['event', 'id', 'done', 'interact_keep'])
+
+    def __init__(self, interact_cell):
+        self._interact_cell = interact_cell
+        self._last = interact_cell._output_hashes or []
+        self._hashes = []
+        self._keep = None
+
+    def keep_all(self):
+        """
+        Keep all output of the last update, instead of running the interact.
+        """
+        self._hashes = list(self._last)
+        if self._last:
+            self._keep = [0, len(self._last)]
+
+    def __call__(self, mesg):
+        content = dict((k, v) for k, v in mesg.iteritems() if k not in self.NOT_CONTENT)
+        if content:
+            i = len(self._hashes)
+            h = None
+            if self.KEEP.issuperset(content):
+                h = hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+            self._hashes.append(h)
+            if h is not None and i < len(self._last) and self._last[i] == h:
+                if self._keep is None:
+                    self._keep = [i, i+1]
+                else:
+                    self._keep[1] = i+1
+                if not mesg.get('done'):
+                    return None
+                mesg = dict((k, v) for k, v in mesg.iteritems() if k in self.NOT_CONTENT)
+        if self._keep is not None:
+            mesg['interact_keep'] = self._keep
+            self._keep = None
+        if mesg.get('done'):
+            self._interact_cell._output_hashes = self._hashes
+        return mesg
+
 class InteractFunction(object):
     def __init__(self, interact_cell):
         self.__dict__['interact_cell'] = interact_cell
@@ -234,6 +432,7 @@ class InteractFunction(object):
             v = I._controls[arg].convert_to_client(value)
             desc = {'var':arg, 'default':v}
             I._last_vals[arg] = value
+            I._client_vals.pop(arg, None)
         else:
             # create a new control
             new_control = interact_control(arg, value)
@@ -305,6 +504,11 @@ class Interact(object):
       be re-evaluated; changing other controls will not cause an update.
     - ``auto_update`` -- (default: True); if False, a button labeled
       'Update' will appear which you can click on to re-evalute.
+    - ``incremental`` -- (default: False); if True, the function is
+      only re-evaluated when the value of a control changed, and only
+      output that differs from that of the last evaluation is sent to
+      the browser again (e.g., an unchanged plot is not).  Only use
+      this if the function's output only depends on the controls.
     - ``layout`` -- (default: one control per row) a list [row0,
       row1, ...] of lists of tuples row0 = [(var_name, width,
       label), ...], where the var_name's are strings, the widths
@@ -426,12 +630,14 @@ class Interact(object):
                 c += 1
                 sleep(.25)
     """
-    def __call__(self, f=None, layout=None, width=None, style=None, update_args=None, auto_update=True, flicker=False, output=True):
+    def __call__(self, f=None, layout=None, width=None, style=None, update_args=None, auto_update=True, flicker=False, output=True,
+                 incremental=False):
         if f is None:
-            return _interact_layout(layout, width, style, update_args, auto_update, flicker)
+            return _interact_layout(layout, width, style, update_args, auto_update, flicker, output, incremental)
         else:
             return salvus.interact(f, layout=layout, width=width, style=style,
-                                   update_args=update_args, auto_update=auto_update, flicker=flicker, output=output)
+                                   update_args=update_args, auto_update=auto_update, flicker=flicker, output=output,
+                                   incremental=incremental)
 
     def __setattr__(self, arg, value):
         I = interact_exec_stack[-1]
@@ -440,6 +646,7 @@ class Interact(object):
             v = I._controls[arg].convert_to_client(value)
             desc = {'var':arg, 'default':v}
             I._last_vals[arg] = value
+            I._client_vals.pop(arg, None)
         else:
             # create a new control
             new_control = interact_control(arg, value)
@@ -1402,7 +1609,8 @@ class Time:
     - write time('some code') to executation of the contents of the string.
 
     If you want to time repeated execution of code for benchmarking purposes, use
-    the timeit command instead.
+    the timeit command instead (e.g., %timeit(stats=True), which also shows the
+    spread of the times and compares with saved baselines).
     """
     def __init__(self, start=False):
         if start:
@@ -1474,9 +1682,36 @@ def timeit(*args, **kwds):
 
         [rest of the cell]
 
+    With stats=True, the code is instead benchmarked: it is run for a
+    while to warm up, and then timed in samples of many loops until the
+    mean time per loop is known precisely enough (see TIMEIT_PRECISION)
+    or TIMEIT_MAX_TIME seconds have passed.  The mean, its 95% confidence
+    interval, the standard deviation and percentiles of the time per loop
+    are shown, with the CPU time and the number of objects left (not
+    freed by reference counting) per loop::
+
+        %timeit(stats=True)  sorted(v)
+
+    Called as timeit('sorted(v)', stats=True), it returns the TimeitStats
+    instead of printing them.  Giving a name saves the result as a named
+    baseline in the project (in TIMEIT_BASELINE_PATH), and compares it
+    with the previous result of that name, or with the last one at least
+    against days old::
+
+        %timeit(name='sort', against=7)  sorted(v)
+
+    shows, e.g., "sort: 12.3% slower than 2016-10-10 09:41 (95% CI: 10.9%
+    to 13.7%)".  Use save=False to compare without saving.
+
     Here is the original docstring for timeit:
 
     """
+    if kwds.pop('stats', False) or 'name' in kwds:
+        if len(args) == 0:
+            def block(code):
+                print timeit_stats(code, **kwds)
+            return block
+        return timeit_stats(*args, **kwds)
     def go(code):
         print sage.misc.sage_timeit.sage_timeit(code, globals_dict=salvus.namespace, **kwds)
     if len(args) == 0:
@@ -1487,6 +1722,252 @@ def timeit(*args, **kwds):
 # TODO: these need to also give the argspec
 timeit.__doc__ += sage.misc.sage_timeit.sage_timeit.__doc__
 
+# Statistical timing (see timeit): the code is run for at least TIMEIT_WARMUP seconds before
+# it is measured, and then timed in samples of at least TIMEIT_SAMPLE_TIME seconds, until the
+# 95% confidence interval of the mean time is within TIMEIT_PRECISION of it (after at least
+# TIMEIT_MIN_SAMPLES samples), TIMEIT_MAX_TIME seconds have passed (after at least two
+# samples) or there are TIMEIT_MAX_SAMPLES samples.
+TIMEIT_WARMUP = .2
+TIMEIT_SAMPLE_TIME = .005
+TIMEIT_PRECISION = .01
+TIMEIT_MIN_SAMPLES = 10
+TIMEIT_MAX_SAMPLES = 10000
+TIMEIT_MAX_TIME = 3
+TIMEIT_PERCENTILES = (5, 25, 50, 75, 95, 99)
+# Named baselines are saved in this directory of the project, with at most TIMEIT_HISTORY
+# results of each name.
+TIMEIT_BASELINE_PATH = os.path.join(os.environ['SMC'], 'timeit')
+TIMEIT_HISTORY = 100
+
+# 97.5% quantiles of Student's t distribution with 1, 2, ..., 29 degrees of freedom
+_T975 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145,
+         2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045]
+
+def _t975(df):
+    if df < 1:
+        return float('inf')
+    if df < 30:
+        return _T975[int(df) - 1]
+    return 1.96 + 2.4 / df
+
+def _format_time(t):
+    for unit, scale in [('s', 1), ('ms', 1e3), ('us', 1e6)]:
+        if abs(t) * scale >= 1:
+            return "%.3g %s"%(t * scale, unit)
+    return "%.3g ns"%(t * 1e9)
+
+class TimeitStats(object):
+    """
+    Statistics of the time per loop of benchmarked code (see timeit).
+
+    The samples are the mean times per loop of each sample of number
+    loops; mean, stddev and the percentiles are of these, and ci is the
+    half width of the 95% confidence interval of the mean.  cpu is the
+    mean CPU time per loop, and objects the number of objects (tracked by
+    the garbage collector) per loop that were allocated, but not freed by
+    reference counting.  If a baseline was compared, comparison is the
+    relative change (e.g., .1 if 10% slower) with its 95% confidence
+    interval, and baseline the result it was compared with.
+    """
+    def __init__(self, samples, number, cpu, objects, name=None):
+        import math
+        self.samples = samples
+        self.number = number
+        self.cpu = cpu
+        self.objects = objects
+        self.name = name
+        self.time = _time_module().time()
+        n = self.n = len(samples)
+        self.mean = sum(samples) / n
+        self.stddev = math.sqrt(sum([(x - self.mean)**2 for x in samples]) / (n - 1)) if n > 1 else 0.
+        self.ci = _t975(n - 1) * self.stddev / math.sqrt(n)
+        v = sorted(samples)
+        self.min = v[0]
+        self.max = v[-1]
+        self.percentiles = {}
+        for p in TIMEIT_PERCENTILES:
+            k = (n - 1) * p / 100.
+            i = int(k)
+            self.percentiles[p] = v[i] + (v[min(i + 1, n - 1)] - v[i]) * (k - i)
+        self.baseline = self.comparison = None
+
+    def summary(self):
+        """
+        Return the dict that is saved as a baseline.
+        """
+        return {'time':self.time, 'n':self.n, 'number':self.number, 'mean':self.mean, 'stddev':self.stddev,
+                'min':self.min, 'max':self.max, 'percentiles':dict([(str(p), x) for p, x in self.percentiles.iteritems()]),
+                'cpu':self.cpu, 'objects':self.objects}
+
+    def compare(self, baseline):
+        """
+        Return the relative change of the mean time from the given baseline
+        (a summary), e.g., .1 if 10% slower, and the lower and upper end of
+        its 95% confidence interval.
+        """
+        import math
+        m0, m1 = baseline['mean'], self.mean
+        v0, v1 = baseline['stddev']**2 / baseline['n'], self.stddev**2 / self.n
+        r = m1 / m0
+        if v0 + v1 == 0:
+            return r - 1, r - 1, r - 1
+        # delta method for the ratio of the means, with Welch-Satterthwaite degrees of freedom
+        se = r * math.sqrt(v0 / m0**2 + v1 / m1**2)
+        df = (v0 + v1)**2 / ((v0**2 / (baseline['n'] - 1) if baseline['n'] > 1 else 0) +
+                             (v1**2 / (self.n - 1) if self.n > 1 else 0))
+        h = _t975(df) * se
+        return r - 1, r - h - 1, r + h - 1
+
+    def __repr__(self):
+        import datetime
+        f = _format_time
+        s = "%s loops x %s samples: mean %s +- %s (95%% CI), stddev %s\n"%(
+            self.number, self.n, f(self.mean), f(self.ci), f(self.stddev))
+        s += ', '.join(["min %s"%f(self.min)] + ["%s%% %s"%(p, f(self.percentiles[p])) for p in sorted(self.percentiles)] +
+                       ["max %s"%f(self.max)]) + '\n'
+        s += "cpu %s, %.3g objects left per loop"%(f(self.cpu), self.objects)
+        if self.comparison is not None:
+            c, lo, hi = self.comparison
+            when = datetime.datetime.fromtimestamp(self.baseline['time']).strftime('%Y-%m-%d %H:%M')
+            if lo <= 0 <= hi:
+                s += "\n%s: no significant change from %s (%+.1f%%, 95%% CI: %+.1f%% to %+.1f%%)"%(
+                    self.name, when, 100*c, 100*lo, 100*hi)
+            else:
+                s += "\n%s: %.1f%% %s than %s (95%% CI: %.1f%% to %.1f%%)"%(
+                    self.name, 100*abs(c), 'slower' if c > 0 else 'faster', when,
+                    100*min(abs(lo), abs(hi)), 100*max(abs(lo), abs(hi)))
+        elif self.name is not None:
+            s += "\n%s: no earlier result to compare with"%self.name
+        return s
+
+def _time_module():
+    # the time module, since time is the Time object in this module
+    return sys.modules['time']
+
+def timeit_baselines(name, path=None):
+    """
+    Return the saved results of the benchmark with the given name (see
+    timeit), oldest first, as a list of dicts.
+    """
+    filename = _timeit_baseline_file(name, path)
+    if not os.path.exists(filename):
+        return []
+    return json.load(open(filename))
+
+def _timeit_baseline_file(name, path=None):
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        raise ValueError("invalid benchmark name '%s'"%name)
+    return os.path.join(TIMEIT_BASELINE_PATH if path is None else path, name + '.json')
+
+def _timeit_save(name, summary, path=None):
+    import tempfile
+    filename = _timeit_baseline_file(name, path)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    v = (timeit_baselines(name, path) + [summary])[-TIMEIT_HISTORY:]
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(v, f)
+    os.rename(tmp, filename)   # so that readers never see a partially written file
+
+def _indent_code(code, prefix):
+    """
+    Return code with prefix in front of each line, except for the lines that
+    continue a string literal (e.g., in triple quotes), whose value would
+    change otherwise.
+    """
+    import tokenize
+    lines = [line + '\n' for line in code.split('\n')]
+    continued = set()   # (0-based) numbers of lines within string literals
+    try:
+        for typ, _, (srow, _), (erow, _), _ in tokenize.generate_tokens(iter(lines).next):
+            if typ == tokenize.STRING:
+                continued.update(xrange(srow, erow))
+    except (tokenize.TokenError, IndentationError):
+        pass   # compiling the code reports the error
+    return ''.join([line if i in continued else prefix + line for i, line in enumerate(lines)])
+
+def timeit_stats(code, name=None, against=None, save=True, preparse=True, globals_dict=None,
+                 warmup=None, max_time=None, precision=None):
+    """
+    Benchmark code and return its TimeitStats, as described in timeit.
+
+    If name is given, the result is compared with the last saved result
+    of that name that is at least against days old (by default, the last
+    one), and saved, unless save is False.  The remaining arguments
+    default to salvus.namespace and TIMEIT_WARMUP, TIMEIT_MAX_TIME and
+    TIMEIT_PRECISION.
+    """
+    import gc, math
+    timer = _time_module().time
+    if globals_dict is None:
+        globals_dict = salvus.namespace
+    if preparse:
+        code = globals_dict['preparse'](code)
+    warmup = TIMEIT_WARMUP if warmup is None else warmup
+    max_time = TIMEIT_MAX_TIME if max_time is None else max_time
+    precision = TIMEIT_PRECISION if precision is None else precision
+
+    # the code is run in a loop in a function, so that each loop costs little more than the code
+    src = "def _timeit_inner(_timeit_number):\n    for _timeit_i in xrange(_timeit_number):\n"
+    src += _indent_code(code, ' ' * 8) if code.strip() else "        pass\n"
+    d = {}
+    exec compile(src, '<timeit>', 'exec') in globals_dict, d
+    inner = d['_timeit_inner']
+
+    # warm up (caches, lazy imports, ...) and estimate the time per loop
+    t0 = timer()
+    loops = 0
+    while loops == 0 or timer() - t0 < warmup:
+        inner(1)
+        loops += 1
+    number = max(1, int(TIMEIT_SAMPLE_TIME * loops / max(timer() - t0, 1e-9)))
+
+    samples = []
+    total = total2 = 0.
+    start = timer()
+    cpu0 = _time_module().clock()
+    while len(samples) < TIMEIT_MAX_SAMPLES:
+        t = timer()
+        inner(number)
+        x = (timer() - t) / number
+        samples.append(x)
+        total += x
+        total2 += x * x
+        n = len(samples)
+        if n >= 2 and timer() - start >= max_time:
+            break
+        if n >= TIMEIT_MIN_SAMPLES:
+            mean = total / n
+            stddev = math.sqrt(max(0., total2 - n * mean * mean) / (n - 1))
+            if _t975(n - 1) * stddev / math.sqrt(n) <= precision * mean:
+                break
+    cpu = (_time_module().clock() - cpu0) / (len(samples) * number)
+
+    # objects allocated, but not freed, per loop (the garbage collector counts allocations
+    # minus deallocations of the objects it tracks, and does not reset the count while disabled)
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        c = gc.get_count()[0]
+        inner(number)
+        objects = float(gc.get_count()[0] - c) / number
+    finally:
+        if enabled:
+            gc.enable()
+
+    stats = TimeitStats(samples, number, cpu, objects, name)
+    if name is not None:
+        v = timeit_baselines(name)
+        if against is not None:
+            v = [b for b in v if b['time'] <= stats.time - against * 86400]
+        if v:
+            stats.baseline = v[-1]
+            stats.comparison = stats.compare(v[-1])
+        if save:
+            _timeit_save(name, stats.summary())
+    return stats
+
 
 class Capture:
     """
@@ -1594,32 +2075,23 @@ def cython(code=None, **kwds):
 
     Just put %cython at the top of a cell, and the rest is compiled as Cython code.
     You can pass options to cython by typing "%cython(... var=value...)" instead.
+    The compiled code is cached (see cython_module), so evaluating the same
+    cell again just loads it.
 
     This is a wrapper around Sage's cython function, whose docstring is:
     """
     if code is None:
         return lambda code: cython(code, **kwds)
-    import sage.misc.misc
-    path = sage.misc.misc.tmp_dir()
-    filename = os.path.join(path, 'a.pyx')
-    open(filename, 'w').write(code)
-
     if 'annotate' not in kwds:
         kwds['annotate'] = True
-    import sage.misc.cython
-    modname, path = sage.misc.cython.cython(filename, **kwds)
-
-    try:
-    	sys.path.insert(0,path)
-    	module = __import__(modname)
-    finally:
-    	del sys.path[0]
+    module = cython_module(code, **kwds)
 
     import inspect
     for name, value in inspect.getmembers(module):
         if not name.startswith('_'):
             salvus.namespace[name] = value
 
+    path = os.path.dirname(module.__file__)
     files = os.listdir(path)
     html_filename = None
     for n in files:
@@ -1630,9 +2102,42 @@ def cython(code=None, **kwds):
         html_url = salvus.file(html_filename, raw=True, show=False)
         salvus.html("<a href='%s' target='_new' class='btn btn-small' style='margin-top: 1ex'>Auto-generated code... &nbsp;<i class='fa fa-external-link'></i></a>"%html_url)
 
+def cython_module(code, filename=None, **kwds):
+    """
+    Return the module compiled from the Cython code with Sage's cython
+    function and the given options.  The module is cached in
+    salvus.artifact_cache, so compiling the same code with the same
+    options again (in any session of the project) just loads it.
+
+    If filename is given, it must contain the code, and is compiled
+    where it is, so it can include files next to it.
+    """
+    import shutil
+    import sage.misc.cython
+    def build(key, target):
+        source = filename
+        if source is None:
+            import sage.misc.misc
+            source = os.path.join(sage.misc.misc.tmp_dir(), 'a.pyx')
+            open(source, 'w').write(code)
+        modname, path = sage.misc.cython.cython(source, **kwds)
+        for n in os.listdir(path):
+            if n == modname + '.so' or n.endswith('.html'):
+                shutil.copy(os.path.join(path, n), target)
+        open(os.path.join(target, 'module'), 'w').write(modname + '.so')
+    cache = salvus.artifact_cache
+    return cache.load(cache.lookup('cython', code, build, filename=filename, **kwds))
+
 cython.__doc__ += sage.misc.cython.cython.__doc__
 
 
+# script reads the output of commands in chunks of at most this many bytes.
+SCRIPT_CHUNK_SIZE = 65536
+# script shows the output of a command when it has been quiet for this many seconds.
+SCRIPT_FLUSH_DELAY = .01
+# script keeps at most the last this many bytes of the output of a command.
+SCRIPT_STDOUT_SIZE = 2**20
+
 class script:
     r"""
     Block decorator to run an arbitrary shell command with input from a
@@ -1652,6 +2157,9 @@ class script:
     will launch a gp session, feed 'factor(2^97-1)' into stdin, and
     display the resulting factorization.
 
+    The output of the command (stdout and stderr) appears in the cell
+    as the command produces it.
+
     NOTE: the result is stored in the attribute "stdout", so you can do::
 
         s = script('gp -q')
@@ -1659,7 +2167,8 @@ class script:
         s.stdout
         '\n[11447 1]\n\n[13842607235828485645766393 1]\n\n'
 
-    and s.stdout will now be the output string.
+    and s.stdout will now be the output string (at most its last
+    SCRIPT_STDOUT_SIZE characters).
 
     You may also specify the shell environment with the env keyword.
     """
@@ -1667,28 +2176,338 @@ class script:
         self._args = args
         self._env = env
     def __call__(self, code=''):
-        import subprocess
+        import errno, fcntl, select, subprocess
+        if isinstance(code, unicode):
+            code = code.encode('utf8')
+        s = None
+        kept = collections.deque()
         try:
-            s = None
             s = subprocess.Popen(self._args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT, shell=isinstance(self._args, str),
+                                 stderr=subprocess.PIPE, shell=isinstance(self._args, str),
                                  env=self._env)
-            s.stdin.write(code); s.stdin.close()
+            # stream --> [where its output goes, incomplete utf-8 sequence at its end]
+            streams = {s.stdout.fileno():[sys.stdout, ''], s.stderr.fileno():[sys.stderr, '']}
+            stdin = s.stdin.fileno()
+            fcntl.fcntl(stdin, fcntl.F_SETFL, fcntl.fcntl(stdin, fcntl.F_GETFL) | os.O_NONBLOCK)
+            pos = 0
+            size = 0
+            unflushed = False
+            while streams:
+                if pos >= len(code) and not s.stdin.closed:
+                    s.stdin.close()
+                try:
+                    r, w, _ = select.select(streams.keys(), [] if s.stdin.closed else [stdin], [],
+                                            SCRIPT_FLUSH_DELAY if unflushed else None)
+                except select.error as (err, msg):
+                    if err != errno.EINTR:
+                        raise
+                    continue
+                if not r and not w:
+                    # the command is quiet for now, so show what it wrote so far
+                    sys.stdout.flush(); sys.stderr.flush()
+                    unflushed = False
+                if w:
+                    try:
+                        pos += os.write(stdin, code[pos:pos+SCRIPT_CHUNK_SIZE])
+                    except OSError as err:
+                        if err.errno != errno.EPIPE:
+                            raise
+                        pos = len(code)   # the command does not read its input
+                for fd in r:
+                    # Only read a chunk after passing on the previous one, so that if the
+                    # output can't be sent as fast as it is made, the command waits.
+                    data = os.read(fd, SCRIPT_CHUNK_SIZE)
+                    stream = streams[fd]
+                    if data:
+                        data, stream[1] = _utf8_split(stream[1] + data)
+                    else:
+                        data = stream[1]
+                        del streams[fd]
+                    if data:
+                        kept.append(data)
+                        size += len(data)
+                        while size - len(kept[0]) >= SCRIPT_STDOUT_SIZE:
+                            size -= len(kept.popleft())
+                        stream[0].write(data)
+                        unflushed = True
         finally:
             if s is None:
                 return
             try:
-                self.stdout = s.stdout.read()
-                sys.stdout.write(self.stdout)
+                self.stdout = ''.join(kept)[-SCRIPT_STDOUT_SIZE:]
+                sys.stdout.flush(); sys.stderr.flush()
             finally:
                 try:
                     os.system("pkill -TERM -P %s"%s.pid)
                 except OSError:
                     pass
-               	try:
+                try:
                     os.kill(s.pid, 9)
                 except OSError:
                     pass
+                s.wait()
+
+def _utf8_split(s):
+    """
+    Split the string s into a prefix that does not end in the middle of a
+    UTF-8 encoded character, and the rest.
+    """
+    i = len(s) - 1
+    while i >= max(0, len(s) - 4) and 0x80 <= ord(s[i]) < 0xC0:
+        i -= 1
+    if i < 0:
+        return s, ''
+    c = ord(s[i])
+    n = 2 if 0xC0 <= c < 0xE0 else 3 if 0xE0 <= c < 0xF0 else 4 if c >= 0xF0 else 1
+    if len(s) - i < n:
+        return s[:i], s[i:]
+    return s, ''
+
+
+# Commands that run a program given as their next argument in an interpreter.
+KERNEL_COMMANDS = {'python3':['python3', '-E', '-u', '-c'], 'perl':['perl', '-e'], 'ruby':['ruby', '-e']}
+
+# Programs that turn an interpreter into a kernel: they read frames (a 4 byte
+# big endian length, then that much code) from file descriptor 3, evaluate
+# each in the same global state, and after each evaluation write the marker
+# given as first argument to stdout, followed by 1 (or 0 if there was an
+# error) and a newline.
+KERNEL_DRIVERS = {
+'python3' : r"""
+import os, struct, sys, traceback
+def smc_kernel(marker):
+    code_in = os.fdopen(3, 'rb')
+    namespace = {'__name__':'__main__'}
+    while True:
+        header = code_in.read(4)
+        if len(header) < 4:
+            return
+        code = code_in.read(struct.unpack('>L', header)[0]).decode('utf-8')
+        status = 1
+        try:
+            exec(compile(code, '<cell>', 'exec'), namespace)
+        except SystemExit:
+            raise
+        except BaseException:
+            etype, value, tb = sys.exc_info()
+            traceback.print_exception(etype, value, tb.tb_next)
+            status = 0
+        sys.stderr.flush()
+        sys.stdout.write('%s%s\n'%(marker, status))
+        sys.stdout.flush()
+smc_kernel(sys.argv[1])
+""",
+
+'perl' : r"""
+$| = 1;
+$SIG{INT} = sub { die "KeyboardInterrupt\n" };
+open(my $smc_in, '<&=', 3) or die "unable to open file descriptor 3: $!";
+binmode $smc_in;
+my $smc_marker = $ARGV[0];
+sub smc_read {
+    my $buf = '';
+    while (length($buf) < $_[0]) {
+        return undef unless read($smc_in, $buf, $_[0] - length($buf), length($buf));
+    }
+    return $buf;
+}
+while (defined(my $smc_header = smc_read(4))) {
+    my $smc_code = smc_read(unpack('N', $smc_header));
+    last unless defined $smc_code;
+    my $smc_status = 1;
+    eval "package main;\n#line 1 \"cell\"\n" . $smc_code;
+    if ($@) { print STDERR $@; $smc_status = 0; }
+    print "$smc_marker$smc_status\n";
+}
+""",
+
+'ruby' : r"""
+$stdout.sync = true
+$stderr.sync = true
+def smc_kernel(marker)
+  code_in = IO.new(3, 'rb')
+  while (header = code_in.read(4)) && header.bytesize == 4
+    code = code_in.read(header.unpack('N')[0]) || ''
+    status = 1
+    begin
+      eval(code.force_encoding('UTF-8'), TOPLEVEL_BINDING, 'cell', 1)
+    rescue SystemExit
+      raise
+    rescue Exception => e
+      $stderr.puts("#{e.class}: #{e.message}")
+      e.backtrace.each { |line| $stderr.puts("\tfrom #{line}") if line.start_with?('cell') }
+      status = 0
+    end
+    $stdout.write("#{marker}#{status}\n")
+  end
+end
+smc_kernel(ARGV[0])
+""",
+}
+
+def close_fds_on_exec(first):
+    """
+    Set the close-on-exec flag of the open file descriptors >= first; for
+    use in a preexec_fn of subprocess.Popen instead of os.closerange, which
+    would also close the pipe on which Popen learns that exec failed (e.g.,
+    since the program does not exist), so that it would not raise OSError.
+    """
+    import fcntl, subprocess
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = xrange(first, subprocess.MAXFD)
+    for fd in fds:
+        if fd >= first:
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            except (IOError, OSError):
+                pass   # e.g., the descriptor of the listed directory, which is closed now
+
+# How long to wait, in seconds, for an interrupted kernel to finish the
+# evaluation before killing it.
+KERNEL_INTERRUPT_TIMEOUT = 2
+
+class Kernel(object):
+    """
+    A long-lived interpreter for one of the languages in KERNEL_DRIVERS,
+    which evaluates code in the same global state, streaming the output to
+    the cell.  If the interpreter dies, it is restarted (with a fresh state)
+    on the next evaluation.  Use language_kernel(language) to get the kernel
+    of this session.
+    """
+    def __init__(self, language, env=None):
+        if language not in KERNEL_DRIVERS:
+            raise ValueError("no kernel for '%s'; the languages are %s"%(language, ', '.join(sorted(KERNEL_DRIVERS))))
+        self._language = language
+        self._env = env
+        self._process = None
+
+    def __repr__(self):
+        if self._running():
+            return "%s kernel (pid %s)"%(self._language, self._process.pid)
+        return "%s kernel (not running)"%self._language
+
+    def _running(self):
+        # a kernel started by another process (e.g., before %fork) is not ours to use
+        return (self._process is not None and self._pid == os.getpid()
+                and self._process.poll() is None)
+
+    def _start(self):
+        import subprocess
+        self._pid = os.getpid()
+        self._marker = 'smc-kernel-%s:'%uuid()
+        # fd 3 is open after this (if it was not, it is r), so Popen does not report a failed exec on it
+        r, w = os.pipe()
+        def setup():
+            os.dup2(r, 3)
+            close_fds_on_exec(4)
+        try:
+            self._process = subprocess.Popen(['sage-native-execute'] + KERNEL_COMMANDS[self._language] + [KERNEL_DRIVERS[self._language], self._marker],
+                                             stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                             env=self._env, preexec_fn=setup)
+        except:
+            os.close(w)
+            raise
+        finally:
+            os.close(r)
+        self._code = os.fdopen(w, 'wb')
+        self._buf = ''
+
+    def restart(self):
+        """
+        Kill the interpreter; a new one is started on the next evaluation.
+        """
+        if self._running():
+            try:
+                self._code.close()
+            except IOError:
+                pass
+            try:
+                os.kill(self._process.pid, 9)
+            except OSError:
+                pass
+            self._process.wait()
+        self._process = None
+
+    def _receive(self, timeout=None):
+        """
+        Write the output of the current evaluation to stdout until the
+        marker, and return True, or False if there was an error.  Return
+        None if timeout seconds pass first.  Raise EOFError if the
+        interpreter exits.
+        """
+        import select, time
+        fd = self._process.stdout.fileno()
+        m = len(self._marker)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            i = self._buf.find(self._marker)
+            if i != -1 and len(self._buf) >= i + m + 2:
+                self._write(self._buf[:i])
+                status = self._buf[i+m]
+                self._buf = self._buf[i+m+2:]
+                return status == '1'
+            if i == -1 and len(self._buf) >= m:
+                # all but a possible prefix of the marker is output
+                self._write(self._buf[:-m])
+                self._buf = self._buf[-m:]
+            if deadline is not None:
+                if not select.select([fd], [], [], max(0, deadline - time.time()))[0]:
+                    return None
+            data = os.read(fd, 65536)
+            if not data:
+                self._write(self._buf)
+                self._buf = ''
+                raise EOFError
+            self._buf += data
+
+    def _write(self, s):
+        if s:
+            self.stdout.append(s)
+            sys.stdout.write(s)
+
+    def __call__(self, code=''):
+        import signal, struct
+        if isinstance(code, unicode):
+            code = code.encode('utf8')
+        if not self._running():
+            self._start()
+        self.stdout = []
+        try:
+            try:
+                self._code.write(struct.pack('>L', len(code)) + code)
+                self._code.flush()
+                self._receive()
+            except KeyboardInterrupt:
+                try:
+                    self._process.send_signal(signal.SIGINT)
+                    if self._receive(KERNEL_INTERRUPT_TIMEOUT) is None:
+                        self.restart()
+                except (EOFError, IOError, OSError):
+                    self.restart()
+                raise
+        except (EOFError, IOError, OSError):
+            self.restart()
+            sys.stdout.flush()
+            sys.stderr.write("The %s kernel died; it will be restarted on the next evaluation.\n"%self._language)
+            sys.stderr.flush()
+        finally:
+            self.stdout = ''.join(self.stdout)
+            sys.stdout.flush()
+
+_language_kernels = {}
+
+def language_kernel(language):
+    """
+    Return the persistent kernel for language (python3, perl or ruby) of
+    this session, which %python3, %perl and %ruby use.  Use
+    language_kernel(language).restart() to start over with a fresh state.
+    """
+    if language not in _language_kernels:
+        _language_kernels[language] = Kernel(language)
+    return _language_kernels[language]
+
 
 def python(code):
     """
@@ -1701,7 +2520,7 @@ def python(code):
     """
     salvus.execute(code, preparse=False)
 
-def python3(code):
+def python3(code=None, persistent=True):
     """
     Block decorator to run code in a pure Python3 mode session.
 
@@ -1720,11 +2539,18 @@ def python3(code):
     Afterwards, p3 contains the output '{1, 2, 3}' and the variable x
     in the controlling Sage session is in no way impacted.
 
-    NOTE: No state is preserved between calls.  Each call is a separate process.
+    NOTE: The code is evaluated in a Python3 kernel that keeps running
+    between calls, so state is preserved (see language_kernel).  Use
+    %python3(persistent=False) to evaluate it in a new process instead.
     """
-    script('sage-native-execute python3 -E')(code)
+    if code is None:
+        return lambda code: python3(code, persistent=persistent)
+    if persistent:
+        language_kernel('python3')(code)
+    else:
+        script('sage-native-execute python3 -E')(code)
 
-def perl(code):
+def perl(code=None, persistent=True):
     """
     Block decorator to run code in a Perl session.
 
@@ -1753,12 +2579,20 @@ def perl(code):
 
     Afterwards, p contains 'hi'.
 
-    NOTE: No state is preserved between calls.  Each call is a separate process.
+    NOTE: The code is evaluated in a Perl kernel that keeps running
+    between calls, so global variables (but not those declared with my)
+    are preserved (see language_kernel).  Use
+    %perl(persistent=False) to evaluate it in a new process instead.
     """
-    script('sage-native-execute perl')(code)
+    if code is None:
+        return lambda code: perl(code, persistent=persistent)
+    if persistent:
+        language_kernel('perl')(code)
+    else:
+        script('sage-native-execute perl')(code)
 
 
-def ruby(code):
+def ruby(code=None, persistent=True):
     """
     Block decorator to run code in a Ruby session.
 
@@ -1786,14 +2620,23 @@ def ruby(code):
 
     Afterwards, p contains 'Hello from ruby!'.
 
-    NOTE: No state is preserved between calls.  Each call is a separate process.
+    NOTE: The code is evaluated in a Ruby kernel that keeps running
+    between calls, so state is preserved (see language_kernel).  Use
+    %ruby(persistent=False) to evaluate it in a new process instead.
     """
-    script('sage-native-execute ruby')(code)
+    if code is None:
+        return lambda code: ruby(code, persistent=persistent)
+    if persistent:
+        language_kernel('ruby')(code)
+    else:
+        script('sage-native-execute ruby')(code)
 
 
 def fortran(x, library_paths=[], libraries=[], verbose=False):
     """
-    Compile Fortran code and make it available to use.
+    Compile Fortran code and make it available to use.  The compiled code
+    is cached in salvus.artifact_cache, so evaluating the same code again
+    (in any session of the project) just loads it.
 
     INPUT:
 
@@ -1832,7 +2675,6 @@ def fortran(x, library_paths=[], libraries=[], verbose=False):
 
     This will produce this output: array([  0.,   1.,   1.,   2.,   3.,   5.,   8.,  13.,  21.,  34.])
     """
-    import __builtin__
     from sage.misc.temporary_file import tmp_dir
     if len(x.splitlines()) == 1 and os.path.exists(x):
         filename = x
@@ -1840,69 +2682,69 @@ def fortran(x, library_paths=[], libraries=[], verbose=False):
         if filename.lower().endswith('.f90'):
             x = '!f90\n' + x
 
-    from numpy import f2py
-    from random import randint
-
-    # Create everything in a temporary directory
-    mytmpdir = tmp_dir()
+    def build(key, target):
+        from numpy import f2py
+        import shutil
 
-    try:
-        old_cwd = os.getcwd()
-        os.chdir(mytmpdir)
+        # Create everything in a temporary directory
+        mytmpdir = tmp_dir()
 
-        old_import_path = os.sys.path
-        os.sys.path.append(mytmpdir)
+        try:
+            old_cwd = os.getcwd()
+            os.chdir(mytmpdir)
+
+            name = "fortran_module_%s"%key[:20]  # Python module name
+            # if the first line has !f90 as a comment, gfortran will
+            # treat it as Fortran 90 code
+            if x.startswith('!f90'):
+                fortran_file = name + '.f90'
+            else:
+                fortran_file = name + '.f'
+
+            s_lib_path = ""
+            s_lib = ""
+            for s in library_paths:
+                s_lib_path = s_lib_path + "-L%s "%s
+
+            for s in libraries:
+                s_lib = s_lib + "-l%s "%s
+
+            log = name + ".log"
+            extra_args = '--quiet --f77exec=sage-inline-fortran --f90exec=sage-inline-fortran %s %s >"%s" 2>&1'%(
+                s_lib_path, s_lib, log)
+
+            f2py.compile(x, name, extra_args = extra_args, source_fn=fortran_file)
+            log_string = open(log).read()
+
+            # f2py.compile() doesn't raise any exception if it fails.
+            # So we manually check whether the compiled file exists.
+            # NOTE: the .so extension is used expect on Cygwin,
+            # that is even on OS X where .dylib might be expected.
+            soname = name
+            uname = os.uname()[0].lower()
+            if uname[:6] == "cygwin":
+                soname += '.dll'
+            else:
+                soname += '.so'
+            if not os.path.isfile(soname):
+                raise RuntimeError("failed to compile Fortran code:\n" + log_string)
 
-        name = "fortran_module_%s"%randint(0,2**64)  # Python module name
-        # if the first line has !f90 as a comment, gfortran will
-        # treat it as Fortran 90 code
-        if x.startswith('!f90'):
-            fortran_file = name + '.f90'
-        else:
-            fortran_file = name + '.f'
-
-        s_lib_path = ""
-        s_lib = ""
-        for s in library_paths:
-            s_lib_path = s_lib_path + "-L%s "
-
-        for s in libraries:
-            s_lib = s_lib + "-l%s "%s
-
-        log = name + ".log"
-        extra_args = '--quiet --f77exec=sage-inline-fortran --f90exec=sage-inline-fortran %s %s >"%s" 2>&1'%(
-            s_lib_path, s_lib, log)
-
-        f2py.compile(x, name, extra_args = extra_args, source_fn=fortran_file)
-        log_string = open(log).read()
-
-        # f2py.compile() doesn't raise any exception if it fails.
-        # So we manually check whether the compiled file exists.
-        # NOTE: the .so extension is used expect on Cygwin,
-        # that is even on OS X where .dylib might be expected.
-        soname = name
-        uname = os.uname()[0].lower()
-        if uname[:6] == "cygwin":
-            soname += '.dll'
-        else:
-            soname += '.so'
-        if not os.path.isfile(soname):
-            raise RuntimeError("failed to compile Fortran code:\n" + log_string)
+            if verbose:
+                print log_string
 
-        if verbose:
-            print log_string
+            shutil.copy(soname, target)
+            open(os.path.join(target, 'module'), 'w').write(soname)
 
-        m = __builtin__.__import__(name)
+        finally:
+            os.chdir(old_cwd)
+            try:
+                shutil.rmtree(mytmpdir)
+            except OSError:
+                # This can fail for example over NFS
+                pass
 
-    finally:
-        os.sys.path = old_import_path
-        os.chdir(old_cwd)
-        try:
-            import shutil
-            shutil.rmtree(mytmpdir)
-        except OSError:
-            # This can fail for example over NFS
-            pass
+    cache = salvus.artifact_cache
+    m = cache.load(cache.lookup('fortran', x, build, library_paths=list(library_paths), libraries=list(libraries)))
 
     for k, x in m.__dict__.iteritems():
         if k[0] != '_':
@@ -1993,6 +2835,217 @@ def r_eval(code, *args, **kwds):
 sage.interfaces.r.r.eval = r_eval
 sage.interfaces.r.r.set_plot_options = set_r_plot_options
 
+# Bulk transfer of vectors and data frames to and from R.  Only a short
+# command goes through the pexpect session; the columns go through binary
+# temporary files, which R reads and writes with readBin and writeBin.
+
+# NA entries are transferred as a mask: a file of 32-bit integers next to the
+# column's file, which are 1 for NA entries and 0 otherwise.  In Python, a
+# column with NA entries is a numpy.ma.MaskedArray.  (NaN is not NA.)
+
+# R function that writes the names of the list x to the file prefix+'names'
+# and its i-th entry to the file prefix+i (and its NA mask, if any, to
+# prefix+i+'na'), and prints their types, with '/na' appended if there is a
+# mask (on one line, since the pexpect interface sends R one line at a time).
+_R_WRITE_COLUMNS = ' '.join([line.strip() for line in """function(x, prefix) {
+    writeBin(enc2utf8(if (is.null(names(x))) rep('', length(x)) else names(x)), paste0(prefix, 'names'));
+    types <- character(length(x));
+    for (i in seq_along(x)) {
+        v <- x[[i]]; f <- paste0(prefix, i);
+        if (is.logical(v)) { types[i] <- 'logical'; writeBin(as.integer(v), f, size=4, endian='little') }
+        else if (is.integer(v) && !is.factor(v)) { types[i] <- 'integer'; writeBin(v, f, size=4, endian='little') }
+        else if (is.numeric(v)) { types[i] <- 'double'; writeBin(as.double(v), f, size=8, endian='little') }
+        else { types[i] <- 'character'; writeBin(enc2utf8(as.character(v)), f) };
+        na <- if (is.double(v)) is.na(v) & !is.nan(v) else is.na(v);
+        if (any(na)) { types[i] <- paste0(types[i], '/na'); writeBin(as.integer(na), paste0(f, 'na'), size=4, endian='little') }
+    };
+    cat(types)
+}""".splitlines()])
+
+def _r_column(x):
+    """
+    Return the vector x as a one dimensional numpy array that is not of
+    object dtype (unless it consists of strings), and the mask of its NA
+    entries, which are the masked entries of a masked array and None, or
+    numpy.ma.nomask.  Raise TypeError if x has entries other than strings,
+    booleans, numbers (e.g., Sage integers) and None, rather than
+    transferring them as strings.
+    """
+    import numbers, numpy
+    mask = numpy.ma.getmask(x)
+    if isinstance(x, numpy.ndarray):
+        x = numpy.ma.getdata(x)
+    else:
+        x = numpy.array(x, dtype=object)   # so mixed entries are not converted to strings
+    if x.ndim != 1:
+        raise ValueError("columns must be one dimensional")
+    if x.dtype.kind == 'O':
+        na = numpy.array([v is None for v in x], dtype=bool)
+        values = [v for v in x if v is not None]
+        if all(isinstance(v, basestring) for v in values):
+            dtype, fill = object, ''
+        elif all(isinstance(v, (bool, numpy.bool_)) for v in values):
+            dtype, fill = bool, False
+        elif all(isinstance(v, numbers.Integral) for v in values):
+            dtype, fill = 'i8', 0
+        elif all(isinstance(v, numbers.Real) for v in values):
+            dtype, fill = 'f8', 0
+        else:
+            raise TypeError("unable to transfer a column with entries of type %s to R"%(
+                ', '.join(sorted(set(type(v).__name__ for v in values)))))
+        values = [fill if v is None else v for v in x]
+        try:
+            x = numpy.array(values, dtype=dtype)
+        except OverflowError:   # integers that do not fit in 64 bits
+            x = numpy.array(values, dtype='f8')
+        if na.any():
+            mask = na if mask is numpy.ma.nomask else (mask | na)
+    return x, mask
+
+def _r_write_column(filename, x):
+    """
+    Write the vector x (and the mask of its NA entries, if any; see
+    _r_column) to filename in binary and return R code that reads it back.
+    """
+    import numpy
+    x, mask = _r_column(x)
+    n = len(x)
+    if x.dtype.kind == 'b':
+        x.astype('<i4').tofile(filename)
+        code = "as.logical(readBin('%s', 'integer', n=%s, size=4, endian='little'))"%(filename, n)
+    elif x.dtype.kind in 'iu' and (n == 0 or (x.min() > -2**31 and x.max() < 2**31)):
+        x.astype('<i4').tofile(filename)
+        code = "readBin('%s', 'integer', n=%s, size=4, endian='little')"%(filename, n)
+    elif x.dtype.kind in 'iuf':
+        x.astype('<f8').tofile(filename)
+        code = "readBin('%s', 'double', n=%s, size=8, endian='little')"%(filename, n)
+    elif x.dtype.kind in 'SUO':
+        open(filename, 'wb').write(''.join([(s.encode('utf8') if isinstance(s, unicode) else str(s)) + '\0' for s in x]))
+        code = "(function(v) { Encoding(v) <- 'UTF-8'; v })(readBin('%s', 'character', n=%s))"%(filename, n)
+    else:
+        raise TypeError("unable to transfer a column of dtype %s to R"%x.dtype)
+    if mask is not numpy.ma.nomask and mask.any():
+        mask.astype('<i4').tofile(filename + 'na')
+        code = "(function(v) { v[readBin('%sna', 'integer', n=%s, size=4, endian='little') != 0] <- NA; v })(%s)"%(filename, n, code)
+    return code
+
+def _r_read_columns(var):
+    """
+    Return the names and the columns of the R list (or data frame) var,
+    as numpy arrays, or masked arrays if they have NA entries.
+    """
+    import numpy, shutil, tempfile
+    tmp = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmp, '')
+        types = r_eval0("(%s)(%s, '%s')"%(_R_WRITE_COLUMNS, var, prefix)).split()
+        def strings(filename):
+            return [s.decode('utf8') for s in open(filename, 'rb').read().split('\0')[:-1]]
+        columns = []
+        for i, t in enumerate(types):
+            filename = prefix + str(i+1)
+            t, _, na = t.partition('/')
+            if t == 'double':
+                columns.append(numpy.fromfile(filename, dtype='<f8'))
+            elif t == 'integer':
+                columns.append(numpy.fromfile(filename, dtype='<i4'))
+            elif t == 'logical':
+                columns.append(numpy.fromfile(filename, dtype='<i4') != 0)
+            else:
+                columns.append(numpy.array(strings(filename), dtype=object))
+            if na:
+                columns[-1] = numpy.ma.masked_array(columns[-1], mask=numpy.fromfile(filename + 'na', dtype='<i4') != 0)
+        return strings(prefix + 'names'), columns
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def _r_set(var, make, columns):
+    import shutil, tempfile
+    tmp = tempfile.mkdtemp()
+    try:
+        code = [_r_write_column(os.path.join(tmp, str(i)), x) for i, x in enumerate(columns)]
+        r_eval0("%s <- %s"%(var, make%', '.join(code)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def r_set_vector(var, v):
+    """
+    Set the R variable var to a vector with the entries of v (e.g., a
+    list or numpy array of numbers, booleans or strings), transferring
+    them in binary.  Integers that fit in 32 bits become an integer
+    vector, other numbers a double vector.  None and the masked entries
+    of a numpy.ma.MaskedArray become NA.  Other objects raise TypeError.
+
+    EXAMPLES::
+
+        sage: r.set_vector('x', [1.5, 2, 3])
+        sage: r.eval('sum(x)')
+        '[1] 6.5'
+    """
+    _r_set(var, '%s', [v])
+
+def r_get_vector(var):
+    """
+    Return a numpy array with the entries of the R vector var,
+    transferred in binary.  Factors become arrays of strings.  If the
+    vector has NA entries, a numpy.ma.MaskedArray is returned, in which
+    they are masked (NaN is not NA).
+
+    EXAMPLES::
+
+        sage: r.eval('x <- c(1.5, 2, 3)')
+        sage: r.get_vector('x')
+        array([ 1.5,  2. ,  3. ])
+    """
+    return _r_read_columns('list(%s)'%var)[1][0]
+
+def r_set_data_frame(var, columns):
+    """
+    Set the R variable var to a data frame with the given columns,
+    transferring them in binary.  The columns are a dictionary (e.g.,
+    an OrderedDict), a list of pairs (name, column), or a pandas
+    DataFrame; each column is converted as by r.set_vector.
+
+    EXAMPLES::
+
+        sage: r.set_data_frame('d', [('n', [1,2,3]), ('x', [.5,.25,.125]), ('s', ['a','b','c'])])
+        sage: r.eval('d$x[d$s == "b"]')
+        '[1] 0.25'
+    """
+    import json
+    if hasattr(columns, 'columns'):
+        columns = [(name, columns[name].values) for name in columns.columns]
+    elif hasattr(columns, 'items'):
+        columns = columns.items()
+    names = [name for name, _ in columns]
+    columns = [x for _, x in columns]
+    rows = set(len(x) for x in columns)
+    if len(rows) > 1:
+        raise ValueError("all columns must have the same length")
+    rows = rows.pop() if rows else 0
+    _r_set(var, "structure(list(%%s), names=c(%s), class='data.frame', row.names=c(NA, -%sL))"%(
+        ', '.join([json.dumps(name) for name in names]).replace('%', '%%'), rows), columns)
+
+def r_get_data_frame(var):
+    """
+    Return an OrderedDict mapping the names of the columns of the R data
+    frame var to numpy arrays with their entries, transferred in binary
+    and converted as by r.get_vector.
+
+    EXAMPLES::
+
+        sage: r.eval('d <- data.frame(n=1:3, s=c("a","b","c"))')
+        sage: r.get_data_frame('d')
+        OrderedDict([(u'n', array([1, 2, 3], dtype=int32)), (u's', array([u'a', u'b', u'c'], dtype=object))])
+    """
+    names, columns = _r_read_columns('as.list(%s)'%var)
+    return collections.OrderedDict(zip(names, columns))
+
+sage.interfaces.r.r.set_vector = r_set_vector
+sage.interfaces.r.r.get_vector = r_get_vector
+sage.interfaces.r.r.set_data_frame = r_set_data_frame
+sage.interfaces.r.r.get_data_frame = r_get_data_frame
+
 
 def prun(code):
     """
@@ -2043,46 +3096,19 @@ def prun(code):
 # The %fork cell decorator.
 ##############################################################
 
-def _wait_in_thread(pid, callback, filename):
-    from sage.structure.sage_object import load
-    def wait():
-        try:
-            os.waitpid(pid,0)
-            callback(load(filename))
-        except Exception, msg:
-        	callback(msg)
-
-    from threading import Thread
-    t = Thread(target=wait, args=tuple([]))
-    t.start()
-
 def async(f, args, kwds, callback):
     """
     Run f in a forked subprocess with given args and kwds, then call the
-    callback function when f terminates.
+    callback function with its result (or the error message, if it failed)
+    when f terminates.  Return the pid of the subprocess.
+
+    At most salvus.fork_engine.workers() subprocesses (by default, the
+    number of cpus of the project) run at once; if that many are running,
+    this waits until one of them terminates.
     """
-    from sage.misc.all import tmp_filename
-    filename = tmp_filename() + '.sobj'
-    sys.stdout.flush()
-    sys.stderr.flush()
-    pid = os.fork()
-    if pid:
-        # The parent master process
-        try:
-            _wait_in_thread(pid, callback, filename)
-            return pid
-        finally:
-            if os.path.exists(filename):
-                os.unlink(filename)
-    else:
-        # The child process
-        try:
-            result = f(*args, **kwds)
-        except Exception, msg:
-            result = str(msg)
-        from sage.structure.sage_object import save
-        save(result, filename)
-        os._exit(0)
+    def done(result, error):
+        callback(result if error is None else error)
+    return salvus.fork_engine.start(f, done, args, kwds)
 
 
 class Fork(object):
@@ -2101,7 +3127,12 @@ class Fork(object):
     subprocess are set in the parent when the forked subprocess
     terminates.  However, the forked subprocess has no other side
     effects, except what it might do to file handles and the
-    filesystem.
+    filesystem.  Its output appears in the cell while it runs.
+
+    Several %fork cells run side by side, each setting its variables
+    when it terminates, but at most as many as the project has cpus
+    (see salvus.fork_engine); evaluating another %fork cell waits
+    until one of them terminates.
 
     To see currently running forked subprocesses, type
     fork.children(), which returns a dictionary {pid:execute_uuid}.
@@ -2148,37 +3179,41 @@ class Fork(object):
             salvus.namespace.on('change', None, change)
             salvus.execute(s)
             result = {}
-            from sage.structure.sage_object import dumps
+            import cPickle
             for var in changed_vars:
                 try:
-                    result[var] = dumps(salvus.namespace[var])
+                    result[var] = cPickle.dumps(salvus.namespace[var], cPickle.HIGHEST_PROTOCOL)
                 except:
-                    result[var] = 'unable to pickle %s'%var
+                    result[var] = None
             return result
 
-
-        from sage.structure.sage_object import loads
-        def g(s):
-            if isinstance(s, Exception):
-                sys.stderr.write(str(s))
+        def g(result, error):
+            with registered:   # until pid is set below
+                if pid not in self._children:
+                    return  # killed
+            import cPickle
+            if error is not None:
+                sys.stderr.write(error)
                 sys.stderr.flush()
             else:
-                for var, val in s.iteritems():
+                for var, val in result.iteritems():
                     try:
-                        salvus.namespace[var] = loads(val)
+                        salvus.namespace[var] = cPickle.loads(val)
                     except:
-                        print "unable to unpickle %s"%var
-            salvus._conn.send_json({'event':'output', 'id':id, 'done':True})
-            if pid in self._children:
-                del self._children[pid]
-
-        pid = async(f, tuple([]), {}, g)
+                        print "unable to pickle %s"%var if val is None else "unable to unpickle %s"%var
+            salvus._send_message({'event':'output', 'id':id, 'done':True})
+            self._children.pop(pid, None)
+
+        import threading
+        registered = threading.Lock()
+        with registered:
+            pid = salvus.fork_engine.start(f, g, salvus=salvus)
+            self._children[pid] = id
         print "Forked subprocess %s"%pid
-        self._children[pid] = id
 
     def kill(self, pid):
         if pid in self._children:
-            salvus._conn.send_json({'event':'output', 'id':self._children[pid], 'done':True})
+            salvus._send_message({'event':'output', 'id':self._children[pid], 'done':True})
             os.kill(pid, 9)
             del self._children[pid]
         else:
@@ -2187,13 +3222,136 @@ class Fork(object):
 fork = Fork()
 
 
+##############################################################
+# Parallel map over forked workers.
+##############################################################
+
+# parallel_map shows how far it got at most this often, in seconds.
+PARALLEL_MAP_PROGRESS_INTERVAL = 2
+
+def parallel_map(f=None, iterable=None, workers=None, chunksize=None, progress=True, **values):
+    """
+    Return [f(x) for x in iterable], computing the values in forked
+    copies of this session, several at once.
+
+    The items are split into chunks of chunksize items (by default,
+    about four chunks per worker), each of which is mapped by a new
+    forked subprocess; at most workers of them run at once (by default,
+    and in any case at most, salvus.fork_engine.workers(), i.e., the
+    number of cpus of the project).  The forked subprocesses get the
+    items and f from the memory of the session, so neither needs to be
+    picklable, but the values of f must be.  Output of f appears in
+    the cell as it runs.  If progress is True, how many items are done
+    is shown every few seconds.  If f raises an exception, the other
+    subprocesses are killed and a RuntimeError is raised.  For example::
+
+        v = parallel_map(lambda n: factor(2^n - 1), [100..200])
+
+    Use parallel_map as a block decorator to evaluate the rest of the
+    cell for each value of a variable, e.g.,
+
+        %parallel_map(n=[100..200])
+        print n, is_prime(2^n - 1)
+
+    The printed output of the evaluations is shown in the order of the
+    values, each as soon as it and those before it are done.
+    """
+    if f is None and iterable is None and len(values) == 1:
+        var, iterable = values.items()[0]
+        def block(code):
+            def run(value):
+                salvus.namespace[var] = value
+                out = []
+                sys.stdout._f = lambda buf, done: out.append(('stdout', buf))
+                sys.stderr._f = lambda buf, done: out.append(('stderr', buf))
+                salvus.execute(code)
+                sys.stdout.flush(); sys.stderr.flush()
+                return out
+            def show(out):
+                for stream, buf in out:
+                    getattr(sys, stream).write(buf)
+                sys.stdout.flush(); sys.stderr.flush()
+            _parallel_map(run, list(iterable), workers, chunksize, progress, show)
+        return block
+    if not callable(f) or iterable is None or values:
+        raise TypeError("use parallel_map(f, iterable) or the block decorator %parallel_map(var=iterable)")
+    return _parallel_map(f, list(iterable), workers, chunksize, progress)
+
+def _parallel_map(f, v, workers, chunksize, progress, show=None):
+    """
+    Map f over the list v as described in parallel_map, calling show
+    with each value in order as soon as it and those before it are done.
+    """
+    import math, Queue, time
+    engine = salvus.fork_engine
+    workers = max(1, min(workers or engine.workers(), engine.workers()))
+    if chunksize is None:
+        chunksize = int(math.ceil(len(v) / (4.0 * workers)))
+    chunksize = max(1, int(chunksize))
+    starts = range(0, len(v), chunksize)
+    chunks = [None] * len(starts)
+    finished = Queue.Queue()
+    running = {}    # chunk index --> pid
+    state = {'shown':0, 'done':0, 'time':time.time()}
+
+    def run(i):
+        return [f(x) for x in v[starts[i]:starts[i]+chunksize]]
+
+    def wait():
+        while True:
+            try:
+                i, result, error = finished.get(timeout=1)   # with a timeout, so it can be interrupted
+                break
+            except Queue.Empty:
+                pass
+        del running[i]
+        if error is not None:
+            raise RuntimeError("parallel_map: %s"%error)
+        chunks[i] = result
+        state['done'] += len(result)
+        if show is not None:
+            while state['shown'] < len(chunks) and chunks[state['shown']] is not None:
+                for x in chunks[state['shown']]:
+                    show(x)
+                state['shown'] += 1
+        if progress and time.time() - state['time'] >= PARALLEL_MAP_PROGRESS_INTERVAL:
+            state['time'] = time.time()
+            print "parallel_map: %s of %s done"%(state['done'], len(v))
+            sys.stdout.flush()
+
+    try:
+        for i in range(len(starts)):
+            while len(running) >= workers:
+                wait()
+            running[i] = engine.start(run, lambda result, error, i=i: finished.put((i, result, error)),
+                                      args=(i,), salvus=salvus)
+        while running:
+            wait()
+    finally:
+        for pid in running.values():
+            try:
+                os.kill(pid, 9)
+            except OSError:
+                pass
+    return [x for chunk in chunks for x in chunk]
+
+
 ####################################################
 # Display of 2d/3d graphics objects
 ####################################################
 
 from sage.misc.all import tmp_filename
 from sage.plot.animate import Animation
-import matplotlib.figure
+
+def _matplotlib_types():
+    """
+    Return the types of the matplotlib objects that show displays, or () if
+    matplotlib was not imported yet, so that there are none.
+    """
+    if sys.modules.get('matplotlib.figure') is None:
+        return ()
+    import matplotlib.axes, matplotlib.figure, matplotlib.image
+    return (matplotlib.figure.Figure, matplotlib.axes.Axes, matplotlib.image.AxesImage)
 
 def show_animation(obj, delay=20, gif=False, **kwds):
     if gif:
@@ -2207,6 +3365,7 @@ def show_animation(obj, delay=20, gif=False, **kwds):
         salvus.file(t, raw=True)   # and let delete when worksheet ends - need this so can replay video.
 
 def show_2d_plot_using_matplotlib(obj, svg, **kwds):
+    import matplotlib.axes, matplotlib.figure, matplotlib.image
     if isinstance(obj, matplotlib.image.AxesImage):
         # The result of imshow, e.g.,
         #
@@ -2391,7 +3550,7 @@ def show(*objs, **kwds):
     def show0(obj, combine_all=False):
         # Either show the object and return None or
         # return a string of html to represent obj.
-        if isinstance(obj, (Graphics, GraphicsArray, matplotlib.figure.Figure, matplotlib.axes.Axes, matplotlib.image.AxesImage)):
+        if isinstance(obj, (Graphics, GraphicsArray) + _matplotlib_types()):
             show_2d_plot_using_matplotlib(obj, svg=svg, **kwds)
         elif isinstance(obj, Animation):
             show_animation(obj, **kwds)
@@ -3239,8 +4398,52 @@ def load(*args, **kwds):
 # add alias, due to IPython.
 runfile = load
 
+class ImportHooks(object):
+    """
+    Finder on sys.meta_path that calls functions with a module right after it
+    is imported; see when_imported.
+    """
+    def __init__(self):
+        self.hooks = {}          # module name --> functions to call with the module
+        self._importing = set()  # names of the modules being imported by load_module
+
+    def add(self, name, hook):
+        module = sys.modules.get(name)
+        if module is not None:
+            hook(module)
+            return
+        self.hooks.setdefault(name, []).append(hook)
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def find_module(self, name, path=None):
+        if name in self.hooks and name not in self._importing:
+            return self
+
+    def load_module(self, name):
+        # import the module as usual (this finder declines while doing so), then call the hooks
+        import importlib
+        self._importing.add(name)
+        try:
+            module = importlib.import_module(name)
+        finally:
+            self._importing.discard(name)
+        for hook in self.hooks.pop(name, []):
+            hook(module)
+        return module
+
+import_hooks = ImportHooks()
+
+def when_imported(name, hook):
+    """
+    Call hook(module) once the module with the given (full) name is imported,
+    or right away if it is already imported.  This is used to adapt, e.g.,
+    matplotlib to worksheets without importing it before a worksheet uses it
+    (see sage_server.LAZY_IMPORTS).
+    """
+    import_hooks.add(name, hook)
+
 ## Make it so pylab (matplotlib) figures display, at least using pylab.show
-import pylab
 def _show_pylab(svg=True):
     """
     Show a Pylab plot in a Sage Worksheet.
@@ -3249,6 +4452,7 @@ def _show_pylab(svg=True):
 
        - svg -- boolean (default: True); if True use an svg; otherwise, use a png.
     """
+    import pylab
     try:
         ext = '.svg' if svg else '.png'
         filename = uuid() + ext
@@ -3260,10 +4464,6 @@ def _show_pylab(svg=True):
         except:
             pass
 
-pylab.show = _show_pylab
-matplotlib.figure.Figure.show = show
-
-import matplotlib.pyplot
 def _show_pyplot(svg=True):
     """
     Show a Pylab plot in a Sage Worksheet.
@@ -3272,6 +4472,7 @@ def _show_pyplot(svg=True):
 
        - svg -- boolean (default: True); if True use an svg; otherwise, use a png.
     """
+    import matplotlib.pyplot
     try:
         ext = '.svg' if svg else '.png'
         filename = uuid() + ext
@@ -3282,7 +4483,13 @@ def _show_pyplot(svg=True):
             os.unlink(filename)
         except:
             pass
-matplotlib.pyplot.show = _show_pyplot
+
+def _set_show(obj, f):
+    obj.show = f
+
+when_imported('pylab', lambda pylab: _set_show(pylab, _show_pylab))
+when_imported('matplotlib.pyplot', lambda pyplot: _set_show(pyplot, _show_pyplot))
+when_imported('matplotlib.figure', lambda figure: _set_show(figure.Figure, show))
 
 
 ## Our own displayhook
@@ -3290,7 +4497,7 @@ matplotlib.pyplot.show = _show_pyplot
 _system_sys_displayhook = sys.displayhook
 
 def displayhook(obj):
-    if isinstance(obj, (Graphics3d, Graphics, GraphicsArray, matplotlib.figure.Figure, matplotlib.axes.Axes, matplotlib.image.AxesImage, Animation)):
+    if isinstance(obj, (Graphics3d, Graphics, GraphicsArray, Animation) + _matplotlib_types()):
         show(obj)
     else:
         _system_sys_displayhook(obj)
@@ -30,9 +30,6 @@ For debugging, this may help:
 # can import other files from there.
 import os, sys, time
 
-# used for clearing pylab figure
-pylab = None
-
 # Maximum number of distinct (non-once) output messages per cell; when this number is
 # exceeded, an exception is raised; this reduces the chances of the user creating
 # a huge unusable worksheet.
@@ -43,13 +40,77 @@ MAX_STDOUT_SIZE = MAX_STDERR_SIZE = MAX_CODE_SIZE = MAX_HTML_SIZE = MAX_MD_SIZE
 
 MAX_OUTPUT = 150000
 
+# If True, a cell whose output exceeds the limits above is not terminated: the rest of its
+# stdout and stderr is written to a log file on disk (see OutputSpool), and the cell only
+# shows a short summary with a handle, from which any part of the log can be read with
+# salvus.output_page.  (Other output beyond the limits is dropped.)
+OUTPUT_SPOOL = False
+
+# Consecutive stdout, stderr or html output of a cell that is produced within this many
+# seconds is merged into a single output message, which is at most OUTPUT_COALESCE_SIZE
+# characters long (and never longer than the MAX_*_SIZE limits above).  Set the window
+# to 0 to send every piece of output right away.
+OUTPUT_COALESCE_WINDOW = .05
+OUTPUT_COALESCE_SIZE = 32768
+
+import __builtin__
+
+class ImportProfiler(object):
+    """
+    Record the time it takes to import each module, including the modules it
+    imports in turn, between start() and stop(), or within a with statement.
+    """
+    def __init__(self):
+        self.times = {}  # module name --> seconds
+        self.total = 0.0
+
+    def start(self):
+        self._start = time.time()
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+        return self
+
+    def stop(self):
+        __builtin__.__import__ = self._import
+        self.total += time.time() - self._start
+
+    __enter__ = start
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        n = len(sys.modules)
+        t = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            # only record imports that actually loaded a module, and the outermost one if
+            # importing name imports name again (which then loads other modules)
+            if len(sys.modules) != n:
+                if not name:
+                    name = "from . import %s"%', '.join(fromlist or ())
+                self.times[name] = max(self.times.get(name, 0), time.time() - t)
+
+    def report(self):
+        """
+        Return the recorded times as text, one line per module, slowest first,
+        after the total time.
+        """
+        v = sorted(self.times.iteritems(), key=lambda x: -x[1])
+        return ''.join(["%10.4f  %s\n"%(t, name) for name, t in [('(total)', self.total)] + v])
+
+# When this file runs as the server, the imports from here on until the library is
+# initialized (see serve) are timed; the times are written to IMPORT_PROFILE if it is set.
+_import_profiler = ImportProfiler().start() if __name__ == '__main__' else None
+
 # We import the notebook interact, which we will monkey patch below,
 # first, since importing later causes trouble in sage>=5.6.
 import sagenb.notebook.interact
 
 # Standard imports.
-import json, resource, shutil, signal, socket, struct, \
-       tempfile, time, traceback, pwd
+import _multiprocessing, atexit, collections, cPickle, errno, fcntl, gc, importlib, io, json, logging, math, \
+       multiprocessing, resource, select, shutil, signal, socket, struct, tempfile, thread, threading, time, traceback, types, pwd
 
 import sage_parsing, sage_salvus
 
@@ -66,18 +127,122 @@ def unicode8(s):
         except:
              return s
 
-LOGFILE = os.path.realpath(__file__)[:-3] + ".log"
+LOGFILE = os.path.splitext(os.path.realpath(__file__))[0] + ".log"
 PID = os.getpid()
 from datetime import datetime
-def log(*args):
-    #print "logging to %s"%LOGFILE
+
+# Log messages are kept in a ring buffer of this many entries, which a background
+# thread writes to LOGFILE at most every LOG_FLUSH_INTERVAL seconds.  If messages
+# are logged faster than they can be written, the oldest ones are dropped.
+LOG_BUFFER_SIZE    = 10000
+LOG_FLUSH_INTERVAL = .1
+
+class Logger(object):
+    """
+    Level-filtered logger that writes to LOGFILE from a background thread.
+
+    Logging a message only appends it to an in-memory ring buffer, so it
+    costs almost nothing, and a message below the level costs even less.
+    The server forks a child for each session; the child notices that its
+    pid changed and starts its own writer thread, leaving the messages
+    buffered before the fork to the parent.  No locks are taken when logging,
+    since a lock held by some thread at the moment of a fork would stay
+    locked forever in the child.
+
+    If quiet is True, the contents of the messages sent to the hub are not
+    logged.  This can be set per session, e.g., in a worksheet::
+
+        sage_server.logger.quiet = True
+    """
+    def __init__(self, level=logging.DEBUG, quiet=False):
+        self.level = level
+        self.quiet = quiet
+        self.dropped = 0
+        self._pid = None
+
+    def _start(self):
+        # (re)initialize in a new process, discarding anything inherited from the parent
+        self._pid = os.getpid()
+        self._buffer = collections.deque(maxlen=LOG_BUFFER_SIZE)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._fd = None
+        self._path = None
+        self._thread = threading.Thread(target=self._run, name='sage_server log writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, level, args):
+        if level < self.level:
+            return
+        pid = os.getpid()
+        if pid != self._pid:
+            self._start()
+        buf = self._buffer
+        if len(buf) == LOG_BUFFER_SIZE:
+            self.dropped += 1
+        # strings are immutable, so only other objects have to be converted right now
+        buf.append((pid, time.time(), [x if isinstance(x, basestring) else unicode8(x) for x in args]))
+        # The writer clears the event before it takes the buffered messages, so a message
+        # appended while the event is set is written, and otherwise the event is set here.
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            time.sleep(LOG_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except:
+                return   # the interpreter is shutting down and the module is torn down (see _flush_log_at_exit)
+
+    def flush(self):
+        """
+        Write all buffered messages to LOGFILE now.
+        """
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            buf = self._buffer
+            v = []
+            try:
+                while True:
+                    pid, t, args = buf.popleft()
+                    v.append(u"%s (%s): %s\n"%(pid, datetime.utcfromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], ' '.join([unicode8(x) for x in args])))
+            except IndexError:
+                pass
+            if self.dropped:
+                v.append(u"%s: (dropped %s log messages)\n"%(self._pid, self.dropped))
+                self.dropped = 0
+            if not v:
+                return
+            try:
+                if self._path != LOGFILE:
+                    if self._fd is not None:
+                        os.close(self._fd)
+                    self._fd = None
+                    self._fd = os.open(LOGFILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+                    self._path = LOGFILE
+                os.write(self._fd, u''.join(v).encode('utf8'))
+            except Exception:
+                pass  # there is nowhere to report failing to log
+
+logger = Logger()
+
+def _flush_log_at_exit(flush=logger.flush):
     try:
-        debug_log = open(LOGFILE, 'a')
-        mesg = "%s (%s): %s\n"%(PID, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], ' '.join([unicode8(x) for x in args]))
-        debug_log.write(mesg)
-        debug_log.flush()
+        flush()
     except:
-        log("an error writing a log message (ignoring)")
+        pass   # e.g., the module is already torn down after a failed import
+atexit.register(_flush_log_at_exit)
+
+def log(*args):
+    logger.log(logging.INFO, args)
+
+def log_debug(*args):
+    logger.log(logging.DEBUG, args)
 
 # Determine the info object, if available.  There's no good reason
 # it wouldn't be available, unless a user explicitly deleted it, but
@@ -92,17 +257,31 @@ if 'base_url' not in INFO:
     INFO['base_url'] = ''
 
 
-# Configure logging
-#logging.basicConfig()
-#log = logging.getLogger('sage_server')
-#log.setLevel(logging.INFO)
-
 # A CoffeeScript version of this function is in misc_node.coffee.
 import hashlib
 def uuidsha1(data):
     sha1sum = hashlib.sha1()
     sha1sum.update(data)
-    s = sha1sum.hexdigest()
+    return sha1_to_uuid(sha1sum.hexdigest())
+
+def uuidsha1_file(filename):
+    """
+    Return uuidsha1 of the contents of the given file, which is read in
+    chunks of FILE_CHUNK_SIZE bytes.
+    """
+    sha1sum = hashlib.sha1()
+    f = io.open(filename, 'rb')
+    try:
+        for chunk in file_chunks(f, os.fstat(f.fileno()).st_size):
+            sha1sum.update(chunk)
+    finally:
+        f.close()
+    return sha1_to_uuid(sha1sum.hexdigest())
+
+def sha1_to_uuid(s):
+    """
+    Format the hex digest s of a sha1 hash as a uuid, as in uuidsha1.
+    """
     t = 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'
     r = list(t)
     j = 0
@@ -114,73 +293,387 @@ def uuidsha1(data):
             r[i] = hex( (int(s[j],16)&0x3) |0x8)[-1]; j += 1
     return ''.join(r)
 
+# Frame parts at most this many bytes long are copied into a single buffer together
+# with the 4-byte length header, so that small messages go out in one syscall.  Larger
+# parts (e.g., big blobs) are handed to the socket directly and are never copied.
+FRAME_COPY_LIMIT = 65536
+
+# Frames have a 4-byte length header, so this is the largest possible frame.
+MAX_FRAME_SIZE = 2**32 - 1
+
+# Files are hashed and sent in chunks of this many bytes.
+FILE_CHUNK_SIZE = 1 << 20
+
+# A file that changes while it is being sent is sent again at most this many times in all.
+FILE_SEND_ATTEMPTS = 3
+
+def file_chunks(f, size, chunk_size=None):
+    """
+    Iterate over the first size bytes of the file f (opened with io.open), as
+    memoryviews into a single reused buffer of chunk_size bytes (default:
+    FILE_CHUNK_SIZE).  Each chunk must be consumed before the next one is read.
+    Stops early if the file is shorter than size.
+    """
+    buf = bytearray(chunk_size or FILE_CHUNK_SIZE)
+    view = memoryview(buf)
+    while size > 0:
+        k = f.readinto(view[:min(size, len(buf))])
+        if not k:
+            return
+        size -= k
+        yield view[:k]
+
+def join_frame_parts(parts):
+    """
+    Return the concatenation of parts as a str, if they are all str, and
+    otherwise as a bytearray; parts may also be bytearrays, buffers or
+    memoryviews, but not unicode.
+    """
+    for part in parts:
+        if type(part) is not str:
+            if isinstance(part, unicode):
+                raise TypeError("frame parts must be bytes, not unicode")
+            b = bytearray()
+            for part in parts:
+                b += part
+            return b
+    return ''.join(parts)
+
 # A tcp connection with support for sending various types of messages, especially JSON.
+#
+# Each message is framed as a 4-byte big endian length header, followed by a one
+# character type ('j' for JSON, 'b' for blob) and the payload.
 class ConnectionJSON(object):
     def __init__(self, conn):
         assert not isinstance(conn, ConnectionJSON)  # avoid common mistake -- conn is supposed to be from socket.socket...
         self._conn = conn
+        # header of the next frame: 4 byte length and 1 byte type, reused for every message
+        self._header = bytearray(5)
+        self._send_lock_pid = None
+        # counters of frames, sendall calls and bytes sent (see stats)
+        self.frames_sent = self.sendall_calls = self.bytes_sent = 0
+
+    def stats(self):
+        """
+        Return a dict with the number of frames, sendall calls (syscalls) and
+        bytes sent so far on this connection.
+        """
+        return {'frames':self.frames_sent, 'syscalls':self.sendall_calls, 'bytes':self.bytes_sent}
 
     def close(self):
         self._conn.close()
 
-    def _send(self, s):
-        length_header = struct.pack(">L", len(s))
-        self._conn.send(length_header + s)
+    def _send_lock(self):
+        """
+        Return the lock that threads hold while sending a frame.  Each forked
+        process gets a new lock, since another thread may have been holding
+        it at the moment of the fork.
+        """
+        pid = os.getpid()
+        if self._send_lock_pid != pid:
+            self._send_lock_pid = pid
+            self._send_lock_obj = threading.Lock()
+        return self._send_lock_obj
+
+    def _send(self, *parts):
+        """
+        Send a single frame whose body is the concatenation of parts, without
+        joining large parts onto the header.  Each part is a str or another
+        object with the buffer interface, i.e., a bytearray, buffer or
+        memoryview (e.g., the body of a received blob); unicode is not
+        accepted, so encode it first.
+        """
+        n = sum(map(len, parts))
+        with self._send_lock():
+            self.frames_sent += 1
+            self.bytes_sent += 4 + n
+            if n <= FRAME_COPY_LIMIT:
+                self.sendall_calls += 1
+                self._conn.sendall(join_frame_parts((struct.pack(">L", n),) + parts))
+                return
+            head = [struct.pack(">L", n)]
+            i = 0
+            while i < len(parts) and len(parts[i]) <= FRAME_COPY_LIMIT:
+                head.append(parts[i])
+                i += 1
+            self.sendall_calls += 1 + len(parts) - i
+            self._conn.sendall(join_frame_parts(head))
+            for part in parts[i:]:
+                self._conn.sendall(part)
+
+    def _send_chunked(self, head, n, chunks):
+        """
+        Send a single frame consisting of the string head followed by exactly n
+        bytes taken from the iterable chunks, one chunk at a time.  If chunks
+        runs out early, the frame is padded with zero bytes so the stream stays
+        intact.  Returns the number of bytes actually taken from chunks.
+        """
+        with self._send_lock():
+            self.frames_sent += 1
+            self.bytes_sent += 4 + len(head) + n
+            self.sendall_calls += 1
+            self._conn.sendall(struct.pack(">L", len(head) + n) + head)
+            sent = 0
+            for chunk in chunks:
+                chunk = chunk[:n - sent]
+                self.sendall_calls += 1
+                self._conn.sendall(chunk)
+                sent += len(chunk)
+                if sent >= n:
+                    break
+            if sent < n:
+                log("stream ended %s bytes early; padding frame"%(n - sent))
+                pad = '\0' * min(n - sent, FILE_CHUNK_SIZE)
+                k = sent
+                while k < n:
+                    self.sendall_calls += 1
+                    self._conn.sendall(pad[:n - k])
+                    k += len(pad)
+        return sent
 
     def send_json(self, m):
         m = json.dumps(m)
-        log(u"sending message '", truncate_text(m, 256), u"'")
-        self._send('j' + m)
+        if not logger.quiet:
+            log_debug(u"sending message '", truncate_text(m, 256)[0], u"'")
+        self._send('j', m)
         return len(m)
 
-    def send_blob(self, blob):
-        s = uuidsha1(blob)
-        self._send('b' + s + blob)
+    def send_blob(self, blob, uuid=None):
+        """
+        Send blob and return its uuid.  If uuid is given, it must be
+        uuidsha1(blob), which is then not computed again.
+        """
+        s = uuidsha1(blob) if uuid is None else uuid
+        self._send('b', s, blob)
         return s
 
-    def send_file(self, filename):
+    def send_file(self, filename, uuid=None):
+        """
+        Send the contents of the given file as a blob and return its uuid.
+
+        The file is read twice in chunks of FILE_CHUNK_SIZE bytes: once to
+        compute the sha1 uuid, which comes first in the frame, and once to
+        stream the data to the socket.  Memory use is thus bounded no matter
+        how big the file is.  If uuid is given, it must be uuidsha1_file(filename),
+        and the file is only read once.
+
+        The streamed data is hashed again as it is sent.  If it does not
+        match the uuid, since the file changed after it was hashed, the hub
+        rejects the blob, and the file is hashed and sent again (at most
+        FILE_SEND_ATTEMPTS times in all, after which a RuntimeError is
+        raised), so the returned uuid may differ from the given one.
+        """
         log("sending file '%s'"%filename)
-        f = open(filename, 'rb')
-        data = f.read()
-        f.close()
-        return self.send_blob(data)
+        for attempt in range(FILE_SEND_ATTEMPTS):
+            if attempt:
+                log("file '%s' changed while it was being sent; sending it again"%filename)
+                uuid = None
+            f = io.open(filename, 'rb')
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if size > MAX_FRAME_SIZE - 37:
+                    raise ValueError("file '%s' is too large to send (%s bytes)"%(filename, size))
+                if uuid is None:
+                    sha1sum = hashlib.sha1()
+                    for chunk in file_chunks(f, size):
+                        sha1sum.update(chunk)
+                    uuid = sha1_to_uuid(sha1sum.hexdigest())
+                    f.seek(0)
+                sent_sha1 = hashlib.sha1()
+                def chunks():
+                    for chunk in file_chunks(f, size):
+                        sent_sha1.update(chunk)
+                        yield chunk
+                sent = self._send_chunked('b' + uuid, size, chunks())
+            finally:
+                f.close()
+            if sent == size and sha1_to_uuid(sent_sha1.hexdigest()) == uuid:
+                return uuid
+        raise RuntimeError("file '%s' changed while it was being sent"%filename)
 
-    def _recv(self, n):
-        #print "_recv(%s)"%n
-        for i in range(20): # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
+    def _recv_into(self, buf):
+        """
+        Fill the writable buffer buf (e.g., a bytearray) completely with data
+        read from the socket.  No intermediate strings are created.
+        """
+        n = len(buf)
+        pos = 0
+        view = None
+        while pos < n:
             try:
-                #print "blocking recv (i = %s), pid=%s"%(i, os.getpid())
-                r = self._conn.recv(n)
-                #log("n=%s; received: '%s' of len %s"%(n,r, len(r)))
-                return r
-            except socket.error as (errno, msg):
-                #print "socket.error, msg=%s"%msg
-                if errno != 4:
+                if pos == 0:
+                    k = self._conn.recv_into(buf, n)
+                else:
+                    # only create a view on partial reads, which are rare for small messages
+                    if view is None:
+                        view = memoryview(buf)
+                    k = self._conn.recv_into(view[pos:], n - pos)
+            except socket.error as err:
+                # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
+                if err.errno != errno.EINTR:
                     raise
-        raise EOFError
+                continue
+            if k == 0:
+                raise EOFError
+            pos += k
 
     def recv(self):
-        n = self._recv(4)
-        if len(n) < 4:
-            raise EOFError
-        n = struct.unpack('>L', n)[0]   # big endian 32 bits
-        s = self._recv(n)
-        while len(s) < n:
-            t = self._recv(n - len(s))
-            if len(t) == 0:
-                raise EOFError
-            s += t
+        """
+        Receive the next message, returning either ('json', mesg) or ('blob', data).
 
-        if s[0] == 'j':
+        The body of each message is received directly into a preallocated
+        bytearray of the right size, which is copied once into the str that
+        is returned as the data of a blob.
+        """
+        header = self._header
+        self._recv_into(header)
+        n = struct.unpack_from('>L', header)[0] - 1   # big endian 32 bits; minus the type character
+        if n < 0:
+            raise ValueError("invalid message of length 0")
+        typ = chr(header[4])
+        body = bytearray(n)
+        self._recv_into(body)
+
+        if typ == 'j':
+            s = str(body)
             try:
-                return 'json', json.loads(s[1:])
+                return 'json', json.loads(s)
             except Exception, msg:
-                log("Unable to parse JSON '%s'"%s[1:])
+                log("Unable to parse JSON '%s'"%s)
                 raise
 
-        elif s[0] == 'b':
-            return 'blob', s[1:]
-        raise ValueError("unknown message type '%s'"%s[0])
+        elif typ == 'b':
+            return 'blob', str(body)
+        raise ValueError("unknown message type '%s'"%typ)
+
+# At most this many blobs are sent before waiting for the hub to acknowledge
+# that it saved them.
+MAX_BLOBS_IN_FLIGHT = 16
+
+# If the hub does not acknowledge any blob for this many seconds (e.g., since it restarted),
+# the blobs that were sent are no longer waited for, so that the cell can finish.
+BLOB_ACK_TIMEOUT = 60
+
+# The number of blob uuids that each session remembers as saved by the hub.
+BLOB_INDEX_SIZE = 1024
+
+# A blob whose ttl will run out within this many seconds is sent again.
+BLOB_TTL_MARGIN = 600
+
+class BlobIndex(object):
+    """
+    LRU index of the sha1 uuids of the blobs that the hub has acknowledged
+    saving, so that sending an identical blob again can be skipped, and of
+    the blobs that have been sent but not acknowledged yet.
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize  = BLOB_INDEX_SIZE if maxsize is None else maxsize
+        self._saved   = collections.OrderedDict()  # uuid --> time when the blob expires (0 = never)
+        self.pending  = collections.OrderedDict()  # uuid --> filename (or None), in the order they were sent
+        self.hits     = 0
+        self.misses   = 0
+
+    def __repr__(self):
+        return "Index of %s saved blobs (%s pending; %s hits, %s misses)"%(len(self._saved), len(self.pending), self.hits, self.misses)
+
+    def ttl(self, uuid):
+        """
+        Return the remaining ttl in seconds of the blob with the given uuid
+        (0 = forever), or None if the blob must be sent to the hub.
+        """
+        expire = self._saved.pop(uuid, None)
+        if expire is not None:
+            now = time.time()
+            if expire == 0 or expire - now > BLOB_TTL_MARGIN:
+                self._saved[uuid] = expire   # most recently used
+                self.hits += 1
+                return 0 if expire == 0 else int(expire - now)
+        self.misses += 1
+        return None
+
+    def sent(self, uuid, filename=None):
+        """
+        Record that the blob with the given uuid was sent to the hub.
+        """
+        self.pending[uuid] = filename
+
+    def ack(self, mesg):
+        """
+        Record the hub's save_blob acknowledgement mesg and return the filename
+        of the blob it refers to (or None).
+        """
+        uuid = mesg.get('sha1')
+        filename = self.pending.pop(uuid, None)
+        if 'error' not in mesg and self.maxsize > 0:
+            ttl = mesg.get('ttl', 0)
+            self._saved.pop(uuid, None)
+            self._saved[uuid] = time.time() + ttl if ttl else 0
+            while len(self._saved) > self.maxsize:
+                self._saved.popitem(last=False)
+        return filename
+
+    def clear(self):
+        self._saved.clear()
+
+# Blobs of this session.  Each session is a forked child of the server, so gets its own copy.
+blob_index = BlobIndex()
+
+# Salvus.execute keeps the blocks of this many recently executed pieces of code, preparsed
+# and compiled, so running the same code again (e.g., when an interact is updated) is
+# faster.  Code longer than COMPILE_CACHE_MAX_CODE characters is not cached.
+COMPILE_CACHE_SIZE = 256
+COMPILE_CACHE_MAX_CODE = 1000000
+
+class CompileCache(object):
+    """
+    LRU cache of the blocks of code, as divided by sage_parsing.divide_into_blocks,
+    preparsed (if requested) and compiled, keyed by the sha1 hash of the code, the
+    preparse flag and the state of the preparser.
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize = COMPILE_CACHE_SIZE if maxsize is None else maxsize
+        self._blocks = collections.OrderedDict()  # key --> blocks
+        self.hits    = 0
+        self.misses  = 0
+
+    def __repr__(self):
+        return "Cache of the compiled blocks of %s pieces of code (%s hits, %s misses)"%(len(self._blocks), self.hits, self.misses)
+
+    def blocks(self, code, preparse):
+        """
+        Return the blocks of code as a list of lists [start, stop, block, compiled],
+        where start, stop and block are as returned by divide_into_blocks, block is
+        preparsed if preparse is True, and compiled is None until the caller sets
+        it to the compiled block.
+        """
+        key = None
+        if self.maxsize > 0 and len(code) <= COMPILE_CACHE_MAX_CODE:
+            key = hashlib.sha1(code.encode('utf8') if isinstance(code, unicode) else code).digest()
+            key = (key, bool(preparse), sage_parsing.preparse_state() if preparse else None)
+            blocks = self._blocks.pop(key, None)
+            if blocks is not None:
+                self._blocks[key] = blocks   # most recently used
+                self.hits += 1
+                return blocks
+            self.misses += 1
+
+        blocks = []
+        for start, stop, block in sage_parsing.divide_into_blocks(code):
+            if preparse:
+                block = sage_parsing.preparse_code(block)
+            blocks.append([start, stop, block, None])
+
+        if key is not None:
+            self._blocks[key] = blocks
+            while len(self._blocks) > self.maxsize:
+                self._blocks.popitem(last=False)
+        return blocks
+
+    def clear(self):
+        self._blocks.clear()
+
+# Compiled code of this session.
+compile_cache = CompileCache()
 
 TRUNCATE_MESG = "WARNING: Output truncated.  Type 'smc?' to learn how to raise the output limit."
 def truncate_text(s, max_size):
@@ -237,7 +730,8 @@ class Message(object):
                auto         = None,
                events       = None,
                clear        = None,
-               delete_last  = None):
+               delete_last  = None,
+               spool        = None):
         m = self._new('output')
         m['id'] = id
         t = truncate_text
@@ -272,6 +766,7 @@ class Message(object):
         if events is not None: m['events'] = events
         if clear is not None: m['clear'] = clear
         if delete_last is not None: m['delete_last'] = delete_last
+        if spool is not None: m['spool'] = spool   # = {'handle':..., 'size':..., ...}, see Salvus._close_spool
         if did_truncate:
             if 'stderr' in m:
                 m['stderr'] += '\n' + TRUNCATE_MESG
@@ -279,6 +774,9 @@ class Message(object):
                 m['stderr'] = '\n' + TRUNCATE_MESG
         return m
 
+    def session_status(self, id, pid, busy, execute_id, elapsed, max_rss, memory):
+        return self._new('session_status', locals())
+
     def introspect_completions(self, id, completions, target):
         m = self._new('introspect_completions', locals())
         m['id'] = id
@@ -294,6 +792,11 @@ class Message(object):
         m['id'] = id
         return m
 
+    def output_page(self, id, handle, start=None, stop=None, size=None, data=None, error=None):
+        m = self._new('output_page', locals())
+        m['id'] = id
+        return m
+
 message = Message()
 
 whoami = os.environ['USER']
@@ -360,27 +863,318 @@ class BufferedOutputStream(object):
         t = time.time()
         if ((len(self._buf) >= self._flush_size) or
                   (t - self._last_flush_time >= self._flush_interval)):
-            self.flush()
+            self._flush_buffer()
             self._last_flush_time = t
 
-    def flush(self, done=False):
+    def _flush_buffer(self, done=False):
+        # hand the buffer to self._f, which may merge it with other pending output (see OutputCoalescer)
         if not self._buf and not done:
             # no point in sending an empty message
             return
         self._f(self._buf, done=done)
         self._buf = ''
 
+    def flush(self, done=False):
+        self._flush_buffer(done=done)
+        # an explicit flush means the output should be visible now
+        output_coalescer.flush()
+
     def isatty(self):
         return False
 
-# This will *have* to be re-done using Cython for speed.
+class OutputCoalescer(object):
+    """
+    Merge consecutive stdout, stderr or html output messages of a cell into a
+    single message.  The merged message is sent as soon as other output (or
+    the done message) has to be sent, it reaches OUTPUT_COALESCE_SIZE characters,
+    OUTPUT_COALESCE_WINDOW seconds have passed since its first piece was added,
+    or flush is called.  A background thread sends it when the window expires,
+    so output still shows up while a cell computes.
+
+    Any other message of a cell must be sent after calling flush (see
+    Salvus._send_message), so that it arrives after the output before it.
+    """
+    _fields = ('stdout', 'stderr', 'html')
+
+    def __init__(self):
+        self.merged = 0   # number of output messages that were merged into an earlier one
+        self._pid = None
+
+    def _start(self):
+        # (re)initialize in a new process; the parent sends its own pending output
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._owner = None   # thread.get_ident() of the thread holding self._lock
+        self._wakeup = threading.Event()
+        self._pending = None
+        self._thread = threading.Thread(target=self._run, name='sage_server output coalescer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, salvus, kwds):
+        """
+        Merge the output message salvus._send_output(**kwds) into the pending
+        message and return True, or send the pending message and return False
+        if kwds is not mergeable, in which case the caller sends it.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        field = None
+        for key, value in kwds.iteritems():
+            if key in self._fields:
+                if value:
+                    if field is not None:
+                        field = False
+                    else:
+                        field = key
+            elif key not in ('id', 'done', 'once') or (key == 'once' and value):
+                field = False
+        self._acquire()
+        try:
+            p = self._pending
+            if field is False or OUTPUT_COALESCE_WINDOW <= 0 or (field is None and (p is None or not kwds.get('done'))):
+                if p is not None:
+                    self._send()
+                return False
+            if p is not None and (p['salvus'] is not salvus or
+                                  (field is not None and (p['field'] != field or
+                                        p['size'] + len(kwds[field]) > self._max_size(field)))):
+                self._send()
+                p = None
+                if field is None:
+                    return False
+            if p is None:
+                # there is nothing to merge with, but the message may be merged with later output
+                p = self._pending = {'salvus':salvus, 'id':kwds.get('id'), 'field':field, 'parts':[],
+                                     'size':0, 'deadline':time.time() + OUTPUT_COALESCE_WINDOW}
+                self._wakeup.set()
+            else:
+                self.merged += 1
+            if field is not None:
+                p['parts'].append(kwds[field])
+                p['size'] += len(kwds[field])
+            if kwds.get('done') or p['size'] >= self._max_size(p['field']) or time.time() >= p['deadline']:
+                self._send(done=kwds.get('done'))
+        finally:
+            self._release()
+        return True
+
+    def _acquire(self):
+        # A blocking acquire cannot be interrupted in Python 2, so a cell waiting here while
+        # another thread sends would ignore SIGINT; poll instead, sleeping between attempts.
+        while not self._lock.acquire(False):
+            time.sleep(.0005)
+        self._owner = thread.get_ident()
+
+    def _release(self):
+        self._owner = None
+        self._lock.release()
+
+    def _max_size(self, field):
+        import sage_server  # so that changes to the MAX's by the user take effect
+        return min(OUTPUT_COALESCE_SIZE, getattr(sage_server, 'MAX_%s_SIZE'%field.upper()))
+
+    def _send(self, done=False):
+        # send the pending message; must be called with self._lock held (see _acquire)
+        p, self._pending = self._pending, None
+        kwds = {'id':p['id'], 'done':done}
+        if p['field'] is not None:
+            try:
+                kwds[p['field']] = ''.join(p['parts'])
+            except UnicodeDecodeError:
+                kwds[p['field']] = u''.join([unicode8(x) for x in p['parts']])
+        p['salvus']._send_output_now(**kwds)
+
+    def flush(self):
+        """
+        Send the pending output message now.  This does nothing when called
+        while the pending message is being sent, e.g., from _send_output_now.
+        """
+        if self._pid != os.getpid() or self._owner == thread.get_ident():
+            return
+        self._acquire()
+        try:
+            if self._pending is not None:
+                self._send()
+        finally:
+            self._release()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                self._acquire()
+                try:
+                    p = self._pending
+                    if p is None:
+                        break
+                    delay = p['deadline'] - time.time()
+                    if delay <= 0:
+                        try:
+                            self._send()
+                        except KeyboardInterrupt:
+                            # too much output: interrupt the cell, as if it had sent it
+                            thread.interrupt_main()
+                        except Exception, err:
+                            log("ERROR -- sending coalesced output '%s'"%err)
+                        break
+                finally:
+                    self._release()
+                time.sleep(delay)
+
+output_coalescer = OutputCoalescer()
+
+
+# Output of cells beyond the output limits (see OUTPUT_SPOOL) is written to log files in
+# this directory.  When a log is started, the oldest logs are removed until they take at
+# most OUTPUT_SPOOL_MAX_BYTES, and output beyond that many bytes of a single log is skipped.
+OUTPUT_SPOOL_PATH = os.path.join(os.environ['SMC'], 'output_spool')
+OUTPUT_SPOOL_MAX_BYTES = 2 * 2**30
+# At most this many bytes of a log are sent in reply to an output_page message.
+OUTPUT_SPOOL_PAGE_SIZE = 65536
+# The summary shown when a cell finishes ends with at most this many bytes of the log.
+OUTPUT_SPOOL_TAIL = 2000
+
+class OutputSpool(object):
+    """
+    Log file with the stdout and stderr output of a cell beyond the output
+    limits.  Only the counts of what was written are kept in memory; the
+    log is read back in pages with output_spool_page, using the handle.
+    """
+    def __init__(self, path=None, max_bytes=None):
+        import sage_server  # so that changes to the settings by the user take effect
+        self.path = sage_server.OUTPUT_SPOOL_PATH if path is None else path
+        self.max_bytes = sage_server.OUTPUT_SPOOL_MAX_BYTES if max_bytes is None else max_bytes
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass   # another session made it
+        self.evict()
+        self.handle = uuid()
+        self.filename = os.path.join(self.path, self.handle)
+        self._file = open(self.filename, 'wb')
+        self.size = 0       # bytes written to the log
+        self.lines = 0      # newlines written to the log
+        self.skipped = 0    # bytes not written, since the log was full
+        self.dropped = 0    # output messages (other than stdout and stderr) that were not sent
+
+    def __repr__(self):
+        return "Output spool %s with %s bytes"%(self.filename, self.size)
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf8')
+        if self.size + len(s) > self.max_bytes:
+            self.skipped += len(s)
+            return
+        self._file.write(s)
+        self.size += len(s)
+        self.lines += s.count('\n')
+
+    def close(self):
+        self._file.close()
+
+    def summary(self):
+        """
+        Return a dict describing the log, which is sent with the output.
+        """
+        return {'handle':self.handle, 'size':self.size, 'lines':self.lines,
+                'skipped':self.skipped, 'dropped':self.dropped}
+
+    def evict(self):
+        """
+        Remove the oldest logs until they take at most self.max_bytes.
+        """
+        lock = open(os.path.join(self.path, 'lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            logs = []
+            for name in os.listdir(self.path):
+                filename = os.path.join(self.path, name)
+                try:
+                    if name != 'lock':
+                        logs.append((os.path.getmtime(filename), os.path.getsize(filename), filename))
+                except OSError:
+                    pass   # removed by another session
+            logs.sort()
+            total = sum([size for _, size, _ in logs])
+            for _, size, filename in logs:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+                total -= size
+        finally:
+            lock.close()
+
+def output_spool_page(handle, start=0, stop=None, max_size=None, path=None):
+    """
+    Return a dict with the bytes start:stop (at most max_size of them) of the
+    output log with the given handle, as the unicode string 'data', and the
+    'start', 'stop' and total 'size' of the log.  A page never ends within a
+    utf8 encoded character, so stop may be smaller than requested; the next
+    page starts at the returned stop.
+    """
+    import sage_server
+    if path is None:
+        path = sage_server.OUTPUT_SPOOL_PATH
+    if not handle or os.path.basename(handle) != handle or handle.startswith('.') or handle == 'lock':
+        raise ValueError("invalid output spool handle '%s'"%handle)
+    with open(os.path.join(path, handle), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = max(0, min(int(start), size))
+        stop = size if stop is None else max(start, min(int(stop), size))
+        if max_size is not None:
+            stop = min(stop, start + max_size)
+        f.seek(start)
+        data = f.read(stop - start)
+    if stop < size:
+        # do not split the last utf8 encoded character
+        i = len(data) - 1   # index of the first byte of the last character
+        while i > 0 and i > len(data) - 4 and 0x80 <= ord(data[i]) < 0xC0:
+            i -= 1
+        if i > 0 and ord(data[i]) >= 0xC0:
+            n = 2 if ord(data[i]) < 0xE0 else 3 if ord(data[i]) < 0xF0 else 4
+            if len(data) - i < n:
+                data = data[:i]
+                stop = start + i
+    return {'handle':handle, 'start':start, 'stop':stop, 'size':size, 'data':data.decode('utf8', 'replace')}
+
 class Namespace(dict):
+    """
+    The namespace in which cells are executed, with listeners that are called
+    when a variable is changed or deleted, or after code was executed in it
+    (see on).
+
+    Until a listener is registered, a Namespace does not override
+    __setitem__ or __delitem__, so that assignments to globals in executed
+    code cost about as much as with a plain dict.  Registering a listener
+    switches the namespace to observing mode (the ObservingNamespace class),
+    and removing the last one switches it back.  Listeners for executed code
+    do not need that.
+    """
     def __init__(self, x):
         self._on_change = {}
         self._on_del = {}
+        self._on_execute = []
+        self._batched = None
         dict.__init__(self, x)
 
+    def _observe(self):
+        self.__class__ = ObservingNamespace if (self._on_change or self._on_del) else Namespace
+
     def on(self, event, x, f):
+        """
+        Call f(y) when the variable x is set to y, or f(x, y) for every
+        variable x if x is None (event='change'), or call f() when x is
+        deleted, or f(x) for every variable if x is None (event='del'), or
+        call f() after code that may have changed any variable was executed
+        (event='execute', with x None; see executed).
+        """
         if event == 'change':
             if x not in self._on_change:
                 self._on_change[x] = []
@@ -389,58 +1183,111 @@ class Namespace(dict):
             if x not in self._on_del:
                 self._on_del[x] = []
             self._on_del[x].append(f)
+        elif event == 'execute':
+            self._on_execute.append(f)
+        self._observe()
 
     def remove(self, event, x, f):
-        if event == 'change' and self._on_change.has_key(x):
-            v = self._on_change[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_change[x]
-        elif event == 'del' and self._on_del.has_key(x):
-            v = self._on_del[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
+        if event == 'change':
+            listeners = self._on_change
+        elif event == 'del':
+            listeners = self._on_del
+        elif event == 'execute':
+            if f in self._on_execute:
+                self._on_execute.remove(f)
+            return
+        else:
+            return
+        v = listeners.get(x, [])
+        if f in v:
+            v.remove(f)
             if len(v) == 0:
-                del self._on_del[x]
+                del listeners[x]
+        self._observe()
+
+    def _changed(self, x, y, do_not_trigger=()):
+        if self._batched is not None:
+            self._batched[x] = y
+            return
+        if x in self._on_change:
+            for f in self._on_change[x]:
+                if f not in do_not_trigger:
+                    f(y)
+        if None in self._on_change:
+            for f in self._on_change[None]:
+                f(x, y)
+
+    def executed(self):
+        """
+        Call the listeners for executed code; called after executing a cell.
+        """
+        for f in self._on_execute:
+            try:
+                f()
+            except Exception, mesg:
+                print mesg
 
+    def set(self, x, y, do_not_trigger=None):
+        dict.__setitem__(self, x, y)
+        self._changed(x, y, do_not_trigger or ())
+
+    def batch(self):
+        """
+        Return a context manager, in which the change listeners are not called
+        for each assignment; instead they are called once for each changed
+        variable (with its last value) on leaving the outermost batch, e.g.::
+
+            with salvus.namespace.batch():
+                for i in range(10^6):
+                    x = i
+        """
+        return NamespaceBatch(self)
+
+class ObservingNamespace(Namespace):
+    """
+    A Namespace with listeners; see Namespace.on.
+    """
     def __setitem__(self, x, y):
         dict.__setitem__(self, x, y)
         try:
-            if self._on_change.has_key(x):
-                for f in self._on_change[x]:
-                    f(y)
-            if self._on_change.has_key(None):
-                for f in self._on_change[None]:
-                    f(x, y)
+            self._changed(x, y)
         except Exception, mesg:
             print mesg
 
     def __delitem__(self, x):
         try:
-            if self._on_del.has_key(x):
+            if self._batched is not None:
+                self._batched.pop(x, None)
+            if x in self._on_del:
                 for f in self._on_del[x]:
                     f()
-            if self._on_del.has_key(None):
+            if None in self._on_del:
                 for f in self._on_del[None]:
                     f(x)
         except Exception, mesg:
             print mesg
         dict.__delitem__(self, x)
 
-    def set(self, x, y, do_not_trigger=None):
-        dict.__setitem__(self, x, y)
-        if self._on_change.has_key(x):
-            if do_not_trigger is None:
-                do_not_trigger = []
-            for f in self._on_change[x]:
-                if f not in do_not_trigger:
-                    f(y)
-        if self._on_change.has_key(None):
-            for f in self._on_change[None]:
-                f(x,y)
+class NamespaceBatch(object):
+    def __init__(self, namespace):
+        self._namespace = namespace
+        self._outer = False
+
+    def __enter__(self):
+        if self._namespace._batched is None:
+            self._namespace._batched = {}
+            self._outer = True
+        return self._namespace
+
+    def __exit__(self, type, value, traceback):
+        if self._outer:
+            batched = self._namespace._batched
+            self._namespace._batched = None
+            for x, y in batched.iteritems():
+                try:
+                    self._namespace._changed(x, y)
+                except Exception, mesg:
+                    print mesg
 
 class TemporaryURL:
     def __init__(self, url, ttl):
@@ -453,6 +1300,9 @@ class TemporaryURL:
 
 namespace = Namespace({})
 
+# Completions of names in namespace and of attributes of objects (see introspect below).
+completion_index = sage_parsing.CompletionIndex(namespace)
+
 class Salvus(object):
     """
     Cell execution state object and wrapper for access to special SageMathCloud functionality.
@@ -477,6 +1327,14 @@ class Salvus(object):
 
         sage_server.MAX_OUTPUT            # max total character output for a single cell; computation
                                           # terminated/truncated if sum of above exceeds this.
+
+    Alternatively, set::
+
+        sage_server.OUTPUT_SPOOL = True
+
+    Then a cell that exceeds these limits keeps running, and the rest of its stdout and stderr
+    is written to a log file on disk instead; the cell shows a summary with the handle of
+    the log, and salvus.output_page(handle, start, stop) returns any part of it.
     """
     Namespace = Namespace
     _prefix       = ''
@@ -486,10 +1344,14 @@ class Salvus(object):
     def _flush_stdio(self):
         """
         Flush the standard output streams.  This should be called before sending any message
-        that produces output.
+        that produces output.  Output already flushed may still be merged with the next
+        output message (see OutputCoalescer).
         """
-        sys.stdout.flush()
-        sys.stderr.flush()
+        for stream in (sys.stdout, sys.stderr):
+            if isinstance(stream, BufferedOutputStream):
+                stream._flush_buffer()
+            else:
+                stream.flush()
 
     def __repr__(self):
         return ''
@@ -499,12 +1361,18 @@ class Salvus(object):
         self._num_output_messages = 0
         self._total_output_length = 0
         self._output_warning_sent = False
+        self._spool = None           # OutputSpool for output beyond the limits (see OUTPUT_SPOOL)
+        self._output_filter = None   # if set, called on each output message, which is not sent if it returns None
+        self._conn_stats = conn.stats()
+        self._merged = output_coalescer.merged
         self._id   = id
         self._done = True    # done=self._done when last execute message is sent; e.g., set self._done = False to not close cell on code term.
         self.data = data
         self.cell_id = cell_id
         self.namespace = namespace
         self.message_queue = message_queue
+        self.fork_engine = fork_engine
+        self.artifact_cache = artifact_cache
         self.code_decorators = [] # gets reset if there are code decorators
         # Alias: someday remove all references to "salvus" and instead use smc.
         # For now this alias is easier to think of and use.
@@ -518,26 +1386,148 @@ class Salvus(object):
     def _send_output(self, *args, **kwds):
         if self._output_warning_sent:
             raise KeyboardInterrupt
+        if self._spool is not None:
+            # the output goes to the log, after any output that is still pending
+            output_coalescer.flush()
+            self._send_output_now(*args, **kwds)
+        elif args:
+            output_coalescer.flush()
+            self._send_output_now(*args, **kwds)
+        elif not output_coalescer.add(self, kwds):
+            self._send_output_now(*args, **kwds)
+
+    def _send_message(self, mesg):
+        """
+        Send mesg (e.g., a message that is not output) after the output of the
+        cell that is still pending, if any, and return its length.
+        """
+        output_coalescer.flush()
+        return self._conn.send_json(mesg)
+
+    def _send_output_now(self, *args, **kwds):
+        if self._output_warning_sent:
+            raise KeyboardInterrupt
+        import sage_server
+        if self._spool is not None:
+            self._spool_output(kwds)
+            return
+        if sage_server.OUTPUT_SPOOL and (len(kwds.get('stdout') or '') > sage_server.MAX_STDOUT_SIZE or
+                                         len(kwds.get('stderr') or '') > sage_server.MAX_STDERR_SIZE):
+            # write it to the log, rather than truncating it
+            self._start_spool()
+            self._spool_output(kwds)
+            return
         mesg = message.output(*args, **kwds)
         if not mesg.get('once',False):
             self._num_output_messages += 1
-        import sage_server
+
+        if self._output_filter is not None:
+            mesg = self._output_filter(mesg)
+            if mesg is None:
+                return
 
         if self._num_output_messages > sage_server.MAX_OUTPUT_MESSAGES:
-            self._output_warning_sent = True
-            err = "\nToo many output messages (at most %s per cell -- type 'smc?' to learn how to raise this limit): attempting to terminate..."%sage_server.MAX_OUTPUT_MESSAGES
-            self._conn.send_json(message.output(stderr=err, id=self._id, once=False, done=True))
-            raise KeyboardInterrupt
+            if sage_server.OUTPUT_SPOOL:
+                if [key for key in mesg if key not in ('event', 'id', 'done', 'once')]:
+                    self._start_spool()
+                    self._spool_output(kwds)
+                    return
+                # otherwise it is just the done message
+            else:
+                self._output_warning_sent = True
+                err = "\nToo many output messages (at most %s per cell -- type 'smc?' to learn how to raise this limit): attempting to terminate..."%sage_server.MAX_OUTPUT_MESSAGES
+                self._send_message(message.output(stderr=err, id=self._id, once=False, done=True))
+                raise KeyboardInterrupt
 
         n = self._conn.send_json(mesg)
         self._total_output_length += n
 
         if self._total_output_length > sage_server.MAX_OUTPUT:
+            if sage_server.OUTPUT_SPOOL:
+                if not mesg.get('done'):
+                    self._start_spool()
+                return
             self._output_warning_sent = True
             err = "\nOutput too long -- MAX_OUTPUT (=%s) exceed (type 'smc?' to learn how to raise this limit): attempting to terminate..."%sage_server.MAX_OUTPUT
-            self._conn.send_json(message.output(stderr=err, id=self._id, once=False, done=True))
+            self._send_message(message.output(stderr=err, id=self._id, once=False, done=True))
             raise KeyboardInterrupt
 
+    def _start_spool(self):
+        self._spool = OutputSpool()
+        err = "\nOutput exceeds the limits of this cell (type 'smc?' to learn more): writing the rest of it to a log, which salvus.output_page('%s') reads...\n"%self._spool.handle
+        self._total_output_length += self._send_message(message.output(stderr=err, id=self._id, spool={'handle':self._spool.handle}))
+
+    def _spool_output(self, kwds):
+        # Write the stdout and stderr of the output message kwds to the log, and send the
+        # rest of it, if any, unless the limits are exceeded.
+        import sage_server
+        for field in ('stdout', 'stderr'):
+            if kwds.get(field):
+                self._spool.write(kwds.pop(field))
+        done = kwds.pop('done', False)
+        if [key for key, value in kwds.iteritems() if value and key not in ('id', 'once')]:
+            if (self._num_output_messages < sage_server.MAX_OUTPUT_MESSAGES and
+                      self._total_output_length < sage_server.MAX_OUTPUT):
+                mesg = message.output(**kwds)
+                if not mesg.get('once',False):
+                    self._num_output_messages += 1
+                if self._output_filter is not None:
+                    mesg = self._output_filter(mesg)
+                if mesg is not None:
+                    self._total_output_length += self._send_message(mesg)
+            else:
+                self._spool.dropped += 1
+        if done:
+            self._close_spool(done=done)
+
+    def _close_spool(self, done=False):
+        """
+        Close the log of the output beyond the limits, if any, and send a
+        summary of it, with the end of the log.
+        """
+        spool, self._spool = self._spool, None
+        if spool is None:
+            return
+        spool.close()
+        import sage_server
+        tail = output_spool_page(spool.handle, max(0, spool.size - sage_server.OUTPUT_SPOOL_TAIL), path=spool.path)['data']
+        if tail and spool.size > sage_server.OUTPUT_SPOOL_TAIL:
+            tail = '[...]' + tail.split('\n', 1)[-1]
+        err = "\n%s bytes (%s lines) of output were written to the log; use salvus.output_page('%s', start, stop) to read them"%(
+            spool.size, spool.lines, spool.handle)
+        if spool.skipped:
+            err += "; %s more bytes were skipped, since the log was full"%spool.skipped
+        if spool.dropped:
+            err += "; %s other output messages were dropped"%spool.dropped
+        self._send_message(message.output(stdout=tail, stderr=err + '\n', id=self._id, spool=spool.summary(), done=done))
+
+    def output_page(self, handle, start=0, stop=None):
+        """
+        Return the part start:stop (in bytes) of the log of output beyond the
+        limits of a cell with the given handle, which the cell shows (see
+        sage_server.OUTPUT_SPOOL).  For example,
+
+            print salvus.output_page(handle, 0, 10000)
+
+        shows the first 10000 bytes of the output.
+        """
+        return output_spool_page(handle, start, stop)['data']
+
+    def output_stats(self):
+        """
+        Return a dict describing what was sent to the hub since this cell started:
+        the number of output messages, of output pieces merged into another
+        message (see sage_server.OUTPUT_COALESCE_WINDOW), and of frames, syscalls
+        and bytes sent on the connection (which includes blobs and replies to
+        other requests).
+        """
+        stats = self._conn.stats()
+        for k, v in self._conn_stats.iteritems():
+            stats[k] -= v
+        stats['messages'] = self._num_output_messages
+        stats['merged'] = output_coalescer.merged - self._merged
+        return stats
+
     def obj(self, obj, done=False):
         self._send_output(obj=obj, id=self._id, done=done)
         return self
@@ -705,7 +1695,11 @@ class Salvus(object):
         # We do this since obj can easily be quite large/complicated, and managing it as part of the
         # document is too slow and doesn't scale.
         blob = json.dumps(scene, separators=(',', ':'))
-        uuid = self._conn.send_blob(blob)
+        uuid = uuidsha1(blob)
+        if blob_index.ttl(uuid) is None and uuid not in blob_index.pending:
+            self._wait_for_blob_acks(max_pending=MAX_BLOBS_IN_FLIGHT-1)
+            self._conn.send_blob(blob, uuid=uuid)
+            blob_index.sent(uuid)
 
         # flush output (so any text appears before 3d graphics, in case they are interleaved)
         self._flush_stdio()
@@ -756,7 +1750,8 @@ class Salvus(object):
 
         The uuid is based on the Sha-1 hash of the file content (it is computed using the
         function sage_server.uuidsha1).  Any two files with the same content have the
-        same Sha1 hash.
+        same Sha1 hash.  A file whose content the hub already saved during this session
+        is not sent again (see sage_server.blob_index).
         """
         filename = unicode8(filename)
         if raw:
@@ -775,19 +1770,19 @@ class Salvus(object):
             else:
                 return TemporaryURL(url=url, ttl=0)
 
-        file_uuid = self._conn.send_file(filename)
-
-        mesg = None
-        while mesg is None:
-            self.message_queue.recv()
-            for i, (typ, m) in enumerate(self.message_queue.queue):
-                if typ == 'json' and m.get('event') == 'save_blob' and m.get('sha1') == file_uuid:
-                    mesg = m
-                    del self.message_queue[i]
-                    break
-
-        if 'error' in mesg:
-            raise RuntimeError("error saving blob -- %s"%mesg['error'])
+        # Blobs that the hub already saved are not sent again.  Otherwise, we do not wait
+        # for the hub to acknowledge saving the blob (unless we need its ttl below), so
+        # several blobs can be in flight at once; all of them are acknowledged before the
+        # cell is done.
+        file_uuid = uuidsha1_file(filename)
+        ttl = blob_index.ttl(file_uuid)
+        if ttl is None:
+            if file_uuid not in blob_index.pending:
+                self._wait_for_blob_acks(max_pending=MAX_BLOBS_IN_FLIGHT-1)
+                file_uuid = self._conn.send_file(filename, uuid=file_uuid)   # differs if the file changed
+                blob_index.sent(file_uuid, filename)
+            if not show:
+                ttl = self._wait_for_blob_acks(uuid=file_uuid).get('ttl', 0)
 
         self._flush_stdio()
         self._send_output(id=self._id, once=once, file={'filename':filename, 'uuid':file_uuid, 'show':show}, events=events, done=done)
@@ -796,7 +1791,41 @@ class Salvus(object):
             url = u"%s/blobs/%s?uuid=%s"%(info['base_url'], filename, file_uuid)
             if download:
                 url += u'?download'
-            return TemporaryURL(url=url, ttl=mesg.get('ttl',0))
+            return TemporaryURL(url=url, ttl=ttl)
+
+    def _wait_for_blob_acks(self, uuid=None, max_pending=0):
+        """
+        Handle save_blob acknowledgements from the hub until the blob with the
+        given uuid (if not None) is acknowledged and at most max_pending blobs
+        are waiting for acknowledgement.  Return the acknowledgement of uuid,
+        or raise a RuntimeError if the hub failed to save it.  Errors saving
+        other blobs are written to stderr.  If no acknowledgement arrives for
+        BLOB_ACK_TIMEOUT seconds, the blobs are no longer waited for (and a
+        RuntimeError is raised if uuid is one of them).
+        """
+        ack = None
+        if uuid is not None:
+            ack = self.message_queue.recv_blob_ack(uuid, timeout=BLOB_ACK_TIMEOUT)
+            if ack is None:
+                blob_index.pending.pop(uuid, None)
+                log("no save_blob acknowledgement for %s in %s seconds"%(uuid, BLOB_ACK_TIMEOUT))
+                raise RuntimeError("the hub did not acknowledge saving the blob %s"%uuid)
+            blob_index.ack(ack)
+        while len(blob_index.pending) > max_pending:
+            mesg = self.message_queue.recv_blob_ack(timeout=BLOB_ACK_TIMEOUT)
+            if mesg is None:
+                log("no save_blob acknowledgement in %s seconds; no longer waiting for %s blobs"%(
+                    BLOB_ACK_TIMEOUT, len(blob_index.pending)))
+                blob_index.pending.clear()
+                break
+            if mesg.get('sha1') not in blob_index.pending:
+                continue   # not sent by this session, e.g., relayed from a forked process
+            filename = blob_index.ack(mesg)
+            if 'error' in mesg:
+                sys.stderr.write("error saving blob for '%s' -- %s\n"%(filename, mesg['error']))
+        if ack is not None and 'error' in ack:
+            raise RuntimeError("error saving blob -- %s"%ack['error'])
+        return ack
 
     def default_mode(self, mode=None):
         """
@@ -881,16 +1910,16 @@ class Salvus(object):
         if namespace is None:
             namespace = self.namespace
 
-        # clear pylab figure (takes a few microseconds)
-        if pylab is not None:
-            pylab.clf()
+        # clear pylab figure (takes a few microseconds), once matplotlib is used (see LAZY_IMPORTS)
+        pyplot = sys.modules.get('matplotlib.pyplot')
+        if pyplot is not None:
+            pyplot.clf()
 
         #code   = sage_parsing.strip_leading_prompts(code)  # broken -- wrong on "def foo(x):\n   print x"
-        blocks = sage_parsing.divide_into_blocks(code)
+        blocks = compile_cache.blocks(code, preparse)
 
-        for start, stop, block in blocks:
-            if preparse:
-                block = sage_parsing.preparse_code(block)
+        for entry in blocks:
+            start, stop, block, compiled = entry
             sys.stdout.reset(); sys.stderr.reset()
             try:
                 b = block.rstrip()
@@ -902,14 +1931,15 @@ class Salvus(object):
                     p = sage_parsing.introspect(block, namespace=namespace, preparse=False)
                     self.code(source = p['result'], mode = "text/x-rst")
                 else:
-                    exec compile(block+'\n', '', 'single') in namespace, locals
-                sys.stdout.flush()
-                sys.stderr.flush()
+                    if compiled is None:
+                        compiled = entry[3] = compile(block+'\n', '', 'single')
+                    exec compiled in namespace, locals
+                self._flush_stdio()
             except:
-                sys.stdout.flush()
+                self._flush_stdio()
                 sys.stderr.write('Error in lines %s-%s\n'%(start+1, stop+1))
                 traceback.print_exc()
-                sys.stderr.flush()
+                self._flush_stdio()
                 break
 
     def execute_with_code_decorators(self, code_decorators, code, preparse=True, namespace=None, locals=None):
@@ -1048,11 +2078,15 @@ class Salvus(object):
         return self
 
     def _execute_interact(self, id, vals):
-        if id not in sage_salvus.interacts:
-            print "(Evaluate this cell to use this interact.)"
+        I = sage_salvus.interacts.get(id)
+        if I is None:
+            if sage_salvus.interacts.evicted(id):
+                print "(This interact was freed, since %s newer interacts were used; evaluate this cell to use it.)"%sage_salvus.interacts.maxsize
+            else:
+                print "(Evaluate this cell to use this interact.)"
             #raise RuntimeError, "Error: No interact with id %s"%id
         else:
-            sage_salvus.interacts[id](vals)
+            I(vals)
 
     def interact(self, f, done=False, once=None, **kwds):
         I = sage_salvus.InteractCell(f, **kwds)
@@ -1212,7 +2246,7 @@ class Salvus(object):
 
         See the docs for the top-level javascript function for more details.
         """
-        self._conn.send_json(message.execute_javascript(code,
+        self._send_message(message.execute_javascript(code,
             coffeescript=coffeescript, obj=json.dumps(obj,separators=(',', ':'))))
 
     def execute_coffeescript(self, *args, **kwds):
@@ -1232,42 +2266,20 @@ class Salvus(object):
         INPUT:
 
            - filename -- name of a Cython file
-           - all other options are passed to sage.misc.cython.cython unchanged,
-             except for use_cache which defaults to True (instead of False)
+           - all other options are passed to sage.misc.cython.cython unchanged
 
         OUTPUT:
 
-           - a module
+           - a module, which is cached by its code and options (see artifact_cache)
         """
-        if 'use_cache' not in opts:
-            opts['use_cache'] = True
-        import sage.misc.cython
-        modname, path = sage.misc.cython.cython(filename, **opts)
-        import sys
-        try:
-            sys.path.insert(0,path)
-            module = __import__(modname)
-        finally:
-            del sys.path[0]
-        return module
+        return sage_salvus.cython_module(open(filename).read(), filename=filename, **opts)
 
     def _import_code(self, content, **opts):
-        while True:
-            py_file_base = uuid().replace('-','_')
-            if not os.path.exists(py_file_base + '.py'):
-                break
-        try:
-            open(py_file_base+'.py', 'w').write(content)
-            import sys
-            try:
-                sys.path.insert(0, os.path.abspath('.'))
-                mod = __import__(py_file_base)
-            finally:
-                del sys.path[0]
-        finally:
-            os.unlink(py_file_base+'.py')
-            os.unlink(py_file_base+'.pyc')
-        return mod
+        def build(key, path):
+            name = '_smc_require_%s'%key[:20]
+            open(os.path.join(path, name + '.py'), 'w').write(content)
+            open(os.path.join(path, 'module'), 'w').write(name + '.py')
+        return artifact_cache.load(artifact_cache.lookup('python', content, build))
 
     def _sage(self, filename, **opts):
         import sage.misc.preparser
@@ -1344,6 +2356,12 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         salvus.execute(code, namespace=namespace, preparse=preparse)
 
     finally:
+        namespace.executed()
+        # make sure the hub saved every blob sent by this cell before it is done
+        try:
+            salvus._wait_for_blob_acks()
+        except Exception, err:
+            log("ERROR -- waiting for blob acknowledgements '%s'"%err)
         # there must be exactly one done message, unless salvus._done is False.
         if sys.stderr._buf:
             if sys.stdout._buf:
@@ -1352,6 +2370,12 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         else:
             sys.stdout.flush(done=salvus._done)
         (sys.stdout, sys.stderr) = streams
+        # the summary of the output beyond the limits, if the done message did not send it
+        try:
+            salvus._close_spool()
+        except Exception, err:
+            log("ERROR -- closing the output spool '%s'"%err)
+        log("cell %s output: %s"%(id, salvus.output_stats()))
 
 
 def drop_privileges(id, home, transient, username):
@@ -1378,10 +2402,39 @@ def drop_privileges(id, home, transient, username):
     sage.misc.misc.DOT_SAGE = home + '/.sage/'
 
 
-class MessageQueue(list):
+class MessageQueue(object):
+    """
+    The messages that a session receives from the hub.
+
+    A reader thread receives each message as soon as it arrives, and sorts
+    it by event:
+
+    - save_blob acknowledgements are stored by sha1, so that they can be
+      looked up directly (see recv_blob_ack);
+    - events with a handler (see on) are handled right away in the reader
+      thread, e.g., so that introspection works while a cell is running;
+    - all other messages are appended to the queue, from which the main
+      thread takes them in order (see next_mesg).
+
+    The main thread waits for the reader thread on a pipe, rather than on a
+    lock, so that it can still be interrupted with SIGINT.
+    """
     def __init__(self, conn):
-        self.queue = []
+        self.queue = collections.deque()
         self.conn  = conn
+        self.eof   = False
+        # (id, start time) of the execute_code message being handled, if any
+        self.executing = None
+        self._acks = {}                         # sha1 --> save_blob message
+        self._ack_order = collections.deque()   # (time, sha1, message) in the order the acks arrived
+        self._handlers = {}
+        self._pid = os.getpid()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in [self._wakeup_r, self._wakeup_w]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._thread = threading.Thread(target=self._run, name='sage_server message reader')
+        self._thread.daemon = True
+        self._thread.start()
 
     def __repr__(self):
         return "Sage Server Message Queue"
@@ -1392,26 +2445,510 @@ class MessageQueue(list):
     def __delitem__(self, i):
         del self.queue[i]
 
+    def on(self, event, f):
+        """
+        Handle each message with the given event by calling f(mesg) in the
+        reader thread.  If f returns False, the message is queued instead.
+        """
+        self._handlers[event] = f
+
+    def _run(self):
+        while True:
+            try:
+                typ, mesg = self.conn.recv()
+            except ValueError, err:
+                # the message was received completely, but could not be decoded
+                log("message reader: ignoring invalid message -- %s"%err)
+                continue
+            except Exception, err:
+                log("message reader: connection closed -- %s"%err)
+                break
+            try:
+                self._dispatch(typ, mesg)
+            except Exception, err:
+                log("message reader: error handling message -- %s"%err)
+        self.eof = True
+        self._wakeup()
+
+    def _dispatch(self, typ, mesg):
+        if typ == 'json':
+            event = mesg.get('event')
+            if event == 'save_blob':
+                # forget acknowledgements that nobody waited for, e.g., of blobs relayed from
+                # forked processes, or of blobs no longer waited for (see BLOB_ACK_TIMEOUT)
+                now = time.time()
+                while self._ack_order and self._ack_order[0][0] < now - BLOB_ACK_TIMEOUT:
+                    _, sha1, old = self._ack_order.popleft()
+                    if self._acks.get(sha1) is old:
+                        del self._acks[sha1]
+                self._ack_order.append((now, mesg.get('sha1'), mesg))
+                self._acks[mesg.get('sha1')] = mesg
+                self._wakeup()
+                return
+            f = self._handlers.get(event)
+            if f is not None and f(mesg) is not False:
+                return
+        self.queue.append((typ, mesg))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            pass  # the pipe is full, so the main thread will wake up anyway
+
+    def _wait(self, timeout=None):
+        """
+        Wait until the reader thread received something, or at most timeout
+        seconds (if not None).
+        """
+        if os.getpid() != self._pid:
+            # A forked child (e.g., of %fork) has no reader thread, so we read ourselves.
+            self._dispatch(*self.conn.recv())
+            return
+        while True:
+            try:
+                select.select([self._wakeup_r], [], [], timeout)
+                break
+            except select.error as (errno, msg):
+                if errno != 4:
+                    raise
+        try:
+            os.read(self._wakeup_r, 4096)
+        except OSError:
+            pass
+
+    def next_mesg(self):
+        """
+        Remove oldest message from the queue and return it.  If the queue is
+        empty, wait for a message to arrive.  Raises EOFError once the
+        connection is closed and all messages were taken.
+        """
+        while True:
+            try:
+                return self.queue.popleft()
+            except IndexError:
+                pass
+            if self.eof:
+                raise EOFError
+            self._wait()
+
+    def recv_blob_ack(self, sha1=None, timeout=None):
+        """
+        Return the save_blob acknowledgement for the blob with the given sha1,
+        or the oldest one if sha1 is None, waiting for it to arrive if
+        necessary, but at most timeout seconds (if not None), after which
+        None is returned.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if sha1 is not None:
+                mesg = self._acks.pop(sha1, None)
+                if mesg is not None:
+                    return mesg
+            else:
+                while self._ack_order:
+                    _, k, mesg = self._ack_order.popleft()
+                    if self._acks.get(k) is mesg:
+                        del self._acks[k]
+                        return mesg
+            if self.eof:
+                raise EOFError
+            if deadline is None:
+                self._wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._wait(remaining)
+
+
+def cpu_quota():
+    """
+    Return the number of cpus this process may use: its cgroup's cpu quota
+    (which smc_compute's compute_quota sets for the project), rounded up, or
+    the number of cpus if there is no quota.
+    """
+    n = multiprocessing.cpu_count()
+    try:
+        for line in open('/proc/self/cgroup'):
+            hierarchy, controllers, path = line.strip().split(':', 2)
+            if controllers == '':
+                # cgroup v2
+                name = '/sys/fs/cgroup%s/cpu.max'%path
+                if os.path.exists(name):
+                    quota, period = open(name).read().split()
+                    if quota != 'max':
+                        return max(1, min(n, int(math.ceil(float(quota)/int(period)))))
+            elif 'cpu' in controllers.split(','):
+                for mount in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/' + controllers]:
+                    name = mount + path.rstrip('/') + '/cpu.cfs_quota_us'
+                    if os.path.exists(name):
+                        quota = int(open(name).read())
+                        period = int(open(name.replace('quota', 'period')).read())
+                        if quota > 0:
+                            return max(1, min(n, int(math.ceil(float(quota)/period))))
+                        break
+    except (IOError, ValueError), err:
+        log("unable to read cpu quota -- %s"%err)
+    return n
+
+class ForkedMessageQueue(object):
+    """
+    Stands in for the MessageQueue in a process forked by the ForkEngine,
+    which does not receive messages from the hub.  The blobs it sends are
+    relayed by the parent, and are acknowledged right away.
+    """
+    eof = True
+
     def next_mesg(self):
+        raise EOFError("input is not available in a forked process")
+
+    def recv_blob_ack(self, sha1=None, timeout=None):
+        if sha1 is None:
+            sha1 = next(iter(blob_index.pending), None)
+        return {'event':'save_blob', 'sha1':sha1}
+
+# Identifies the blob frame with the pickled result of a forked function.
+FORK_RESULT_UUID = 'fork-result'.ljust(36, '-')
+
+class ForkEngine(object):
+    """
+    Runs functions in forked copies of this session, at most workers() at a
+    time.
+
+    The output of a forked function (including blobs, e.g., plots) goes
+    through a socket to this process, which sends it on to the hub while the
+    function runs, followed by the pickled result, which is passed to a
+    callback in a thread of this process.  The state of the engine is per
+    process, so forked functions can use it too.
+    """
+    def __init__(self, max_workers=None):
+        # number of children that may run at once; by default, the cpu quota
+        self.max_workers = max_workers
+        self._pid = None
+
+    def _state(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._children = {}   # pid --> time when forked
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            for fd in [self._wakeup_r, self._wakeup_w]:
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        return self._children
+
+    def __repr__(self):
+        return "Fork engine running %s of at most %s processes"%(len(self._state()), self.workers())
+
+    def workers(self):
+        return self.max_workers if self.max_workers else cpu_quota()
+
+    def children(self):
+        """
+        Return the pids of the running children.
+        """
+        return self._state().keys()
+
+    def wait(self, n=0):
+        """
+        Wait until at most n children are running.  Can be interrupted.
+        """
+        children = self._state()
+        while len(children) > n:
+            try:
+                select.select([self._wakeup_r], [], [], 1)
+            except select.error as (errno, msg):
+                if errno != 4:
+                    raise
+            try:
+                os.read(self._wakeup_r, 4096)
+            except OSError:
+                pass
+
+    def start(self, f, callback, args=(), kwds=None, salvus=None):
         """
-        Remove oldest message from the queue and return it.
-        If the queue is empty, wait for a message to arrive
-        and return it (does not place it in the queue).
+        Call f(*args, **kwds) in a forked child, after waiting until fewer
+        than workers() children are running, and return the pid of the child.
+
+        The child sends the output of salvus (if given) to this process,
+        which sends it on to salvus's connection.  When the child exits,
+        callback(result, error) is called in a new thread of this process,
+        with the result of f and error=None, or with result=None and an
+        error message if f raised an exception, its result could not be
+        pickled, or the child was killed.  Since the callback may change the
+        namespace, its 'execute' listeners are called afterwards (see
+        Namespace.executed).
         """
-        if self.queue:
-            return self.queue.pop()
+        children = self._state()
+        self.wait(self.workers() - 1)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        a, b = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                a.close()
+                self._run_child(b, f, args, kwds or {}, salvus)
+            finally:
+                os._exit(0)
+        b.close()
+        children[pid] = time.time()
+        t = threading.Thread(target=self._relay, args=(pid, a, callback, salvus))
+        t.daemon = True
+        t.start()
+        return pid
+
+    def _run_child(self, sock, f, args, kwds, salvus):
+        conn = ConnectionJSON(sock)
+        if salvus is not None:
+            salvus._conn = conn
+            salvus.message_queue = ForkedMessageQueue()
+        try:
+            result = cPickle.dumps(f(*args, **kwds), cPickle.HIGHEST_PROTOCOL)
+            error = None
+        except BaseException, err:
+            error = "%s: %s"%(type(err).__name__, err)
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+        if error is None:
+            conn.send_json({'event':'fork_result'})
+            conn.send_blob(result, uuid=FORK_RESULT_UUID)
         else:
-            return self.conn.recv()
+            conn.send_json({'event':'fork_result', 'error':error})
+        sock.close()
 
-    def recv(self):
+    def _relay(self, pid, sock, callback, salvus):
+        conn = ConnectionJSON(sock)
+        result = None
+        error = "process %s exited without a result"%pid
+        try:
+            while True:
+                try:
+                    typ, mesg = conn.recv()
+                except EOFError:
+                    break
+                if typ == 'json' and mesg.get('event') == 'fork_result':
+                    error = mesg.get('error')
+                    if error is None:
+                        typ, body = conn.recv()
+                        result = cPickle.loads(body[len(FORK_RESULT_UUID):])
+                elif salvus is None:
+                    pass
+                elif typ == 'json':
+                    salvus._send_message(mesg)
+                else:
+                    salvus._conn.send_blob(buffer(mesg, 36), uuid=mesg[:36])
+        except Exception, err:
+            error = "error receiving from process %s -- %s"%(pid, err)
+        finally:
+            sock.close()
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            self._children.pop(pid, None)
+            try:
+                os.write(self._wakeup_w, 'x')
+            except OSError:
+                pass
+        try:
+            callback(result, error)
+        finally:
+            namespace.executed()
+
+fork_engine = ForkEngine()
+
+
+# Compiled modules are cached in this directory, which all sessions of the
+# project share, up to this many bytes.
+ARTIFACT_CACHE_PATH = os.path.join(os.environ['SMC'], 'artifact_cache')
+ARTIFACT_CACHE_MAX_BYTES = 512 * 2**20
+# Entries used less than this many seconds ago are not removed to make room,
+# since a session may be about to load them.
+ARTIFACT_CACHE_GRACE = 60
+
+class ArtifactCache(object):
+    """
+    Cache of compiled modules (e.g., from %cython and %fortran cells, and
+    salvus.require), keyed by a hash of the source, the compiler options
+    and the ABI of this Python, and shared by all sessions of the project.
+
+    Each entry is a directory named by its key that contains the module
+    (and any other files of the build) and a file 'module' with the name of
+    the module's file.  Entries are built in a temporary directory that is
+    then renamed, so sessions only see complete entries, and when two build
+    the same entry at once, the first one wins.  When the entries take more
+    than max_bytes, the least recently used ones are removed, except those
+    used in the last ARTIFACT_CACHE_GRACE seconds.
+    """
+    def __init__(self, path=ARTIFACT_CACHE_PATH, max_bytes=ARTIFACT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._abi = None
+
+    def __repr__(self):
+        entries = self.entries()
+        return "Artifact cache in %s with %s entries using %s bytes (at most %s)"%(
+            self.path, len(entries), sum([size for _, size, _ in entries]), self.max_bytes)
+
+    def abi(self):
+        """
+        Return a string that identifies the ABI of compiled modules.
+        """
+        if self._abi is None:
+            import platform
+            try:
+                import sage.version
+                version = sage.version.version
+            except ImportError:
+                version = ''
+            self._abi = '\n'.join([sys.version, sys.executable, str(sys.maxunicode), platform.machine(), version,
+                                   os.environ.get('CFLAGS', ''), os.environ.get('LDFLAGS', '')])
+        return self._abi
+
+    def key(self, kind, source, **options):
+        """
+        Return the key of the module of the given kind (e.g., 'cython')
+        built from source with the given options.
+        """
+        if isinstance(source, unicode):
+            source = source.encode('utf8')
+        h = hashlib.sha1()
+        for x in [kind, repr(sorted(options.items())), self.abi(), source]:
+            h.update(x)
+            h.update('\0')
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the directory of the entry with the given key, or None if
+        there is none.
+        """
+        path = os.path.join(self.path, key)
+        try:
+            os.utime(path, None)   # most recently used
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, build):
+        """
+        Call build(key, path) to write the files of the entry with the
+        given key to the empty directory path, and return the directory of
+        the entry.
+        """
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass   # another session made it
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='tmp-')
+        try:
+            build(key, tmp)
+            if not os.path.exists(os.path.join(tmp, 'module')):
+                raise RuntimeError("the build of %s did not write the name of the module"%key)
+            path = os.path.join(self.path, key)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                if not os.path.exists(path):
+                    raise
+                # another session put the same entry first
+            os.utime(path, None)   # most recently used
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return path
+
+    def lookup(self, kind, source, build, **options):
+        """
+        Return the directory of the entry for the module of the given kind
+        built from source with the given options, calling build as in put
+        if there is none.
+        """
+        key = self.key(kind, source, **options)
+        return self.get(key) or self.put(key, build)
+
+    def load(self, path):
+        """
+        Return the module in the entry with directory path, importing it
+        unless it is already imported from there.
+        """
+        import imp
+        filename = os.path.join(path, open(os.path.join(path, 'module')).read())
+        name, ext = os.path.splitext(os.path.basename(filename))
+        module = sys.modules.get(name)
+        if module is not None and os.path.dirname(getattr(module, '__file__', '')) == path:
+            return module
+        if ext == '.py':
+            return imp.load_source(name, filename)
+        return imp.load_dynamic(name, filename)
+
+    def entries(self):
+        """
+        Return a list of the entries as triples (last used time, bytes,
+        directory), least recently used first.
+        """
+        v = []
+        if os.path.exists(self.path):
+            for key in os.listdir(self.path):
+                path = os.path.join(self.path, key)
+                if key.startswith('tmp-') or not os.path.isdir(path):
+                    continue
+                try:
+                    size = sum([os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files])
+                    v.append((os.path.getmtime(path), size, path))
+                except OSError:
+                    pass   # removed by another session
+        v.sort()
+        return v
+
+    def evict(self, max_bytes=None, grace=None):
+        """
+        Remove the least recently used entries until they take at most
+        max_bytes (default: self.max_bytes), but not those used in the last
+        grace seconds (default: ARTIFACT_CACHE_GRACE), which may be about
+        to be loaded.  Modules that were loaded from removed entries keep
+        working.
+        """
+        import sage_server
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if grace is None:
+            grace = sage_server.ARTIFACT_CACHE_GRACE
+        lock = open(os.path.join(self.path, 'lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for key in os.listdir(self.path):
+                path = os.path.join(self.path, key)
+                try:
+                    if key.startswith('tmp-') and os.path.getmtime(path) < time.time() - 86400:
+                        shutil.rmtree(path, ignore_errors=True)   # left by a session that died while building
+                except OSError:
+                    pass
+            entries = self.entries()
+            total = sum([size for _, size, _ in entries])
+            recent = time.time() - grace
+            for used, size, path in entries:
+                if total <= max_bytes or used >= recent:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+        finally:
+            lock.close()
+
+    def clear(self):
         """
-        Wait until one message is received and enqueue it.
-        Also returns the mesg.
+        Remove all entries.
         """
-        mesg = self.conn.recv()
-        self.queue.insert(0,mesg)
-        return mesg
+        if os.path.exists(self.path):
+            self.evict(0, grace=0)
 
+artifact_cache = ArtifactCache()
 
 
 def session(conn):
@@ -1428,13 +2965,35 @@ def session(conn):
 
     pid = os.getpid()
 
-    # seed the random number generator(s)
-    import sage.all; sage.all.set_random_seed()
-    import random; random.seed(sage.all.initial_seed())
+    # Answered by the message reader thread, so they work while a cell is running.
+    def handle_introspect(mesg):
+        if mq.executing is None:
+            return False   # handled by the loop below, which can also evaluate code
+        return introspect(conn=conn, id=mesg['id'], line=mesg['line'], preparse=mesg['preparse'], evaluate=False)
+    mq.on('introspect', handle_introspect)
+
+    def handle_session_status(mesg):
+        executing = mq.executing
+        conn.send_json(message.session_status(id          = mesg.get('id'),
+                                              pid         = pid,
+                                              busy        = executing is not None,
+                                              execute_id  = executing[0] if executing else None,
+                                              elapsed     = time.time() - executing[1] if executing else None,
+                                              max_rss     = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                              memory      = smaps_memory()))
+    mq.on('session_status', handle_session_status)
+
+    # Pages of the logs of output beyond the limits (see OUTPUT_SPOOL), also while a cell is running.
+    def handle_output_page(mesg):
+        try:
+            page = output_spool_page(mesg['handle'], mesg.get('start', 0), mesg.get('stop'), max_size=OUTPUT_SPOOL_PAGE_SIZE)
+        except Exception, err:
+            conn.send_json(message.output_page(id=mesg.get('id'), handle=mesg.get('handle'), error=str(err)))
+        else:
+            conn.send_json(message.output_page(id=mesg.get('id'), **page))
+    mq.on('output_page', handle_output_page)
 
-    # get_memory_usage is not aware of being forked...
-    import sage.misc.getusage
-    sage.misc.getusage._proc_status = "/proc/%s/status"%os.getpid()
+    prepare_session()
 
     cnt = 0
     while True:
@@ -1442,11 +3001,13 @@ def session(conn):
             typ, mesg = mq.next_mesg()
 
             #print 'INFO:child%s: received message "%s"'%(pid, mesg)
-            log("handling message ", truncate_text(unicode8(mesg), 400)[0])
+            if not logger.quiet and logger.level <= logging.DEBUG:
+                log_debug("handling message ", truncate_text(unicode8(mesg), 400)[0])
             event = mesg['event']
             if event == 'terminate_session':
                 return
             elif event == 'execute_code':
+                mq.executing = (mesg['id'], time.time())
                 try:
                     execute(conn          = conn,
                             id            = mesg['id'],
@@ -1457,6 +3018,8 @@ def session(conn):
                             message_queue = mq)
                 except Exception, err:
                     log("ERROR -- exception raised '%s' when executing '%s'"%(err, mesg['code']))
+                finally:
+                    mq.executing = None
             elif event == 'introspect':
                 try:
                     introspect(conn=conn, id=mesg['id'], line=mesg['line'], preparse=mesg['preparse'])
@@ -1464,6 +3027,9 @@ def session(conn):
                     pass
             else:
                 raise RuntimeError("invalid message '%s'"%mesg)
+        except EOFError:
+            log("connection to the hub closed; ending session")
+            sys.exit(0)
         except:
             # When hub connection dies, loop goes crazy.
             # Unfortunately, just catching SIGINT doesn't seem to
@@ -1477,9 +3043,100 @@ def session(conn):
                 pass
 
 
-def introspect(conn, id, line, preparse):
-    salvus = Salvus(conn=conn, id=id) # so salvus.[tab] works -- note that Salvus(...) modifies namespace.
-    z = sage_parsing.introspect(line, namespace=namespace, preparse=preparse)
+_prepared_pid = None
+def prepare_session():
+    """
+    Get a newly forked process ready to run a session.  This does nothing if
+    the process is already prepared, e.g., because it waited in the SessionPool.
+    """
+    global PID, _prepared_pid
+    if _prepared_pid == os.getpid():
+        return
+    PID = _prepared_pid = os.getpid()
+
+    # seed the random number generator(s)
+    import sage.all; sage.all.set_random_seed()
+    import random; random.seed(sage.all.initial_seed())
+
+    # get_memory_usage is not aware of being forked...
+    import sage.misc.getusage
+    sage.misc.getusage._proc_status = "/proc/%s/status"%os.getpid()
+
+    if PREIMPORT_GC == 'limit':
+        gc.set_threshold(*PREIMPORT_GC_THRESHOLD)
+        gc.enable()
+
+# Opt-in copy-on-write friendly handling of the preimported library by the cyclic garbage
+# collector (set with --preimport_gc).  Collecting touches every tracked object, so each
+# session would copy the pages of the preimported library that it shares with the server.
+#
+#    None      -- collect as usual
+#    'limit'   -- do a full collection before forking sessions, never collect in the server,
+#                 and in sessions do full collections (of the long-lived generation, which holds
+#                 the preimported objects) much less often; see PREIMPORT_GC_THRESHOLD
+#    'disable' -- as 'limit', but sessions do not collect cyclic garbage at all (unless the
+#                 user calls gc.collect())
+PREIMPORT_GC = None
+PREIMPORT_GC_THRESHOLD = (700, 10, 1000)   # see gc.set_threshold; the default is (700, 10, 10)
+
+def collect_preimported():
+    """
+    Called by the server once the library is imported: if PREIMPORT_GC is set,
+    do a full collection now and disable the cyclic garbage collector, so the
+    server never touches the preimported objects again (see prepare_session
+    for what sessions do).
+    """
+    if PREIMPORT_GC:
+        tm = time.time()
+        n = gc.collect()
+        gc.disable()
+        log("collected %s objects in %s seconds before forking; %s objects are tracked (preimport_gc=%s)"%(
+                n, time.time() - tm, len(gc.get_objects()), PREIMPORT_GC))
+
+SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty', 'Swap')
+
+def smaps_memory(pid='self'):
+    """
+    Return a dict with the memory usage of the given process in kB, according to
+    /proc/[pid]/smaps, e.g., {'pss':..., 'private_dirty':..., 'rss':...}.  The pss
+    ("proportional set size") of a session counts the pages it shares with the
+    server and other sessions divided by the number of processes sharing them,
+    and private_dirty is the memory only it uses.  Returns {} if smaps is not
+    available.
+    """
+    path = '/proc/%s/smaps_rollup'%pid
+    if not os.path.exists(path):
+        path = '/proc/%s/smaps'%pid
+    try:
+        return parse_smaps(open(path))
+    except (IOError, ValueError):
+        return {}
+
+def parse_smaps(lines):
+    """
+    Return the totals in kB of the SMAPS_FIELDS in the given lines of an
+    smaps file, as in smaps_memory.
+    """
+    usage = dict([(k.lower(), 0) for k in SMAPS_FIELDS])
+    for line in lines:
+        k, _, v = line.partition(':')
+        if k in SMAPS_FIELDS:
+            usage[k.lower()] += int(v.split()[0])
+    return usage
+
+def introspect(conn, id, line, preparse, evaluate=True):
+    """
+    Send the result of introspecting line to the client, and return True.
+    If evaluate is False, no code is evaluated (see sage_parsing.introspect)
+    and nothing is sent if that makes it impossible to answer; then False is
+    returned.
+    """
+    if evaluate:
+        salvus = Salvus(conn=conn, id=id) # so salvus.[tab] works -- note that Salvus(...) modifies namespace.
+    z = sage_parsing.introspect(line, namespace=namespace, preparse=preparse, evaluate=evaluate,
+                                index=completion_index)
+    if z is None:
+        return False
     if z['get_completions']:
         mesg = message.introspect_completions(id=id, completions=z['result'], target=z['target'])
     elif z['get_help']:
@@ -1487,6 +3144,7 @@ def introspect(conn, id, line, preparse):
     elif z['get_source']:
         mesg = message.introspect_source_code(id=id, source_code=z['result'], target=z['expr'])
     conn.send_json(mesg)
+    return True
 
 def handle_session_term(signum, frame):
     while True:
@@ -1564,22 +3222,230 @@ def serve_connection(conn):
     conn.send_json(desc)
     session(conn=conn)
 
-def serve(port, host, extra_imports=False):
+# Number of session processes that are forked in advance and wait for the server to
+# hand them a connection; 0 = fork a process for each connection after accepting it.
+SESSION_POOL_SIZE = 2
+# The pool is refilled once no new connection came in for this many seconds.
+SESSION_POOL_REFILL_DELAY = .5
+
+class ServerStats(object):
+    """
+    Counters describing the server process, which serve() writes as JSON to
+    its statsfile (if one is given) whenever they change.
+    """
+    def __init__(self):
+        self.sessions = 0           # sessions currently running
+        self.accepted = 0           # connections accepted
+        self.ended = 0              # sessions that ended
+        self.wakeups = 0            # times the server loop woke up
+        self.backlog = 0            # connections that were waiting when the server last accepted
+        self.backlog_max = 0
+        self.forks = 0              # forks done by the server
+        self.fork_seconds = 0.0     # total and maximum time the server spent forking
+        self.fork_seconds_max = 0.0
+
+    def fork(self):
+        """
+        Fork the server like os.fork, timing it.
+        """
+        t = time.time()
+        pid = os.fork()
+        if pid:
+            t = time.time() - t
+            self.forks += 1
+            self.fork_seconds += t
+            self.fork_seconds_max = max(self.fork_seconds_max, t)
+        return pid
+
+    def accepted_backlog(self, n):
+        self.accepted += n
+        self.backlog = n
+        self.backlog_max = max(self.backlog_max, n)
+
+    def to_json(self):
+        return {'pid'             : os.getpid(),
+                'sessions'        : self.sessions,
+                'accepted'        : self.accepted,
+                'ended'           : self.ended,
+                'wakeups'         : self.wakeups,
+                'backlog'         : self.backlog,
+                'backlog_max'     : self.backlog_max,
+                'forks'           : self.forks,
+                'fork_ms_mean'    : 1000*self.fork_seconds/self.forks if self.forks else 0,
+                'fork_ms_max'     : 1000*self.fork_seconds_max}
+
+    def save(self, filename):
+        tmp = filename + '.tmp'
+        open(tmp, 'w').write(json.dumps(self.to_json()))
+        os.rename(tmp, filename)
+
+server_stats = ServerStats()
+
+# File descriptors of the server loop (see serve_sessions), including the connections of
+# the running sessions, which forked session processes close.
+_server_fds = []
+
+def init_session_process():
+    """
+    Undo the server loop setup in a newly forked session process, in
+    particular its SIGCHLD handler, which breaks pexpect.
+    """
+    if _server_fds:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in _server_fds:
+            os.close(fd)
+        del _server_fds[:]
+
+def serve_connection_and_exit(conn):
+    """
+    Serve the connection in a forked session process, then exit it.
+    """
+    status = 0
+    try:
+        serve_connection(conn)
+    except SystemExit:
+        pass
+    except:
+        status = 1
+        log("session process %s: %s"%(os.getpid(), traceback.format_exc()))
+    finally:
+        logger.flush()
+        os._exit(status)
+
+class SessionPool(object):
+    """
+    Processes that are forked and prepared (see prepare_session) in advance,
+    each waiting on a unix socket for the server to pass it an accepted
+    connection (SCM_RIGHTS file descriptor passing), so that a new session
+    does not have to wait for a fork.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._workers = collections.deque()   # (pid, unix socket) of the idle workers
+
+    def __len__(self):
+        return len(self._workers)
+
+    def fill(self):
+        """
+        Fork workers until there are self.size idle ones.
+        """
+        while len(self._workers) < self.size:
+            a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            pid = server_stats.fork()
+            if pid:
+                b.close()
+                self._workers.append((pid, a))
+            else:
+                a.close()
+                for _, sock in self._workers:
+                    sock.close()
+                self._workers.clear()
+                self._work(b)
+
+    def _work(self, sock):
+        # runs in the forked worker; never returns
+        try:
+            init_session_process()
+            prepare_session()
+            try:
+                fd = _multiprocessing.recvfd(sock.fileno())
+            except Exception:
+                # the server closed the socket, e.g., because it exited
+                os._exit(0)
+            sock.close()
+            conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            os.close(fd)
+            log("pooled session process %s got a connection"%PID)
+        except:
+            log("pooled session process %s: %s"%(os.getpid(), traceback.format_exc()))
+            logger.flush()
+            os._exit(1)
+        serve_connection_and_exit(conn)
+
+    def handoff(self, conn):
+        """
+        Pass the connection to an idle worker and return its pid, or return
+        None if there is no idle worker.
+        """
+        while self._workers:
+            pid, sock = self._workers.popleft()
+            try:
+                _multiprocessing.sendfd(sock.fileno(), conn.fileno())
+                return pid
+            except Exception, err:
+                log("pooled session process %s is gone (%s)"%(pid, err))
+            finally:
+                sock.close()
+        return None
+
+    def exited(self, pid):
+        """
+        Forget the worker with the given pid, which exited while idle.
+        """
+        for worker in self._workers:
+            if worker[0] == pid:
+                log("pooled session process %s terminated"%pid)
+                worker[1].close()
+                self._workers.remove(worker)
+                return
+
+# Modules (top-level names, e.g., 'pylab') that the server does not import when initializing
+# the library, but puts in the namespace as a LazyModule, which imports the module when the
+# worksheet first uses it (set with --lazy_imports).  This makes starting the server faster
+# and the server smaller, but each session that uses such a module then imports it itself.
+# Note that sage_salvus only adapts matplotlib to worksheets once it is imported, so a lazy
+# pylab also defers matplotlib, unless the Sage library imports it anyway.  Listed modules
+# that the server would not import at all (e.g., 'scipy', unless extra_imports is set) are
+# just made available without an import statement.
+LAZY_IMPORTS = []
+
+# If set, the cumulative time it took to import each module when starting the server, i.e.,
+# importing this module, sage_salvus and the Sage library, and initializing the library, is
+# written to this file (set with --import_profile; see ImportProfiler).  If the server is
+# started by calling serve from another module, only the imports of initializing the
+# library are timed.
+IMPORT_PROFILE = ''
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for the module with the given name, which imports the module on
+    first attribute access and then replaces itself by it in namespace.
+    """
+    def __init__(self, name, namespace=None):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_lazy_namespace'] = namespace
+
+    def _lazy_load(self):
+        module = importlib.import_module(self.__name__)
+        if not self.__dict__.get('_lazy_loaded'):
+            log("lazily imported %s"%self.__name__)
+            self.__dict__.update(module.__dict__)
+            self.__dict__['_lazy_loaded'] = True
+            namespace = self.__dict__['_lazy_namespace']
+            if namespace is not None and namespace.get(self.__name__) is self:
+                dict.__setitem__(namespace, self.__name__, module)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_load(), name, value)
+        self.__dict__[name] = value
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+def serve(port, host, extra_imports=False, pool_size=None, statsfile=''):
     #log.info('opening connection on port %s', port)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # check for children that have finished every few seconds, so
-    # we don't end up with zombies.
-    s.settimeout(5)
-
     s.bind((host, port))
     log('Sage server %s:%s'%(host, port))
 
-    # Enabling the following signal completely breaks subprocess pexpect in many cases, which is
-    # obviously totally unacceptable.
-    #signal.signal(signal.SIGCHLD, handle_session_term)
-
     def init_library():
         tm = time.time()
         log("pre-importing the sage library...")
@@ -1622,11 +3488,14 @@ def serve(port, host, extra_imports=False):
                     'integrate(sin(x**2),x)'])
         tm0 = time.time()
         for cmd in cmds:
+            if cmd.startswith('import ') and cmd[len('import '):] in LAZY_IMPORTS:
+                continue
             log(cmd)
             exec cmd in namespace
-
-        global pylab
-        pylab = namespace['pylab']     # used for clearing
+        for name in LAZY_IMPORTS:
+            if name not in namespace:
+                log("lazy import %s"%name)
+                namespace[name] = LazyModule(name, namespace)
 
         log('imported sage library and other components in %s seconds'%(time.time() - tm))
 
@@ -1636,8 +3505,8 @@ def serve(port, host, extra_imports=False):
         namespace['_salvus_parsing'] = sage_parsing
 
         for name in ['coffeescript', 'javascript', 'time', 'timeit', 'capture', 'cython',
-                     'script', 'python', 'python3', 'perl', 'ruby', 'sh', 'prun', 'show', 'auto',
-                     'hide', 'hideall', 'cell', 'fork', 'exercise', 'dynamic', 'var',
+                     'script', 'python', 'python3', 'perl', 'ruby', 'language_kernel', 'sh', 'prun', 'show', 'auto',
+                     'hide', 'hideall', 'cell', 'fork', 'parallel_map', 'exercise', 'dynamic', 'var',
                      'reset', 'restore', 'md', 'load', 'runfile', 'typeset_mode', 'default_mode',
                      'sage_chat', 'fortran', 'magics', 'go', 'julia', 'pandoc', 'wiki', 'plot3d_using_matplotlib',
                      'mediawiki', 'help', 'raw_input', 'clear', 'delete_last_output', 'sage_eval']:
@@ -1660,46 +3529,143 @@ def serve(port, host, extra_imports=False):
         namespace['__SAGEWS__'] = True
 
     log("Initialize sage library.")
-    init_library()
+    global _import_profiler
+    profiler, _import_profiler = _import_profiler, None
+    if profiler is None and IMPORT_PROFILE:
+        profiler = ImportProfiler().start()
+    try:
+        init_library()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    if IMPORT_PROFILE:
+        open(IMPORT_PROFILE, 'w').write(profiler.report())
+        log("wrote import times to '%s'"%IMPORT_PROFILE)
+    log("server max rss after initializing the library: %s kB"%resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
-    t = time.time()
+    collect_preimported()
+
+    serve_sessions(s, pool_size=pool_size, statsfile=statsfile)
+
+def serve_sessions(s, pool_size=None, statsfile=''):
+    """
+    Listen on the bound socket s and serve each connection in a session process,
+    forked for it or taken from a SessionPool of pool_size processes, until an
+    error occurs; then close s.  The ServerStats are written to statsfile.
+    """
     s.listen(128)
-    i = 0
+    s.setblocking(0)
+
+    # The server sleeps in select until a connection comes in or a child exits.  The SIGCHLD
+    # handler does nothing, but Python writes to the wakeup pipe whenever a signal arrives.
+    # Forked session processes restore the default handler (see init_session_process), since
+    # a SIGCHLD handler completely breaks subprocess pexpect in many cases.
+    wakeup_r, wakeup_w = os.pipe()
+    for fd in (wakeup_r, wakeup_w):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    _server_fds[:] = [s.fileno(), wakeup_r, wakeup_w]
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)
+    signal.set_wakeup_fd(wakeup_w)
+
+    if pool_size is None:
+        pool_size = SESSION_POOL_SIZE
+    pool = SessionPool(pool_size) if pool_size > 0 else None
+    if pool is not None:
+        pool.fill()
+        log("forked a pool of %s session processes"%len(pool))
+    refill_time = 0
 
     children = {}
+
+    def reap():
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return  # no children
+            if not pid:
+                return
+            if pid in children:
+                log("subprocess %s terminated, closing connection"%pid)
+                conn = children.pop(pid)
+                _server_fds.remove(conn.fileno())
+                conn.close()
+                server_stats.sessions -= 1
+                server_stats.ended += 1
+            elif pool is not None:
+                pool.exited(pid)
+
+    def start_session(conn):
+        if pool is not None:
+            child_pid = pool.handoff(conn)
+            if child_pid:
+                log("handed connection to pooled session process %s"%child_pid)
+                children[child_pid] = conn
+                _server_fds.append(conn.fileno())
+                server_stats.sessions += 1
+                return
+        child_pid = server_stats.fork()
+        if child_pid: # parent
+            log("forked off child with pid %s to handle this connection"%child_pid)
+            children[child_pid] = conn
+            _server_fds.append(conn.fileno())
+            server_stats.sessions += 1
+        else:
+            # child
+            init_session_process()
+            log("child process, will now serve this new connection")
+            serve_connection_and_exit(conn)
+
+    saved_stats = None
     log("Starting server listening for connections")
     try:
         while True:
-            i += 1
-            #print i, time.time()-t, 'cps: ', int(i/(time.time()-t))
             # do not use log.info(...) in the server loop; threads = race conditions that hang server every so often!!
+            timeout = None
+            if pool is not None and len(pool) < pool.size:
+                # refill the pool only once no connection came in for a while, so
+                # forking does not compete with sessions that are just starting
+                timeout = refill_time - time.time()
+                if timeout <= 0:
+                    pool.fill()
+                    timeout = None
+            if statsfile:
+                stats = server_stats.to_json()
+                del stats['wakeups']  # not worth writing the file for
+                if stats != saved_stats:
+                    server_stats.save(statsfile)
+                    saved_stats = stats
+
             try:
-                if children:
-                    for pid in children.keys():
-                        if os.waitpid(pid, os.WNOHANG) != (0,0):
-                            log("subprocess %s terminated, closing connection"%pid)
-                            conn.close()
-                            del children[pid]
+                ready = select.select([s, wakeup_r], [], [], timeout)[0]
+            except select.error as (errno, msg):
+                if errno != 4:
+                    raise
+                continue
+            server_stats.wakeups += 1
 
+            if wakeup_r in ready:
                 try:
-                    conn, addr = s.accept()
+                    while os.read(wakeup_r, 4096):
+                        pass
+                except OSError:
+                    pass  # empty
+            reap()
+
+            if s in ready:
+                n = 0
+                while True:
+                    try:
+                        conn, addr = s.accept()
+                    except socket.error:
+                        break  # no more waiting connections
+                    n += 1
+                    conn.setblocking(1)
                     log("Accepted a connection from", addr)
-                except:
-                    # this will happen periodically since we did s.settimeout above, so
-                    # that we wait for children above periodically.
-                    continue
-            except socket.error, msg:
-                continue
-            child_pid = os.fork()
-            if child_pid: # parent
-                log("forked off child with pid %s to handle this connection"%child_pid)
-                children[child_pid] = conn
-            else:
-                # child
-                global PID
-                PID = os.getpid()
-                log("child process, will now serve this new connection")
-                serve_connection(conn)
+                    start_session(conn)
+                server_stats.accepted_backlog(n)
+                refill_time = time.time() + SESSION_POOL_REFILL_DELAY
 
         # end while
     except Exception, err:
@@ -1712,7 +3678,7 @@ def serve(port, host, extra_imports=False):
         #s.shutdown(0)
         s.close()
 
-def run_server(port, host, pidfile, logfile=None):
+def run_server(port, host, pidfile, logfile=None, pool_size=None, statsfile=''):
     global LOGFILE
     if logfile:
         LOGFILE = logfile
@@ -1720,7 +3686,7 @@ def run_server(port, host, pidfile, logfile=None):
         open(pidfile,'w').write(str(os.getpid()))
     log("run_server: port=%s, host=%s, pidfile='%s', logfile='%s'"%(port, host, pidfile, LOGFILE))
     try:
-        serve(port, host)
+        serve(port, host, pool_size=pool_size, statsfile=statsfile)
     finally:
         if pidfile:
             os.unlink(pidfile)
@@ -1730,8 +3696,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run Sage server")
     parser.add_argument("-p", dest="port", type=int, default=0,
                         help="port to listen on (default: 0); 0 = automatically allocated; saved to $SMC/data/sage_server.port")
-    parser.add_argument("-l", dest='log_level', type=str, default='INFO',
-                        help="log level (default: INFO) useful options include WARNING and DEBUG")
+    parser.add_argument("-l", dest='log_level', type=str, default='DEBUG',
+                        help="log level (default: DEBUG, which logs the messages sent and received, "
+                             "unlike INFO) useful options include INFO and WARNING")
     parser.add_argument("-d", dest="daemon", default=False, action="store_const", const=True,
                         help="daemon mode (default: False)")
     parser.add_argument("--host", dest="host", type=str, default='127.0.0.1',
@@ -1746,6 +3713,17 @@ if __name__ == "__main__":
                         help="hostname to connect to in client mode")
     parser.add_argument("--portfile", dest="portfile", type=str, default='',
                         help="write port to this file")
+    parser.add_argument("--pool_size", dest="pool_size", type=int, default=SESSION_POOL_SIZE,
+                        help="number of session processes to fork in advance (default: %s)"%SESSION_POOL_SIZE)
+    parser.add_argument("--statsfile", dest="statsfile", type=str, default='',
+                        help="keep server statistics (sessions, fork times, accept backlog) as JSON in this file")
+    parser.add_argument("--preimport_gc", dest="preimport_gc", choices=['limit', 'disable'], default=None,
+                        help="garbage collect before forking sessions and limit or disable full collections "
+                             "in sessions, so they share more memory with the server (default: collect as usual)")
+    parser.add_argument("--lazy_imports", dest="lazy_imports", type=str, default='',
+                        help="comma separated modules (e.g., pylab,scipy) to import only when a worksheet uses them")
+    parser.add_argument("--import_profile", dest="import_profile", type=str, default='',
+                        help="write the time it takes to import each module when starting the server to this file")
 
     args = parser.parse_args()
 
@@ -1754,9 +3732,11 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if args.log_level:
-        pass
-        #level = getattr(logging, args.log_level.upper())
-        #log.setLevel(level)
+        logger.level = getattr(logging, args.log_level.upper())
+
+    PREIMPORT_GC = args.preimport_gc
+    LAZY_IMPORTS = [name for name in args.lazy_imports.split(',') if name]
+    IMPORT_PROFILE = os.path.abspath(args.import_profile) if args.import_profile else ''
 
     if args.client:
         client1(port=args.port if args.port else int(open(args.portfile).read()), hostname=args.hostname)
@@ -1777,7 +3757,8 @@ if __name__ == "__main__":
         open(LOGFILE, 'w')  # for now we clear it on restart...
         log("setting logfile to %s"%LOGFILE)
 
-    main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile)
+    statsfile = os.path.abspath(args.statsfile) if args.statsfile else ''
+    main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile, pool_size=args.pool_size, statsfile=statsfile)
     if args.daemon and args.pidfile:
         import daemon
         daemon.daemonize(args.pidfile)
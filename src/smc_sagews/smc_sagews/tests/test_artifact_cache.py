@@ -0,0 +1,97 @@
+import os, shutil, tempfile, time
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+def builder(data, calls=None):
+    def build(key, path):
+        if calls is not None:
+            calls.append(key)
+        open(os.path.join(path, 'm.py'), 'w').write(data)
+        open(os.path.join(path, 'module'), 'w').write('m.py')
+    return build
+
+
+class TestArtifactCache(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = sage_server.ArtifactCache(path=os.path.join(self.tmp, 'cache'), max_bytes=100)
+        self.cache._abi = 'test'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def age(self, path, seconds):
+        t = time.time() - seconds
+        os.utime(path, (t, t))
+
+    def test_lookup(self):
+        calls = []
+        path = self.cache.lookup('python', 'x = 1', builder('x = 1\n', calls), opt=1)
+        self.assertEqual(self.cache.lookup('python', 'x = 1', builder('x = 1\n', calls), opt=1), path)
+        self.assertEqual(len(calls), 1)
+        self.assertNotEqual(self.cache.key('python', 'x = 1', opt=2), self.cache.key('python', 'x = 1', opt=1))
+        self.assertEqual(self.cache.key('python', u'x = 1'), self.cache.key('python', 'x = 1'))
+        self.assertEqual(self.cache.load(path).x, 1)
+        self.assertEqual(self.cache.get('missing'), None)
+
+    def test_put_race(self):
+        # another session puts the same entry while this one builds it: the first one wins
+        key = self.cache.key('python', 'x = 1')
+        def build(key, path):
+            self.cache.put(key, builder('first'))
+            builder('second')(key, path)
+        path = self.cache.put(key, build)
+        self.assertEqual(open(os.path.join(path, 'm.py')).read(), 'first')
+        self.assertEqual([p for p in os.listdir(self.cache.path) if p.startswith('tmp-')], [])
+
+    def test_failed_build(self):
+        self.assertRaises(RuntimeError, self.cache.put, 'key', lambda key, path: None)
+        self.assertEqual(self.cache.entries(), [])
+        self.assertEqual([p for p in os.listdir(self.cache.path) if p.startswith('tmp-')], [])
+
+    def test_evict(self):
+        a = self.cache.put('a', builder('a' * 40))
+        b = self.cache.put('b', builder('b' * 40))
+        self.age(a, 200)
+        self.age(b, 100)
+        c = self.cache.put('c', builder('c' * 40))   # over max_bytes, so the least recently used goes
+        self.assertEqual([path for _, _, path in self.cache.entries()], [b, c])
+        self.assertTrue(self.cache.get(b))   # now the most recently used
+        self.cache.evict(50)
+        self.assertEqual([path for _, _, path in self.cache.entries()], [c, b])   # recently used entries stay
+        self.cache.evict(50, grace=0)
+        self.assertEqual([path for _, _, path in self.cache.entries()], [b])
+
+    def test_put_large_entry(self):
+        # an entry larger than max_bytes is not removed before it is loaded
+        path = self.cache.put('big', builder('x = 1\n' + '#' * 200))
+        self.assertEqual(self.cache.load(path).x, 1)
+
+    def test_stale_builds(self):
+        os.makedirs(self.cache.path)
+        stale = tempfile.mkdtemp(dir=self.cache.path, prefix='tmp-')
+        building = tempfile.mkdtemp(dir=self.cache.path, prefix='tmp-')
+        self.age(stale, 2 * 86400)
+        self.cache.evict()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(building))
+
+    def test_clear(self):
+        self.cache.put('a', builder('a'))
+        self.cache.clear()
+        self.assertEqual(self.cache.entries(), [])
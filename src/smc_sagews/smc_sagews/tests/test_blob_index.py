@@ -0,0 +1,92 @@
+import os, socket, tempfile, time
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestBlobIndex(TestCase):
+    def test_ack(self):
+        index = sage_server.BlobIndex(maxsize=2)
+        self.assertEqual(index.ttl('a'), None)
+        index.sent('a', 'a.png')
+        self.assertEqual(index.ack({'sha1':'a', 'ttl':0}), 'a.png')
+        self.assertEqual(index.pending, {})
+        self.assertEqual(index.ttl('a'), 0)
+        self.assertEqual((index.hits, index.misses), (1, 1))
+
+    def test_expiring_ttl(self):
+        index = sage_server.BlobIndex()
+        index.sent('a')
+        index.ack({'sha1':'a', 'ttl':sage_server.BLOB_TTL_MARGIN + 100})
+        self.assertTrue(0 < index.ttl('a') <= 100 + sage_server.BLOB_TTL_MARGIN)
+        index.sent('b')
+        index.ack({'sha1':'b', 'ttl':sage_server.BLOB_TTL_MARGIN - 1})
+        self.assertEqual(index.ttl('b'), None)   # sent again, since it is about to expire
+
+    def test_error(self):
+        index = sage_server.BlobIndex()
+        index.sent('a')
+        index.ack({'sha1':'a', 'error':'failed'})
+        self.assertEqual(index.ttl('a'), None)
+
+    def test_eviction(self):
+        index = sage_server.BlobIndex(maxsize=2)
+        for uuid in 'abc':
+            index.sent(uuid)
+            index.ack({'sha1':uuid})
+        self.assertEqual(index.ttl('a'), None)
+        self.assertEqual(index.ttl('c'), 0)
+
+
+class TestBlobAcks(TestCase):
+    def setUp(self):
+        a, self.hub = socket.socketpair()
+        self.hub = sage_server.ConnectionJSON(self.hub)
+        self.mq = sage_server.MessageQueue(sage_server.ConnectionJSON(a))
+        self.timeout = sage_server.BLOB_ACK_TIMEOUT
+
+    def tearDown(self):
+        sage_server.BLOB_ACK_TIMEOUT = self.timeout
+        sage_server.blob_index.pending.clear()
+        self.hub.close()
+
+    def test_recv(self):
+        self.hub.send_json({'event':'save_blob', 'sha1':'a', 'ttl':5})
+        self.hub.send_json({'event':'save_blob', 'sha1':'b'})
+        self.assertEqual(self.mq.recv_blob_ack('b')['sha1'], 'b')
+        self.assertEqual(self.mq.recv_blob_ack()['sha1'], 'a')
+        self.assertEqual(self.mq.recv_blob_ack(timeout=.05), None)
+
+    def test_unmatched_acks_are_dropped(self):
+        sage_server.BLOB_ACK_TIMEOUT = .05
+        self.hub.send_json({'event':'save_blob', 'sha1':'a'})
+        time.sleep(.1)
+        self.hub.send_json({'event':'save_blob', 'sha1':'b'})
+        self.assertEqual(self.mq.recv_blob_ack('b')['sha1'], 'b')
+        self.assertEqual(self.mq._acks, {})
+
+    def test_wait_for_acks_times_out(self):
+        sage_server.BLOB_ACK_TIMEOUT = .05
+        salvus = sage_server.Salvus(conn=self.mq.conn, id='x', message_queue=self.mq)
+        sage_server.blob_index.sent('a')
+        sage_server.blob_index.sent('b')
+        self.hub.send_json({'event':'save_blob', 'sha1':'other'})
+        self.hub.send_json({'event':'save_blob', 'sha1':'a'})
+        salvus._wait_for_blob_acks()
+        self.assertEqual(sage_server.blob_index.pending, {})
+        self.assertEqual(sage_server.blob_index.ttl('a'), 0)
+        sage_server.blob_index.sent('c')
+        self.assertRaises(RuntimeError, salvus._wait_for_blob_acks, uuid='c')
@@ -0,0 +1,62 @@
+import os, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestCompileCache(TestCase):
+    def test_hit(self):
+        cache = sage_server.CompileCache(maxsize=2)
+        blocks = cache.blocks("x = 1\nx", preparse=False)
+        self.assertEqual(blocks, [[0, 0, 'x = 1', None], [1, 1, 'x', None]])
+        blocks[0][3] = compile(blocks[0][2], '', 'single')
+        self.assertTrue(cache.blocks("x = 1\nx", preparse=False) is blocks)
+        self.assertEqual(cache.blocks(u"x = 1\nx", preparse=False), blocks)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_eviction(self):
+        cache = sage_server.CompileCache(maxsize=2)
+        a = cache.blocks("a", preparse=False)
+        b = cache.blocks("b", preparse=False)
+        self.assertTrue(cache.blocks("a", preparse=False) is a)   # so b is the least recently used
+        cache.blocks("c", preparse=False)
+        self.assertTrue(cache.blocks("a", preparse=False) is a)
+        self.assertFalse(cache.blocks("b", preparse=False) is b)
+
+    def test_not_cached(self):
+        cache = sage_server.CompileCache(maxsize=0)
+        self.assertFalse(cache.blocks("a", preparse=False) is cache.blocks("a", preparse=False))
+        max_code = sage_server.COMPILE_CACHE_MAX_CODE
+        sage_server.COMPILE_CACHE_MAX_CODE = 3
+        try:
+            cache = sage_server.CompileCache(maxsize=2)
+            self.assertFalse(cache.blocks("abcd", preparse=False) is cache.blocks("abcd", preparse=False))
+            self.assertEqual((cache.hits, cache.misses), (0, 0))
+        finally:
+            sage_server.COMPILE_CACHE_MAX_CODE = max_code
+
+    def test_code_decorators(self):
+        # the arguments of code decorators are part of the cached blocks
+        cache = sage_server.CompileCache()
+        block = cache.blocks("%time x = 1", preparse=False)[0][2]
+        self.assertEqual(block, "salvus.execute_with_code_decorators(*(['time '], 'x = 1'))")
+        self.assertEqual(cache.blocks("%time x = 1", preparse=False)[0][2], block)
+
+    def test_clear(self):
+        cache = sage_server.CompileCache()
+        a = cache.blocks("a", preparse=False)
+        cache.clear()
+        self.assertFalse(cache.blocks("a", preparse=False) is a)
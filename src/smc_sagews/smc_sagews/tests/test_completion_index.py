@@ -0,0 +1,111 @@
+import os, tempfile, threading
+from unittest import TestCase
+
+from smc_sagews import sage_parsing, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class A(object):
+    pass
+
+
+class TestCompletionIndex(TestCase):
+    def setUp(self):
+        self.namespace = sage_server.Namespace({'zeta':1, 'zebra':2})
+        self.index = sage_parsing.CompletionIndex(self.namespace)
+
+    def test_names(self):
+        self.assertEqual(self.index.names('ze'), ['bra', 'ta'])
+        self.assertTrue('ip' in self.index.names('z'))   # the builtin zip
+        # the namespace is only read again after code was executed in it
+        del self.namespace['zebra']
+        self.namespace['zed'] = 3
+        self.assertEqual(self.index.names('ze'), ['bra', 'ta'])
+        self.namespace.executed()
+        self.assertEqual(self.index.names('ze'), ['d', 'ta'])
+
+    def test_names_bound_elsewhere(self):
+        # e.g., by a callback in another thread; the index sees that there are more names
+        self.assertEqual(self.index.names('ze'), ['bra', 'ta'])
+        self.namespace['zed'] = 3
+        self.assertEqual(self.index.names('ze'), ['bra', 'd', 'ta'])
+
+    def test_fork_engine_callback(self):
+        # a callback of the fork engine may change objects in the session's namespace
+        namespace = sage_server.namespace
+        index = sage_parsing.CompletionIndex(namespace)
+        done = threading.Event()
+        namespace.on('execute', None, done.set)   # called after index.invalidate
+        try:
+            a = A()
+            self.assertEqual(index.attributes(a, 'zq'), [])
+            def callback(result, error):
+                a.zqx = result
+            sage_server.ForkEngine(max_workers=1).start(lambda: 1, callback)
+            self.assertTrue(done.wait(10))
+            self.assertEqual(a.zqx, 1)
+            self.assertEqual(index.attributes(a, 'zq'), ['x'])
+        finally:
+            namespace.remove('execute', None, done.set)
+            namespace.remove('execute', None, index.invalidate)
+
+    def test_not_listening(self):
+        # a plain dict cannot tell the index about changes, so it is read each time
+        namespace = {'zeta':1}
+        index = sage_parsing.CompletionIndex(namespace)
+        self.assertEqual(index.names('ze'), ['ta'])
+        namespace['zed'] = 2
+        self.assertEqual(index.names('ze'), ['d', 'ta'])
+
+    def test_attributes(self):
+        a = A()
+        a.alpha = 1
+        self.assertEqual(self.index.attributes(a, 'al'), ['pha'])
+        # the same number of attributes, so their number does not show the change
+        del a.alpha
+        a.almost = 1
+        A.alright = None
+        self.assertEqual(self.index.attributes(a, 'al'), ['pha'])
+        self.namespace.executed()
+        self.assertEqual(self.index.attributes(a, 'al'), ['most', 'right'])
+        del A.alright
+
+    def test_builtin_types(self):
+        self.assertEqual(self.index.attributes(1, 'bit_'), ['length'])
+        entry = self.index._attributes[('type', int)]
+        self.namespace.executed()
+        self.index.attributes(2, 'bit_')
+        self.assertTrue(self.index._attributes[('type', int)] is entry)
+
+    def test_cached_attributes(self):
+        a = A()
+        a.alpha = 1
+        self.assertEqual(self.index.cached_attributes(a, 'al'), None)
+        self.index.attributes(a, '')
+        self.assertEqual(self.index.cached_attributes(a, 'al'), ['pha'])
+        self.assertEqual(self.index.cached_attributes(A(), 'al'), None)
+
+    def test_maxsize(self):
+        index = sage_parsing.CompletionIndex(self.namespace, maxsize=2)
+        v = [A() for i in range(3)]
+        for a in v:
+            index.attributes(a, '')
+        self.assertEqual(index.cached_attributes(v[0], ''), None)
+        self.assertEqual(index.cached_attributes(v[2], ''), [])
+
+    def test_unregister(self):
+        self.namespace.remove('execute', None, self.index.invalidate)
+        self.assertEqual(self.namespace._on_execute, [])
+        self.assertTrue(type(self.namespace) is sage_server.Namespace)
@@ -0,0 +1,93 @@
+import os, socket, tempfile, threading
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestConnectionJSON(TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.a = sage_server.ConnectionJSON(a)
+        self.b = sage_server.ConnectionJSON(b)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_json_round_trip(self):
+        mesg = {'event':'output', 'id':'x', 'stdout':u'caf\xe9 ' * 10}
+        self.a.send_json(mesg)
+        self.assertEqual(self.b.recv(), ('json', mesg))
+
+    def test_blob_parts(self):
+        # small frames are joined and large ones sent part by part, for all kinds of parts
+        for size in [3, sage_server.FRAME_COPY_LIMIT + 1]:
+            data = 'x' * (size - 1) + 'y'
+            for blob in [data, bytearray(data), buffer('..' + data, 2), memoryview(data)]:
+                uuid = self.a.send_blob(blob)
+                self.assertEqual(uuid, sage_server.uuidsha1(data))
+                typ, body = self.b.recv()
+                self.assertEqual(typ, 'blob')
+                self.assertEqual(body, uuid + data)
+
+    def test_resend_received_blob(self):
+        self.a.send_blob('abc')
+        typ, body = self.b.recv()
+        self.assertEqual(type(body), str)
+        uuid = self.b.send_blob(buffer(body, 36), uuid=body[:36])
+        self.assertEqual(self.a.recv(), ('blob', uuid + 'abc'))
+        self.b.send_blob(bytearray('abc'))
+        self.assertEqual(self.a.recv(), ('blob', uuid + 'abc'))
+
+    def test_unicode_part(self):
+        self.assertRaises(TypeError, sage_server.join_frame_parts, ['b', bytearray('a'), u'x'])
+
+    def test_stats(self):
+        self.a.send_json({'event':'x'})
+        self.a.send_blob('z' * (sage_server.FRAME_COPY_LIMIT + 1))
+        stats = self.a.stats()
+        self.assertEqual(stats['frames'], 2)
+        self.assertEqual(stats['syscalls'], 3)
+        self.b.recv()
+        self.b.recv()
+
+    def test_send_file(self):
+        import tempfile
+        f = tempfile.NamedTemporaryFile()
+        data = 'abc' * (sage_server.FILE_CHUNK_SIZE // 2)
+        f.write(data)
+        f.flush()
+        uuid = sage_server.uuidsha1(data)
+        self.assertEqual(sage_server.uuidsha1_file(f.name), uuid)
+        received = []
+        reader = threading.Thread(target=lambda: received.append(self.b.recv()))
+        reader.start()
+        self.assertEqual(self.a.send_file(f.name), uuid)
+        reader.join()
+        self.assertEqual(received[0][1], uuid + data)
+
+    def test_send_changed_file(self):
+        # the file changed after it was hashed, so the uuid does not match what is
+        # streamed: the file is hashed and sent again
+        import tempfile
+        f = tempfile.NamedTemporaryFile()
+        f.write('new')
+        f.flush()
+        stale = sage_server.uuidsha1('old')
+        uuid = self.a.send_file(f.name, uuid=stale)
+        self.assertEqual(uuid, sage_server.uuidsha1('new'))
+        self.assertEqual(self.b.recv()[1], stale + 'new')
+        self.assertEqual(self.b.recv()[1], uuid + 'new')
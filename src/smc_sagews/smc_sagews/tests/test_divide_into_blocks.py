@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from smc_sagews import sage_parsing
+
+# Cells, and their blocks as divided by the splitter before it used tokenize
+# (which went backwards counting parentheses).
+OLD_BLOCKS = [
+    ("2+2", [[0, 0, '2+2']]),
+    ("x = 1\ny = 2\nx + y", [[0, 0, 'x = 1'], [1, 1, 'y = 2'], [2, 2, 'x + y']]),
+    ("def f(x):\n    return x\n\nf(2)", [[0, 1, 'def f(x):\n    return x'], [2, 2, 'f(2)']]),
+    ("try:\n    1/0\nexcept ZeroDivisionError:\n    pass\nfinally:\n    x = 1\nprint x",
+     [[0, 5, 'try:\n    1/0\nexcept ZeroDivisionError:\n    pass\nfinally:\n    x = 1'], [6, 6, 'print x']]),
+    ("if x:\n    a = 1\nelif y:\n    a = 2\nelse:\n    a = 3\na",
+     [[0, 5, 'if x:\n    a = 1\nelif y:\n    a = 2\nelse:\n    a = 3'], [6, 6, 'a']]),
+    ("for i in range(3):\n    print i\nelse:\n    print 'done'",
+     [[0, 3, "for i in range(3):\n    print i\nelse:\n    print 'done'"]]),
+    ("@cached\ndef f():\n    pass\nf()", [[0, 2, '@cached\ndef f():\n    pass'], [3, 3, 'f()']]),
+    ("v = [1,\n2,\n3]\nw = {'a':\n1}\nf(1,\n  2)",
+     [[0, 2, 'v = [1,\n2,\n3]'], [3, 4, "w = {'a':\n1}"], [5, 6, 'f(1,\n  2)']]),
+    ("s = '''a\nb\nc'''\nt = 1  # comment\n# a comment line\nt",
+     [[0, 0, "s = '''a\nb\nc'''"], [1, 2, 't = 1'], [3, 3, 't']]),
+    ("x = 1;  y = 2\nx = (1 +\n     2) * \\\n    3", [[0, 0, 'x = 1;  y = 2'], [1, 3, 'x = (1 +\n     2) * \\\n    3']]),
+    ("\n\n  \nx = 1\n\n", [[0, 0, 'x = 1']]),
+]
+
+
+class TestDivideIntoBlocks(TestCase):
+    def test_same_as_old_splitter(self):
+        for code, blocks in OLD_BLOCKS:
+            self.assertEqual(sage_parsing.divide_into_blocks(code), blocks)
+
+    def test_merged_clauses(self):
+        # which the old splitter did not merge
+        self.assertEqual(sage_parsing.divide_into_blocks("try:\n    x\nexcept:\n    y\nelse:\n    z"),
+                         [[0, 5, 'try:\n    x\nexcept:\n    y\nelse:\n    z']])
+        self.assertEqual(sage_parsing.divide_into_blocks("@dec\nclass A:\n    pass"),
+                         [[0, 2, '@dec\nclass A:\n    pass']])
+
+    def test_unbalanced(self):
+        # cannot be tokenized, so the blocks are found by counting parentheses
+        self.assertEqual(sage_parsing.divide_into_blocks("f(1,\n2))\nx = 1"),
+                         [[0, 0, 'f(1,'], [1, 1, '2))'], [2, 2, 'x = 1']])
+        self.assertEqual(sage_parsing.block_starts_by_counting(["f(1,", " 2)", "x = (", "1"]), [0, 2, 3])
+
+    def test_block_starts(self):
+        self.assertEqual(sage_parsing.block_starts(["def f():", "    return (1,", "2)", "%(L0)s", "f()"]), [0, 4])
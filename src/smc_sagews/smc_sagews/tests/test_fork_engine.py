@@ -0,0 +1,69 @@
+import os, socket, tempfile, threading
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class Cell(object):
+    # the parts of Salvus that the fork engine uses
+    def __init__(self, conn):
+        self._conn = conn
+    def _send_message(self, mesg):
+        return self._conn.send_json(mesg)
+
+
+class TestForkEngine(TestCase):
+    def setUp(self):
+        self.engine = sage_server.ForkEngine(max_workers=2)
+        self.done = threading.Event()
+
+    def run_child(self, f, salvus=None):
+        results = []
+        self.done.clear()
+        def callback(result, error):
+            results.append((result, error))
+            self.done.set()
+        self.engine.start(f, callback, salvus=salvus)
+        self.done.wait(10)
+        self.assertEqual(self.engine.children(), [])
+        return results[0]
+
+    def test_result(self):
+        self.assertEqual(self.run_child(lambda: {'x':6*7}), ({'x':42}, None))
+
+    def test_error(self):
+        def f():
+            raise ValueError("bad")
+        self.assertEqual(self.run_child(f), (None, 'ValueError: bad'))
+        result, error = self.run_child(lambda: lambda: None)   # cannot be pickled
+        self.assertEqual(result, None)
+        self.assertTrue(error.startswith('PicklingError'))
+
+    def test_relay(self):
+        # the output of the child, including blobs, is sent on to the connection of the cell
+        a, b = socket.socketpair()
+        hub = sage_server.ConnectionJSON(b)
+        cell = Cell(sage_server.ConnectionJSON(a))
+        blob = 'x' * (sage_server.FRAME_COPY_LIMIT + 1)
+        def f():
+            cell._conn.send_json({'event':'output', 'stdout':'plot:'})
+            return cell._conn.send_blob(blob)
+        uuid, error = self.run_child(f, salvus=cell)
+        self.assertEqual((uuid, error), (sage_server.uuidsha1(blob), None))
+        self.assertEqual(hub.recv(), ('json', {'event':'output', 'stdout':'plot:'}))
+        self.assertEqual(hub.recv(), ('blob', uuid + blob))
+        a.close()
+        b.close()
@@ -0,0 +1,162 @@
+import os, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+def output(**kwds):
+    mesg = {'event':'output', 'id':'cell'}
+    mesg.update(kwds)
+    return mesg
+
+DONE = output(done=True)
+
+
+class Cell(object):
+    _output_hashes = None
+
+
+class Salvus(object):
+    # what InteractCell uses of the Salvus object of the cell that runs
+    _output_filter = None
+
+
+class TestInteractOutput(TestCase):
+    def update(self, cell, messages):
+        # the messages that are sent in an update of the interact
+        f = sage_salvus.InteractOutput(cell)
+        return [mesg for mesg in [f(dict(m)) for m in messages] if mesg is not None]
+
+    def test_first(self):
+        cell = Cell()
+        messages = [output(stdout='a'), output(html='<b>b</b>'), DONE]
+        self.assertEqual(self.update(cell, messages), messages)
+        self.assertEqual(len(cell._output_hashes), 2)   # the done message has no content
+
+    def test_unchanged(self):
+        cell = Cell()
+        messages = [output(stdout='a'), output(stdout='b'), DONE]
+        self.update(cell, messages)
+        hashes = cell._output_hashes
+        self.assertEqual(self.update(cell, messages), [output(done=True, interact_keep=[0, 2])])
+        self.assertEqual(cell._output_hashes, hashes)
+
+    def test_changed(self):
+        cell = Cell()
+        self.update(cell, [output(stdout='a'), output(stdout='b'), output(stdout='c'), DONE])
+        # the kept range is sent with the next message that is sent
+        self.assertEqual(self.update(cell, [output(stdout='a'), output(stdout='x'), output(stdout='c'), DONE]),
+                         [output(stdout='x', interact_keep=[0, 1]), output(done=True, interact_keep=[2, 3])])
+
+    def test_position(self):
+        # output is only kept if it is at the same position as last time
+        cell = Cell()
+        self.update(cell, [output(stdout='a'), output(stdout='b'), DONE])
+        messages = [output(stdout='b'), output(stdout='a'), DONE]
+        self.assertEqual(self.update(cell, messages), messages)
+        self.assertEqual(self.update(cell, [output(stdout='b'), DONE]),
+                         [output(done=True, interact_keep=[0, 1])])
+        self.assertEqual(len(cell._output_hashes), 1)
+
+    def test_done_with_content(self):
+        cell = Cell()
+        self.update(cell, [output(stdout='a', done=True)])
+        self.assertEqual(self.update(cell, [output(stdout='a', done=True)]),
+                         [output(done=True, interact_keep=[0, 1])])
+
+    def test_always_sent(self):
+        # javascript, etc., is sent every time, and ends the kept range before it
+        cell = Cell()
+        messages = [output(stdout='a'), output(javascript={'code':'f()'}), output(stdout='b'), DONE]
+        self.update(cell, messages)
+        self.assertEqual(cell._output_hashes[1], None)
+        self.assertEqual(self.update(cell, messages),
+                         [output(javascript={'code':'f()'}, interact_keep=[0, 1]),
+                          output(done=True, interact_keep=[2, 3])])
+
+    def test_keep_all(self):
+        cell = Cell()
+        self.update(cell, [output(stdout='a'), output(stdout='b'), DONE])
+        hashes = cell._output_hashes
+        f = sage_salvus.InteractOutput(cell)
+        f.keep_all()
+        self.assertEqual(f(output(done=True)), output(done=True, interact_keep=[0, 2]))
+        self.assertEqual(cell._output_hashes, hashes)
+
+    def test_keep_all_first(self):
+        # nothing to keep before the first update
+        f = sage_salvus.InteractOutput(Cell())
+        f.keep_all()
+        self.assertEqual(f(output(done=True)), DONE)
+
+
+class TestIncrementalInteract(TestCase):
+    def setUp(self):
+        self.salvus = sage_salvus.salvus
+        self.calls = []
+
+    def tearDown(self):
+        sage_salvus.salvus = self.salvus
+
+    def interact(self, **kwds):
+        def f(n='a', b=sage_salvus.button('click')):
+            self.calls.append(n)
+        return sage_salvus.InteractCell(f, **kwds)
+
+    def update(self, cell, vals, messages=()):
+        # an update of the interact in a new cell execution; returns what is sent
+        sage_salvus.salvus = salvus = Salvus()
+        cell(vals)
+        if salvus._output_filter is None:
+            return list(messages) + [DONE]
+        sent = [salvus._output_filter(dict(m)) for m in list(messages) + [DONE]]
+        return [mesg for mesg in sent if mesg is not None]
+
+    def test_unchanged(self):
+        cell = self.interact(incremental=True)
+        self.assertEqual(cell.jsonable()['incremental'], True)
+        self.update(cell, {'n':'x'}, [output(stdout='x')])
+        self.assertEqual(self.calls, ['x'])
+        # the same value again: f is not called and its output is kept
+        self.assertEqual(self.update(cell, {'n':'x'}), [output(done=True, interact_keep=[0, 1])])
+        self.assertEqual(self.calls, ['x'])
+        self.assertEqual(cell.changed, [])
+        self.update(cell, {'n':'y'}, [output(stdout='y')])
+        self.assertEqual(self.calls, ['x', 'y'])
+        self.assertEqual(cell.changed, ['n'])
+
+    def test_button(self):
+        # a button sends the same value each time it is clicked
+        cell = self.interact(incremental=True)
+        self.update(cell, {'n':'x', 'b':'click'})
+        self.update(cell, {'n':'x', 'b':'click'})
+        self.assertEqual(self.calls, ['x', 'x'])
+        self.assertEqual(cell.changed, ['b'])
+
+    def test_update_args(self):
+        cell = self.interact(incremental=True, update_args=['b'])
+        self.update(cell, {'b':'click'}, [output(stdout='a')])
+        self.assertEqual(self.update(cell, {'n':'x'}), [output(done=True, interact_keep=[0, 1])])
+        self.assertEqual(self.calls, ['a'])
+
+    def test_not_incremental(self):
+        cell = self.interact()
+        self.assertFalse('incremental' in cell.jsonable())
+        self.update(cell, {'n':'x'}, [output(stdout='x')])
+        self.update(cell, {'n':'x'}, [output(stdout='x')])
+        self.assertEqual(sage_salvus.salvus._output_filter, None)   # all output is sent
+        self.assertEqual(self.calls, ['x', 'x'])
+        self.assertEqual(cell._output_hashes, None)
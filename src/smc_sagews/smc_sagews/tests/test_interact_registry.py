@@ -0,0 +1,70 @@
+import gc, os, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class Cell(object):
+    def memory(self):
+        return 10
+
+
+class TestInteractRegistry(TestCase):
+    def test_recent(self):
+        interacts = sage_salvus.InteractRegistry(maxsize=2)
+        a, b = Cell(), Cell()
+        interacts['a'] = a
+        interacts['b'] = b
+        self.assertTrue(interacts['a'] is a)   # so b is the least recently used
+        interacts['c'] = Cell()
+        self.assertEqual(list(interacts._recent), ['a', 'c'])
+        self.assertTrue(interacts.get('b') is b)   # still referenced here, so it works
+        self.assertEqual(list(interacts._recent), ['c', 'b'])
+        self.assertEqual(len(interacts), 3)
+
+    def test_eviction(self):
+        interacts = sage_salvus.InteractRegistry(maxsize=1)
+        interacts['a'] = Cell()
+        interacts['b'] = Cell()
+        gc.collect()
+        self.assertFalse('a' in interacts)
+        self.assertEqual(interacts.get('a'), None)
+        self.assertRaises(KeyError, lambda: interacts['a'])
+        self.assertTrue(interacts.evicted('a'))
+        self.assertFalse(interacts.evicted('b'))
+        self.assertEqual(len(interacts), 1)
+
+    def test_replace(self):
+        # an old weak reference to a replaced interact does not remove the new one
+        interacts = sage_salvus.InteractRegistry(maxsize=1)
+        old = Cell()
+        interacts['a'] = old
+        interacts['b'] = Cell()
+        a = Cell()
+        interacts['a'] = a
+        del old
+        gc.collect()
+        self.assertTrue(interacts['a'] is a)
+        self.assertFalse(interacts.evicted('a'))
+
+    def test_memory(self):
+        interacts = sage_salvus.InteractRegistry(maxsize=1)
+        a = Cell()
+        interacts['a'] = a
+        interacts['b'] = Cell()
+        self.assertEqual(interacts.memory(), {'a':10, 'b':10})
+        interacts.clear()
+        self.assertEqual(len(interacts), 0)
@@ -0,0 +1,94 @@
+import os, socket, tempfile, threading
+from unittest import TestCase
+
+from smc_sagews import sage_parsing, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class Attributes(object):
+    calls = 0
+    def __getattr__(self, name):
+        Attributes.calls += 1
+        raise AttributeError(name)
+    def __dir__(self):
+        Attributes.calls += 1
+        return ['alpha', 'beta']
+
+
+class TestIntrospectWithoutEvaluating(TestCase):
+    def setUp(self):
+        self.namespace = {'os':os, 'zabc':1, 'zabd':2, 'x':Attributes()}
+        self.index = sage_parsing.CompletionIndex(self.namespace)
+        Attributes.calls = 0
+
+    def introspect(self, line):
+        return sage_parsing.introspect(line, self.namespace, preparse=False, evaluate=False, index=self.index)
+
+    def test_names(self):
+        self.index.names('')
+        self.assertEqual(self.introspect('zab')['result'], ['c', 'd'])
+        self.namespace['zabe'] = 3
+        # the namespace may be changing in another thread, so it is not read
+        self.assertEqual(self.introspect('zab')['result'], ['c', 'd'])
+        self.assertEqual(self.index.names('zab'), ['c', 'd', 'e'])
+
+    def test_module_attributes(self):
+        z = self.introspect('os.path.joi')
+        self.assertEqual((z['result'], z['target']), (['n'], 'joi'))
+        self.assertEqual(self.introspect('os.nonexistent.x'), None)
+
+    def test_object_attributes(self):
+        self.assertEqual(self.introspect('x.al'), None)   # not in the index
+        self.assertEqual(self.introspect('x.zz.al'), None)
+        self.assertEqual(Attributes.calls, 0)
+        self.assertEqual(self.index.attributes(self.namespace['x'], 'al'), ['pha'])
+        calls = Attributes.calls
+        self.assertEqual(self.introspect('x.al')['result'], ['pha'])
+        self.assertEqual(Attributes.calls, calls)
+
+    def test_no_evaluation(self):
+        for line in ['x?', 'x??', 'os.path.join?', 'f(x).a', 'x + 1; x.al']:
+            self.assertEqual(self.introspect(line), None)
+        self.assertEqual(Attributes.calls, 0)
+
+
+class TestRecvInto(TestCase):
+    def test_interrupted(self):
+        # a signal during recv is retried, however often it happens
+        class Interrupted(object):
+            def __init__(self, conn, n):
+                self.conn, self.n = conn, n
+            def recv_into(self, *args):
+                if self.n:
+                    self.n -= 1
+                    raise socket.error(4, 'Interrupted system call')
+                return self.conn.recv_into(*args)
+        a, b = socket.socketpair()
+        conn = sage_server.ConnectionJSON(b)
+        conn._conn = Interrupted(b, 50)
+        a.sendall('abcd')
+        buf = bytearray(4)
+        conn._recv_into(buf)
+        self.assertEqual(str(buf), 'abcd')
+        a.close()
+        b.close()
+
+    def test_timeout(self):
+        a, b = socket.socketpair()
+        b.settimeout(0.01)
+        conn = sage_server.ConnectionJSON(b)
+        self.assertRaises(socket.timeout, conn._recv_into, bytearray(4))
+        a.close()
+        b.close()
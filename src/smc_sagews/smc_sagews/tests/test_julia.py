@@ -0,0 +1,196 @@
+import distutils.spawn, os, re, signal, tempfile
+from unittest import TestCase, skipUnless
+
+import numpy
+
+from smc_sagews import julia, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+HAVE_JULIA = distutils.spawn.find_executable('julia') is not None
+
+def arrays():
+    # a 2x3 array of each dtype that can be transferred
+    for dtype in julia.JULIA_DTYPES:
+        yield numpy.array([[1, 0, 3], [4, 5, 0]]).astype(dtype)
+
+
+class TestJuliaArrays(TestCase):
+    def test_string(self):
+        self.assertEqual(julia.julia_string('/tmp/a'), '"/tmp/a"')
+        self.assertEqual(julia.julia_string('a"$b\\'), r'"a\"\$b\\"')
+
+    def test_array(self):
+        a = julia.julia_array(numpy.arange(6).reshape(2, 3))
+        self.assertTrue(a.flags.f_contiguous)
+        self.assertRaises(TypeError, julia.julia_array, numpy.array(['a']))
+        self.assertRaises(TypeError, julia.julia_array, numpy.arange(3, dtype='int16'))
+
+    def test_missing(self):
+        pipe = julia.JuliaPipe('/nonexistent/julia')
+        self.assertRaises(RuntimeError, pipe.eval, '1')
+        self.assertFalse(pipe.is_running())
+
+
+class TestREPLFiles(TestCase):
+    # how Julia(pipe=False) transfers arrays, with the julia code it evaluates
+    # done here instead
+    def setUp(self):
+        self.julia = julia.Julia(pipe=False)
+        self.code = []
+        self.julia.eval = self.eval
+
+    def files(self, code):
+        return re.findall(r'"(/[^"]*)"', code)
+
+    def eval(self, code):
+        self.code.append(code)
+        if code.startswith('let'):
+            header, filename = self.files(code)
+            open(header, 'w').write(self.header)
+            self.data.tofile(filename)
+        else:
+            filename, = self.files(code)
+            self.read = numpy.fromfile(filename, dtype=self.data.dtype)
+        return ''
+
+    def test_set_array(self):
+        self.data = numpy.array([[1., 2, 3], [4, 5, 6]])
+        self.julia.set_array('x', self.data)
+        self.assertTrue(re.match(r'x = read!\("/.*", zeros\(Float64, 2, 3\)\);$', self.code[0]))
+        self.assertEqual(list(self.read), [1, 4, 2, 5, 3, 6])   # column major
+        self.assertFalse(os.path.exists(self.files(self.code[0])[0]))
+        self.assertRaises(TypeError, self.julia.set_array, 'x', numpy.array(['a']))
+
+    def test_get_array(self):
+        self.header = 'Int64 2 3'
+        self.data = numpy.array([1, 4, 2, 5, 3, 6])
+        a = self.julia.get_array('x')
+        self.assertEqual(a.dtype.name, 'int64')
+        self.assertEqual(a.tolist(), [[1, 2, 3], [4, 5, 6]])
+        self.header = 'ComplexF64 1'
+        self.data = numpy.array([1j])
+        self.assertEqual(self.julia.get_array('x').tolist(), [1j])
+
+    def test_get_other(self):
+        self.header = 'String 2'
+        self.data = numpy.array([0])
+        self.assertRaises(RuntimeError, self.julia.get_array, 'x')
+
+
+@skipUnless(HAVE_JULIA, "julia is not installed")
+class TestJuliaPipe(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.julia = julia.Julia()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.julia.quit()
+
+    def test_eval(self):
+        self.assertEqual(self.julia.eval('1 + 2'), '3')
+        self.assertEqual(self.julia.eval('x = 5;'), '')
+        self.assertEqual(self.julia.eval('x * 2'), '10')
+        self.assertEqual(self.julia.eval('ans + 1'), '11')
+        self.assertEqual(self.julia.eval('println("hi"); x'), 'hi\n5')
+        self.assertEqual(self.julia.eval(u'"\u03b1"'), '"\xce\xb1"')
+
+    def test_error(self):
+        try:
+            self.julia.eval('println("before"); error("bad")')
+        except RuntimeError, err:
+            self.assertEqual(str(err), 'before\nERROR: bad')
+        else:
+            self.fail("no RuntimeError")
+        self.assertEqual(self.julia.eval('2'), '2')
+
+    def test_interrupt(self):
+        self.julia.eval('y = 7;')
+        pid = self.julia.pid()
+        def interrupt(*args):
+            raise KeyboardInterrupt
+        handler = signal.signal(signal.SIGALRM, interrupt)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, .5)
+            self.assertRaises(KeyboardInterrupt, self.julia.eval, 'sleep(30)')
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+        # julia stopped the evaluation, and is still running
+        self.assertEqual(self.julia.pid(), pid)
+        self.assertEqual(self.julia.eval('y'), '7')
+
+    def test_restart(self):
+        # julia is started again if it exited ...
+        self.julia.eval('1')
+        pid = self.julia.pid()
+        self.julia._pipe._process.kill()
+        self.julia._pipe._process.wait()
+        self.assertEqual(self.julia.eval('1'), '1')
+        self.assertNotEqual(self.julia.pid(), pid)
+        # ... also during an evaluation
+        pid = self.julia.pid()
+        handler = signal.signal(signal.SIGALRM, lambda *args: os.kill(pid, signal.SIGKILL))
+        try:
+            signal.setitimer(signal.ITIMER_REAL, .5)
+            self.assertRaises(RuntimeError, self.julia.eval, 'sleep(30)')
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+        self.assertFalse(self.julia.is_running())
+        self.assertEqual(self.julia.eval('2'), '2')
+
+    def test_arrays(self):
+        for a in arrays():
+            self.julia.set_array('a', a)
+            self.assertEqual(self.julia.eval('size(a)'), '(2, 3)')
+            self.assertEqual(self.julia.eval('Int(a[2,1])'), str(int(a[1, 0])))
+            b = self.julia.get_array('a')
+            self.assertEqual((b.dtype, b.shape, b.tolist()), (a.dtype, a.shape, a.tolist()))
+        self.assertEqual(self.julia.get_array('a').flags.f_contiguous, True)
+        self.julia.eval('v = [1.5, 2.5];')
+        self.assertEqual(self.julia.get_array('v').tolist(), [1.5, 2.5])
+
+    def test_not_array(self):
+        self.julia.eval('s = "abc"; t = ["a"];')
+        self.assertRaises(RuntimeError, self.julia.get_array, 's')
+        self.assertRaises(RuntimeError, self.julia.get_array, 't')
+        self.assertRaises(RuntimeError, self.julia.get_array, 'undefined_name')
+        self.assertEqual(self.julia.eval('3'), '3')
+
+
+@skipUnless(HAVE_JULIA, "julia is not installed")
+class TestJuliaREPL(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.julia = julia.Julia(pipe=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.julia.quit()
+
+    def test_eval(self):
+        self.assertEqual(self.julia.eval('1 + 2'), '3')
+        self.assertRaises(RuntimeError, self.julia.eval, 'error("bad")')
+
+    def test_arrays(self):
+        for a in arrays():
+            self.julia.set_array('a', a)
+            self.assertEqual(self.julia.eval('Int(a[2,1])'), str(int(a[1, 0])))
+            b = self.julia.get_array('a')
+            self.assertEqual((b.dtype, b.shape, b.tolist()), (a.dtype, a.shape, a.tolist()))
+        self.julia.eval('s = "abc";')
+        self.assertRaises(RuntimeError, self.julia.get_array, 's')
@@ -0,0 +1,44 @@
+import os, subprocess, sys, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestKernel(TestCase):
+    def test_missing_program(self):
+        kernel = sage_salvus.Kernel('python3', env={'PATH':'/nonexistent'})
+        self.assertRaises(OSError, kernel._start)
+
+    def test_close_fds_on_exec(self):
+        r, w = os.pipe()
+        other_r, other_w = os.pipe()
+        def setup():
+            os.dup2(r, 3)
+            sage_salvus.close_fds_on_exec(4)
+        code = "import os, sys\nsys.stdout.write(os.read(3, 5))\ntry:\n    os.fstat(%s)\nexcept OSError:\n    sys.stdout.write(' closed')\n"%other_w
+        p = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, preexec_fn=setup)
+        os.close(r)
+        os.write(w, 'hello')
+        os.close(w)
+        self.assertEqual(p.communicate()[0], 'hello closed')
+        os.close(other_r)
+        os.close(other_w)
+
+
+class TestJuliaPipe(TestCase):
+    def test_missing_program(self):
+        from smc_sagews import julia
+        self.assertRaises(OSError, julia.JuliaPipe('/nonexistent/julia').start)
@@ -0,0 +1,131 @@
+import __builtin__, itertools, os, shutil, sys, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+_names = itertools.count()
+
+class ModulesTestCase(TestCase):
+    # modules with new names, written to a temporary directory on sys.path
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        sys.path.insert(0, self.dir)
+        self.names = []
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        shutil.rmtree(self.dir)
+        for name in self.names:
+            sys.modules.pop(name, None)
+
+    def module(self, code=''):
+        name = '_lazy_test_%s'%next(_names)
+        self.names.append(name)
+        open(os.path.join(self.dir, name + '.py'), 'w').write(code)
+        return name
+
+
+class TestLazyModule(ModulesTestCase):
+    def test_load(self):
+        name = self.module("x = 42\ndef f():\n    return x\n")
+        namespace = sage_server.Namespace({})
+        namespace[name] = lazy = sage_server.LazyModule(name, namespace)
+        self.assertFalse(name in sys.modules)
+        self.assertEqual(lazy.x, 42)   # imports the module ...
+        self.assertTrue(namespace[name] is sys.modules[name])   # ... which replaces the stand-in
+        self.assertEqual(lazy.f(), 42)
+        self.assertTrue('f' in dir(lazy))
+
+    def test_setattr(self):
+        name = self.module("x = 1\n")
+        lazy = sage_server.LazyModule(name)
+        lazy.x = 2
+        self.assertEqual(sys.modules[name].x, 2)
+        self.assertEqual(lazy.x, 2)
+
+    def test_replaced(self):
+        # the worksheet assigned something else to the name; that is left alone
+        name = self.module("x = 1\n")
+        namespace = {}
+        lazy = sage_server.LazyModule(name, namespace)
+        namespace[name] = 'other'
+        self.assertEqual(lazy.x, 1)
+        self.assertEqual(namespace[name], 'other')
+
+    def test_missing(self):
+        lazy = sage_server.LazyModule('_lazy_test_nonexistent')
+        self.assertRaises(ImportError, getattr, lazy, 'x')
+
+
+class TestImportProfiler(ModulesTestCase):
+    def test_times(self):
+        inner = self.module("import time\ntime.sleep(.02)\n")
+        outer = self.module("import %s\n"%inner)
+        import_ = __builtin__.__import__
+        with sage_server.ImportProfiler() as profiler:
+            __import__(outer)
+            __import__(outer)   # already imported, so not recorded again
+            import os
+        self.assertTrue(__builtin__.__import__ is import_)
+        self.assertEqual(sorted(profiler.times), sorted([inner, outer]))
+        self.assertTrue(profiler.times[outer] >= profiler.times[inner] >= .02)
+        self.assertTrue(profiler.total >= profiler.times[outer])
+        lines = profiler.report().splitlines()
+        self.assertEqual([line.split()[1] for line in lines], ['(total)', outer, inner])
+
+    def test_start_stop(self):
+        name = self.module()
+        profiler = sage_server.ImportProfiler().start()
+        try:
+            __import__(name)
+        finally:
+            profiler.stop()
+        self.assertEqual(list(profiler.times), [name])
+
+
+class TestImportHooks(ModulesTestCase):
+    def test_when_imported(self):
+        hooks = sage_salvus.ImportHooks()
+        name = self.module("x = 1\n")
+        calls = []
+        hooks.add(name, lambda module: calls.append(module.x))
+        try:
+            self.assertTrue(hooks in sys.meta_path)
+            self.assertEqual(calls, [])
+            __import__(name).x = 2
+            self.assertEqual(calls, [1])   # called before the module is used
+            __import__(name)
+            self.assertEqual(calls, [1])
+            hooks.add(name, lambda module: calls.append(module.x))   # already imported
+            self.assertEqual(calls, [1, 2])
+            self.assertEqual(hooks.hooks, {})
+        finally:
+            sys.meta_path.remove(hooks)
+
+    def test_submodule(self):
+        hooks = sage_salvus.ImportHooks()
+        package = '_lazy_test_%s'%next(_names)
+        os.mkdir(os.path.join(self.dir, package))
+        open(os.path.join(self.dir, package, '__init__.py'), 'w').write('')
+        open(os.path.join(self.dir, package, 'sub.py'), 'w').write("def show():\n    return 'plain'\n")
+        self.names.extend([package, package + '.sub'])
+        hooks.add(package + '.sub', lambda module: setattr(module, 'show', lambda: 'patched'))
+        try:
+            module = __import__(package + '.sub', fromlist=['show'])
+            self.assertEqual(module.show(), 'patched')
+        finally:
+            sys.meta_path.remove(hooks)
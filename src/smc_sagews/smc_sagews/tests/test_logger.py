@@ -0,0 +1,68 @@
+import logging, os, tempfile, threading, time
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+class TestLogger(TestCase):
+    def setUp(self):
+        self.logfile = sage_server.LOGFILE
+        fd, sage_server.LOGFILE = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(sage_server.LOGFILE)
+        sage_server.LOGFILE = self.logfile
+
+    def test_level(self):
+        logger = sage_server.Logger(level=logging.INFO)
+        logger.log(logging.DEBUG, ['hidden'])
+        logger.log(logging.INFO, ['shown', 3])
+        logger.flush()
+        lines = open(sage_server.LOGFILE).read().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(': shown 3'))
+
+    def test_dropped(self):
+        size = sage_server.LOG_BUFFER_SIZE
+        sage_server.LOG_BUFFER_SIZE = 3
+        try:
+            logger = sage_server.Logger()
+            for i in range(5):
+                logger.log(logging.INFO, [str(i)])
+            logger.flush()
+        finally:
+            sage_server.LOG_BUFFER_SIZE = size
+        lines = open(sage_server.LOGFILE).read().splitlines()
+        self.assertEqual([line.split(': ')[-1] for line in lines[:3]], ['2', '3', '4'])
+        self.assertTrue('dropped 2 log messages' in lines[3])
+
+    def test_threads(self):
+        # every message is written by the writer thread, without calling flush
+        interval = sage_server.LOG_FLUSH_INTERVAL
+        sage_server.LOG_FLUSH_INTERVAL = 0
+        try:
+            logger = sage_server.Logger()
+            def run(k):
+                for i in range(500):
+                    logger.log(logging.INFO, [str(k), str(i)])
+                    if i % 50 == 0:
+                        time.sleep(.001)
+            threads = [threading.Thread(target=run, args=(k,)) for k in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            deadline = time.time() + 5
+            while time.time() < deadline and len(open(sage_server.LOGFILE).readlines()) < 8 * 500:
+                time.sleep(.01)
+        finally:
+            sage_server.LOG_FLUSH_INTERVAL = interval
+        lines = open(sage_server.LOGFILE).read().splitlines()
+        self.assertEqual(sorted([line.split(': ')[-1] for line in lines]),
+                         sorted(['%s %s'%(k, i) for k in range(8) for i in range(500)]))
+
+    def test_flush_at_exit(self):
+        def flush():
+            raise AttributeError("'NoneType' object has no attribute 'getpid'")
+        sage_server._flush_log_at_exit(flush)   # as during interpreter teardown; must not raise
@@ -0,0 +1,69 @@
+import os, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestNamespace(TestCase):
+    def setUp(self):
+        self.namespace = sage_server.Namespace({'a':1})
+        self.changes = []
+
+    def changed(self, x, y):
+        self.changes.append((x, y))
+
+    def test_observe(self):
+        self.assertTrue(type(self.namespace) is sage_server.Namespace)
+        self.namespace.on('change', None, self.changed)
+        self.assertTrue(type(self.namespace) is sage_server.ObservingNamespace)
+        exec "a = 2\nb = a + 1" in self.namespace
+        self.assertEqual(self.changes, [('a', 2), ('b', 3)])
+        self.namespace.remove('change', None, self.changed)
+        self.assertTrue(type(self.namespace) is sage_server.Namespace)
+        exec "a = 4" in self.namespace
+        self.assertEqual(self.changes, [('a', 2), ('b', 3)])
+        self.assertEqual(self.namespace['a'], 4)
+
+    def test_variable_listeners(self):
+        values, deleted = [], []
+        self.namespace.on('change', 'a', values.append)
+        self.namespace.on('del', 'a', lambda: deleted.append('a'))
+        self.namespace['a'] = 2
+        self.namespace['b'] = 3
+        self.namespace.set('a', 5, do_not_trigger=[values.append])
+        del self.namespace['a']
+        self.assertEqual((values, deleted), ([2], ['a']))
+        self.assertFalse('a' in self.namespace)
+
+    def test_batch(self):
+        self.namespace.on('change', None, self.changed)
+        with self.namespace.batch():
+            exec "for i in range(5):\n    a = i" in self.namespace
+            with self.namespace.batch():
+                self.namespace['b'] = 1
+            self.namespace['c'] = 2
+            del self.namespace['c']
+            self.assertEqual(self.changes, [])
+        self.assertEqual(sorted(self.changes), [('a', 4), ('b', 1), ('i', 4)])
+        self.namespace['a'] = 0
+        self.assertEqual(self.changes[-1], ('a', 0))
+
+    def test_listener_error(self):
+        def f(x, y):
+            raise ValueError(x)
+        self.namespace.on('change', None, f)
+        self.namespace['a'] = 2   # printed, not raised
+        self.assertEqual(self.namespace['a'], 2)
@@ -0,0 +1,116 @@
+import os, socket, tempfile, time
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class Cell(object):
+    def __init__(self, coalescer, interrupt=False):
+        self.coalescer = coalescer
+        self.interrupt = interrupt
+        self.sent = []
+    def _send_output_now(self, **kwds):
+        self.coalescer.flush()   # as when a message starts the output spool
+        if self.interrupt:
+            raise KeyboardInterrupt
+        self.sent.append(kwds)
+
+
+class TestOutputCoalescer(TestCase):
+    def setUp(self):
+        self.window = sage_server.OUTPUT_COALESCE_WINDOW
+        self.coalescer = sage_server.OutputCoalescer()
+
+    def tearDown(self):
+        sage_server.OUTPUT_COALESCE_WINDOW = self.window
+
+    def test_merge(self):
+        sage_server.OUTPUT_COALESCE_WINDOW = 10
+        cell = Cell(self.coalescer)
+        self.assertTrue(self.coalescer.add(cell, {'id':'x', 'stdout':'a'}))
+        self.assertTrue(self.coalescer.add(cell, {'id':'x', 'stdout':'b'}))
+        self.assertEqual(cell.sent, [])
+        self.assertTrue(self.coalescer.add(cell, {'id':'x', 'stdout':'c', 'done':True}))
+        self.assertEqual(cell.sent, [{'id':'x', 'stdout':'abc', 'done':True}])
+        self.assertEqual(self.coalescer.merged, 2)
+
+    def test_other_output(self):
+        sage_server.OUTPUT_COALESCE_WINDOW = 10
+        cell = Cell(self.coalescer)
+        self.coalescer.add(cell, {'id':'x', 'stdout':'a'})
+        self.assertTrue(self.coalescer.add(cell, {'id':'x', 'stderr':'b'}))
+        # not mergeable: the pending output is sent, and then the caller sends it
+        self.assertFalse(self.coalescer.add(cell, {'id':'x', 'html':'c', 'stdout':'d'}))
+        self.assertEqual(cell.sent, [{'id':'x', 'stdout':'a', 'done':False}, {'id':'x', 'stderr':'b', 'done':False}])
+
+    def test_flush(self):
+        sage_server.OUTPUT_COALESCE_WINDOW = 10
+        cell = Cell(self.coalescer)
+        self.coalescer.add(cell, {'id':'x', 'stdout':'a'})
+        self.coalescer.flush()
+        self.coalescer.flush()
+        self.assertEqual(cell.sent, [{'id':'x', 'stdout':'a', 'done':False}])
+
+    def test_window(self):
+        sage_server.OUTPUT_COALESCE_WINDOW = .01
+        cell = Cell(self.coalescer)
+        self.coalescer.add(cell, {'id':'x', 'stdout':'a'})
+        for i in range(100):
+            if cell.sent:
+                break
+            time.sleep(.01)
+        self.assertEqual(cell.sent, [{'id':'x', 'stdout':'a', 'done':False}])
+
+    def test_interrupt(self):
+        # the output limits raise KeyboardInterrupt in the background thread, which interrupts the cell
+        sage_server.OUTPUT_COALESCE_WINDOW = .01
+        cell = Cell(self.coalescer, interrupt=True)
+        self.coalescer.add(cell, {'id':'x', 'stdout':'a'})
+        try:
+            for i in range(100):
+                time.sleep(.01)
+        except KeyboardInterrupt:
+            pass
+        else:
+            self.fail("the cell was not interrupted")
+
+
+class TestMessageOrder(TestCase):
+    def setUp(self):
+        self.window = sage_server.OUTPUT_COALESCE_WINDOW
+        sage_server.OUTPUT_COALESCE_WINDOW = 10
+        a, b = socket.socketpair()
+        self.conn = sage_server.ConnectionJSON(a)
+        self.hub = sage_server.ConnectionJSON(b)
+
+    def tearDown(self):
+        sage_server.OUTPUT_COALESCE_WINDOW = self.window
+        self.conn.close()
+        self.hub.close()
+
+    def test_javascript_after_output(self):
+        salvus = sage_server.Salvus(conn=self.conn, id='x')
+        salvus.stdout('a')
+        salvus.stdout('b')
+        salvus.execute_javascript('f()')
+        salvus.hide('output')
+        self.assertEqual(self.hub.recv()[1].get('stdout'), 'ab')
+        self.assertEqual(self.hub.recv()[1]['event'], 'execute_javascript')
+        salvus.stdout('c')
+        salvus.hide('output')
+        self.assertEqual(self.hub.recv()[1].get('hide'), 'output')
+        self.assertEqual(self.hub.recv()[1].get('stdout'), 'c')
+        self.assertEqual(self.hub.recv()[1].get('hide'), 'output')
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os, shutil, socket, tempfile, time
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestOutputSpool(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write(self):
+        spool = sage_server.OutputSpool(path=self.path, max_bytes=10)
+        spool.write('ab\ncd\n')
+        spool.write(u'\xe9')
+        spool.write('too much')
+        spool.close()
+        self.assertEqual(spool.summary(), {'handle':spool.handle, 'size':8, 'lines':2, 'skipped':8, 'dropped':0})
+        self.assertEqual(open(spool.filename).read(), 'ab\ncd\n\xc3\xa9')
+
+    def test_pages(self):
+        # pages do not split characters, and together they are the whole log
+        spool = sage_server.OutputSpool(path=self.path)
+        text = u'a\xe9€\U0001f600\n' * 10
+        spool.write(text)
+        spool.close()
+        for max_size in [4, 5, 7]:
+            pages = []
+            start = 0
+            while start < spool.size:
+                page = sage_server.output_spool_page(spool.handle, start, max_size=max_size, path=self.path)
+                self.assertEqual(page['size'], spool.size)
+                self.assertTrue(0 < page['stop'] - start <= max_size)
+                pages.append(page['data'])
+                start = page['stop']
+            self.assertEqual(u''.join(pages), text)
+        page = sage_server.output_spool_page(spool.handle, 5, 3, path=self.path)
+        self.assertEqual((page['start'], page['stop'], page['data']), (5, 5, u''))
+        page = sage_server.output_spool_page(spool.handle, -1, 10**6, path=self.path)
+        self.assertEqual((page['start'], page['stop'], page['data']), (0, spool.size, text))
+
+    def test_invalid_handle(self):
+        for handle in ['', '../x', '.x', 'lock', 'a/b']:
+            self.assertRaises(ValueError, sage_server.output_spool_page, handle, path=self.path)
+        self.assertRaises(IOError, sage_server.output_spool_page, 'missing', path=self.path)
+
+    def test_evict(self):
+        old = sage_server.OutputSpool(path=self.path)
+        old.write('x' * 10)
+        old.close()
+        t = time.time() - 100
+        os.utime(old.filename, (t, t))
+        new = sage_server.OutputSpool(path=self.path)
+        new.write('y' * 10)
+        new.close()
+        sage_server.OutputSpool(path=self.path, max_bytes=15).close()
+        self.assertFalse(os.path.exists(old.filename))
+        self.assertTrue(os.path.exists(new.filename))
+
+
+class TestSalvusSpool(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = dict((name, getattr(sage_server, name)) for name in
+                             ['OUTPUT_SPOOL', 'OUTPUT_SPOOL_PATH', 'MAX_OUTPUT_MESSAGES', 'OUTPUT_COALESCE_WINDOW'])
+        sage_server.OUTPUT_SPOOL = True
+        sage_server.OUTPUT_SPOOL_PATH = self.path
+        sage_server.MAX_OUTPUT_MESSAGES = 2
+        sage_server.OUTPUT_COALESCE_WINDOW = 0
+        a, b = socket.socketpair()
+        self.conn = sage_server.ConnectionJSON(a)
+        self.hub = sage_server.ConnectionJSON(b)
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(sage_server, name, value)
+        self.conn.close()
+        self.hub.close()
+        shutil.rmtree(self.path)
+
+    def test_spool(self):
+        salvus = sage_server.Salvus(conn=self.conn, id='x')
+        for i in range(5):
+            salvus.stdout('%s\n'%i)
+        salvus._close_spool(done=True)
+        mesgs = [self.hub.recv()[1] for i in range(4)]
+        self.assertEqual([m.get('stdout') for m in mesgs[:2]], ['0\n', '1\n'])
+        handle = mesgs[2]['spool']['handle']
+        self.assertEqual(mesgs[3]['spool'], {'handle':handle, 'size':6, 'lines':3, 'skipped':0, 'dropped':0})
+        self.assertTrue(mesgs[3]['done'])
+        self.assertEqual(salvus.output_page(handle), '2\n3\n4\n')
@@ -0,0 +1,141 @@
+import os, socket, sys, tempfile, time
+from unittest import TestCase
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class ForkEngine(sage_server.ForkEngine):
+    # records how many children run at once
+    def __init__(self, max_workers=None):
+        sage_server.ForkEngine.__init__(self, max_workers)
+        self.started = 0
+        self.most = 0
+
+    def start(self, *args, **kwds):
+        pid = sage_server.ForkEngine.start(self, *args, **kwds)
+        self.started += 1
+        self.most = max(self.most, len(self.children()))
+        return pid
+
+
+class Salvus(object):
+    # the parts of Salvus that parallel_map uses
+    def __init__(self, engine):
+        self.fork_engine = engine
+        self.namespace = {}
+        self._sockets = socket.socketpair()
+        self._conn = sage_server.ConnectionJSON(self._sockets[0])
+
+    def _send_message(self, mesg):
+        return self._conn.send_json(mesg)
+
+    def execute(self, code):
+        exec code in self.namespace
+
+    def close(self):
+        for sock in self._sockets:
+            sock.close()
+
+
+def slow_square(x):
+    # the first items take longest, so the chunks finish in reverse order
+    time.sleep(.05 * (4 - x % 5))
+    return x * x
+
+
+class TestParallelMap(TestCase):
+    def setUp(self):
+        self.saved = (sage_salvus.salvus, sage_server.cpu_quota)
+
+    def tearDown(self):
+        sage_salvus.salvus.close()
+        sage_salvus.salvus, sage_server.cpu_quota = self.saved
+
+    def engine(self, max_workers=None):
+        engine = ForkEngine(max_workers)
+        sage_salvus.salvus = Salvus(engine)
+        return engine
+
+    def test_order(self):
+        engine = self.engine(4)
+        v = range(10)
+        self.assertEqual(sage_salvus.parallel_map(slow_square, v, chunksize=1, progress=False),
+                         [x * x for x in v])
+        self.assertEqual(engine.started, 10)
+        self.assertTrue(engine.most <= 4)
+
+    def test_error(self):
+        engine = self.engine(2)
+        def f(x):
+            if x == 3:
+                raise ValueError("bad item %s"%x)
+            time.sleep(.5)
+            return x
+        try:
+            sage_salvus.parallel_map(f, range(8), chunksize=1, progress=False)
+        except RuntimeError, err:
+            self.assertEqual(str(err), "parallel_map: ValueError: bad item 3")
+        else:
+            self.fail("no RuntimeError")
+        # the other children were killed
+        engine.wait()
+        self.assertEqual(engine.children(), [])
+        self.assertTrue(engine.started < 8)
+
+    def test_few_items(self):
+        engine = self.engine(4)
+        self.assertEqual(sage_salvus.parallel_map(slow_square, [3, 1], progress=False), [9, 1])
+        self.assertEqual(engine.started, 2)   # one item per chunk
+        self.assertEqual(sage_salvus.parallel_map(slow_square, [], progress=False), [])
+
+    def test_cpu_quota(self):
+        sage_server.cpu_quota = lambda: 2
+        engine = self.engine()
+        v = range(16)
+        # more workers than the quota are not used
+        self.assertEqual(sage_salvus.parallel_map(slow_square, v, workers=8, progress=False),
+                         [x * x for x in v])
+        self.assertEqual(engine.started, 8)   # about four chunks per worker
+        self.assertTrue(engine.most <= 2)
+
+    def test_usage(self):
+        self.engine(2)
+        self.assertRaises(TypeError, sage_salvus.parallel_map, None, [1])
+        self.assertRaises(TypeError, sage_salvus.parallel_map, slow_square, [1], n=[1])
+
+
+class TestParallelMapBlock(TestCase):
+    def setUp(self):
+        self.saved = (sage_salvus.salvus, sys.stdout, sys.stderr)
+        sage_salvus.salvus = Salvus(sage_server.ForkEngine(3))
+        self.output = []
+        sys.stdout = sage_server.BufferedOutputStream(lambda buf, done: self.output.append(buf))
+        sys.stderr = sage_server.BufferedOutputStream(lambda buf, done: self.output.append('stderr:' + buf))
+
+    def tearDown(self):
+        sage_salvus.salvus.close()
+        sage_salvus.salvus, sys.stdout, sys.stderr = self.saved
+
+    def test_block(self):
+        # the output of each evaluation of the block is shown in the order of the values
+        block = sage_salvus.parallel_map(n=range(6), chunksize=1, progress=False)
+        block("import time\ntime.sleep(.05 * (6 - n))\nprint n*n\n")
+        self.assertEqual(''.join(self.output), ''.join('%s\n'%(n*n) for n in range(6)))
+
+    def test_stderr(self):
+        block = sage_salvus.parallel_map(n=[1, 2], progress=False)
+        block("import sys\nsys.stderr.write('n=%s'%n)\n")
+        self.assertEqual(self.output, ['stderr:n=1', 'stderr:n=2'])
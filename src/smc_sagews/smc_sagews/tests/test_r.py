@@ -0,0 +1,77 @@
+import distutils.spawn, os, shutil, tempfile
+from fractions import Fraction
+from unittest import TestCase, skipIf
+
+import numpy
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestRColumns(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_column(self):
+        x, mask = sage_salvus._r_column([1, None, 3])
+        self.assertEqual((x.dtype.kind, list(x), list(mask)), ('i', [1, 0, 3], [False, True, False]))
+        x, mask = sage_salvus._r_column([Fraction(1, 2), 2])
+        self.assertEqual((list(x), mask), ([.5, 2.0], numpy.ma.nomask))
+        x, mask = sage_salvus._r_column([True, None])
+        self.assertEqual((x.dtype.kind, list(mask)), ('b', [False, True]))
+        x, mask = sage_salvus._r_column([2**70, 1])
+        self.assertEqual(x.dtype.kind, 'f')
+        x, mask = sage_salvus._r_column(numpy.ma.masked_array([1.5, 2], mask=[True, False]))
+        self.assertEqual((list(x), list(mask)), ([1.5, 2], [True, False]))
+
+    def test_objects(self):
+        # are not silently transferred as strings
+        self.assertRaises(TypeError, sage_salvus._r_column, ['a', {}])
+        self.assertRaises(TypeError, sage_salvus._r_write_column, os.path.join(self.tmp, '0'), [1, 'a'])
+        self.assertRaises(ValueError, sage_salvus._r_column, [[1, 2]])
+
+    def test_write_mask(self):
+        filename = os.path.join(self.tmp, '0')
+        code = sage_salvus._r_write_column(filename, [u'a', None, 'c'])
+        self.assertEqual(open(filename, 'rb').read(), 'a\0\0c\0')
+        self.assertEqual(list(numpy.fromfile(filename + 'na', dtype='<i4')), [0, 1, 0])
+        self.assertTrue(code.startswith("(function(v) { v[readBin('%sna'"%filename))
+        code = sage_salvus._r_write_column(filename + 'x', [1.5, float('nan')])   # NaN is not NA
+        self.assertFalse(os.path.exists(filename + 'xna'))
+
+
+@skipIf(distutils.spawn.find_executable('R') is None, "R is not installed")
+class TestRTransfer(TestCase):
+    def test_vector_na(self):
+        r = sage_salvus.sage.interfaces.r.r
+        for v in [[1, None, 3], [True, None], ['a', None], [1.5, None]]:
+            r.set_vector('x', v)
+            self.assertEqual(r.eval('sum(is.na(x))'), '[1] 1')
+            w = r.get_vector('x')
+            self.assertEqual(list(w.mask), [x is None for x in v])
+            self.assertEqual([x for x, m in zip(w.data, w.mask) if not m], [x for x in v if x is not None])
+        r.eval('x <- c(1, NaN)')
+        self.assertTrue(numpy.isnan(r.get_vector('x')[1]))
+
+    def test_data_frame(self):
+        r = sage_salvus.sage.interfaces.r.r
+        r.set_data_frame('d', [('n', [1, 2, None]), ('s', ['a', 'b', 'c'])])
+        d = r.get_data_frame('d')
+        self.assertEqual(list(d), [u'n', u's'])
+        self.assertEqual(list(d['n'].mask), [False, False, True])
+        self.assertEqual(list(d['s']), [u'a', u'b', u'c'])
@@ -1,6 +1,84 @@
+import json, os, signal, socket, tempfile, time
 from unittest import TestCase
 
 
 class TestServer(TestCase):
     def test_imports(self):
         import smc_sagews.sage_server
+
+
+class TestServeSessions(TestCase):
+    def setUp(self):
+        from smc_sagews import sage_server
+        self.sage_server = sage_server
+        self.saved = (sage_server.LOGFILE, sage_server.secret_token, sage_server.SESSION_POOL_REFILL_DELAY)
+        self.dir = tempfile.mkdtemp()
+        sage_server.LOGFILE = os.path.join(self.dir, 'sage_server.log')
+        sage_server.secret_token = 'secret'
+        sage_server.SESSION_POOL_REFILL_DELAY = 0
+        self.statsfile = os.path.join(self.dir, 'stats.json')
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            os.kill(self.server, signal.SIGKILL)
+            os.waitpid(self.server, 0)
+        self.sage_server.logger.flush()
+        self.sage_server.LOGFILE, self.sage_server.secret_token, self.sage_server.SESSION_POOL_REFILL_DELAY = self.saved
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def connect(self, n, pool_size):
+        # clients connect before the server process starts, so it accepts them all at once
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        s.listen(128)
+        clients = []
+        for i in range(n):
+            client = socket.create_connection(s.getsockname())
+            client.sendall('secret')
+            clients.append(client)
+        self.server = os.fork()
+        if not self.server:
+            try:
+                self.sage_server.serve_sessions(s, pool_size=pool_size, statsfile=self.statsfile)
+            finally:
+                os._exit(0)
+        s.close()
+        return clients
+
+    def end_session(self, client):
+        # the session process handles a signal request and then exits; the server
+        # closes its end of the connection once it reaped the session process
+        self.assertEqual(client.recv(1), 'y')
+        self.sage_server.ConnectionJSON(client).send_json({'event':'send_signal', 'pid':0})
+        client.settimeout(10)
+        self.assertEqual(client.recv(1), '')
+        client.close()
+
+    def stats(self, **expected):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                stats = json.loads(open(self.statsfile).read())
+            except (IOError, ValueError):
+                stats = {}
+            if all(stats.get(k) == v for k, v in expected.iteritems()):
+                break
+            time.sleep(.01)
+        self.assertEqual(dict((k, stats.get(k)) for k in expected), expected)
+        return stats
+
+    def test_reap(self):
+        clients = self.connect(3, pool_size=0)
+        for client in clients:
+            self.end_session(client)
+        stats = self.stats(accepted=3, ended=3, sessions=0, forks=3)
+        self.assertEqual(stats['backlog_max'], 3)   # accepted in one wakeup
+        self.assertEqual(stats['pid'], self.server)
+
+    def test_pool(self):
+        # the connection goes to the pooled process, and the pool is refilled
+        client, = self.connect(1, pool_size=1)
+        self.end_session(client)
+        self.stats(accepted=1, ended=1, sessions=0, forks=2)
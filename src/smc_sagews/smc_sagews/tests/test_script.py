@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os, sys, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class Output(object):
+    def __init__(self):
+        self.writes = []
+    def write(self, s):
+        self.writes.append(s)
+    def flush(self):
+        pass
+
+
+class TestUtf8Split(TestCase):
+    def test_split(self):
+        s = u'a\xe9\u20ac\U0001f600b'.encode('utf8')   # characters of 1, 2, 3 and 4 bytes
+        for i in range(len(s) + 1):
+            prefix, rest = sage_salvus._utf8_split(s[:i])
+            self.assertEqual(prefix + rest, s[:i])
+            prefix.decode('utf8')
+            self.assertTrue(len(rest) < 4)
+            self.assertEqual(sage_salvus._utf8_split(rest + s[i:]), (rest + s[i:], ''))
+
+    def test_invalid(self):
+        # continuation bytes without a start are passed on as they are
+        self.assertEqual(sage_salvus._utf8_split('a' + '\x80' * 5), ('a' + '\x80' * 5, ''))
+        self.assertEqual(sage_salvus._utf8_split('\x80'), ('\x80', ''))
+        self.assertEqual(sage_salvus._utf8_split(''), ('', ''))
+
+
+class TestScript(TestCase):
+    def setUp(self):
+        self.streams = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = Output(), Output()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.streams
+
+    def test_stream(self):
+        # the output is written as it comes, without splitting characters
+        code = "import os, sys, time\nfor c in %r:\n    os.write(1, c)\n    time.sleep(.001)\ntime.sleep(.05)\nsys.stderr.write('err')"%u'\xe9\u20ac'.encode('utf8')
+        s = sage_salvus.script([sys.executable, '-c', code])
+        s()
+        for data in sys.stdout.writes:
+            data.decode('utf8')
+        self.assertEqual(''.join(sys.stdout.writes), u'\xe9\u20ac'.encode('utf8'))
+        self.assertEqual(''.join(sys.stderr.writes), 'err')
+        self.assertEqual(s.stdout, u'\xe9\u20ac'.encode('utf8') + 'err')
+
+    def test_input(self):
+        size = sage_salvus.SCRIPT_CHUNK_SIZE * 3
+        s = sage_salvus.script([sys.executable, '-c', 'import sys; sys.stdout.write(str(len(sys.stdin.read())))'])
+        s('x' * size)
+        self.assertEqual(s.stdout, str(size))
@@ -0,0 +1,112 @@
+import gc, os, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+SMAPS = """\
+00400000-00452000 r-xp 00000000 08:02 173521      /usr/bin/python
+Size:                328 kB
+Rss:                 300 kB
+Pss:                 100 kB
+Shared_Clean:        300 kB
+Shared_Dirty:          0 kB
+Private_Clean:         0 kB
+Private_Dirty:         0 kB
+Referenced:          300 kB
+Swap:                  0 kB
+VmFlags: rd ex mr mw me dw
+7f2b3c000000-7f2b3c021000 rw-p 00000000 00:00 0
+Size:                132 kB
+Rss:                  64 kB
+Pss:                  40 kB
+Shared_Clean:          0 kB
+Shared_Dirty:         32 kB
+Private_Clean:         4 kB
+Private_Dirty:        28 kB
+Referenced:           64 kB
+Swap:                  8 kB
+VmFlags: rd wr mr mw me ac
+"""
+
+
+class TestSmaps(TestCase):
+    def test_parse(self):
+        self.assertEqual(sage_server.parse_smaps(SMAPS.splitlines(True)),
+                         {'rss':364, 'pss':140, 'shared_clean':300, 'shared_dirty':32,
+                          'private_clean':4, 'private_dirty':28, 'swap':8})
+
+    def test_self(self):
+        usage = sage_server.smaps_memory()
+        if not os.path.exists('/proc/self/smaps'):
+            self.assertEqual(usage, {})
+            return
+        self.assertTrue(0 < usage['pss'] <= usage['rss'])
+        self.assertTrue(0 < usage['private_dirty'] <= usage['rss'])
+
+    def test_missing(self):
+        self.assertEqual(sage_server.smaps_memory(pid='nonexistent'), {})
+
+
+class TestPreimportGC(TestCase):
+    def setUp(self):
+        self.mode = sage_server.PREIMPORT_GC
+        self.enabled = gc.isenabled()
+        self.threshold = gc.get_threshold()
+
+    def tearDown(self):
+        sage_server.PREIMPORT_GC = self.mode
+        gc.set_threshold(*self.threshold)
+        if self.enabled:
+            gc.enable()
+        else:
+            gc.disable()
+
+    def session_gc(self):
+        # the gc settings of a session process forked now
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(r)
+                sage_server.prepare_session()
+                os.write(w, repr((gc.isenabled(), gc.get_threshold())))
+            finally:
+                os._exit(0)
+        os.close(w)
+        s = os.read(r, 1000)
+        os.close(r)
+        os.waitpid(pid, 0)
+        return eval(s)
+
+    def test_default(self):
+        sage_server.PREIMPORT_GC = None
+        gc.enable()
+        sage_server.collect_preimported()
+        self.assertTrue(gc.isenabled())
+        self.assertEqual(self.session_gc(), (True, self.threshold))
+
+    def test_limit(self):
+        sage_server.PREIMPORT_GC = 'limit'
+        sage_server.collect_preimported()
+        self.assertFalse(gc.isenabled())   # the server does not collect anymore
+        self.assertEqual(self.session_gc(), (True, sage_server.PREIMPORT_GC_THRESHOLD))
+
+    def test_disable(self):
+        sage_server.PREIMPORT_GC = 'disable'
+        sage_server.collect_preimported()
+        self.assertFalse(gc.isenabled())
+        self.assertEqual(self.session_gc(), (False, self.threshold))
@@ -0,0 +1,113 @@
+import os, signal, socket, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+def serve_connection(conn):
+    # what a pooled session process does with its connection in these tests
+    conn.sendall('%s'%os.getpid())
+
+
+class TestSessionPool(TestCase):
+    def setUp(self):
+        self.serve_connection = sage_server.serve_connection
+        sage_server.serve_connection = serve_connection   # before forking, so the workers use it
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.pools = []
+
+    def tearDown(self):
+        sage_server.serve_connection = self.serve_connection
+        self.listener.close()
+        for pool in self.pools:
+            for pid, sock in list(pool._workers):
+                pool.exited(pid)   # closing its socket makes the worker exit
+                self.wait(pid)
+
+    def pool(self, size):
+        pool = sage_server.SessionPool(size)
+        self.pools.append(pool)
+        pool.fill()
+        self.assertEqual(len(pool), size)
+        return pool
+
+    def wait(self, pid):
+        return os.waitpid(pid, 0)[1]
+
+    def connect(self):
+        client = socket.create_connection(self.listener.getsockname())
+        conn = self.listener.accept()[0]
+        return client, conn
+
+    def recv_all(self, sock):
+        v = []
+        while True:
+            s = sock.recv(4096)
+            if not s:
+                return ''.join(v)
+            v.append(s)
+
+    def test_handoff(self):
+        pool = self.pool(1)
+        pid = pool._workers[0][0]
+        client, conn = self.connect()
+        self.assertEqual(pool.handoff(conn), pid)
+        conn.close()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(self.recv_all(client), str(pid))   # the worker served the connection
+        self.assertEqual(self.wait(pid), 0)
+        client.close()
+        # there is no worker left to hand a connection to
+        client, conn = self.connect()
+        self.assertEqual(pool.handoff(conn), None)
+        client.close()
+        conn.close()
+
+    def test_refill(self):
+        pool = self.pool(1)
+        first = pool._workers[0][0]
+        client, conn = self.connect()
+        self.assertEqual(pool.handoff(conn), first)
+        conn.close()
+        self.assertEqual(self.wait(first), 0)
+        client.close()
+        pool.fill()
+        self.assertEqual(len(pool), 1)
+        self.assertNotEqual(pool._workers[0][0], first)
+
+    def test_dead_worker(self):
+        # a worker that died while idle is skipped and the connection goes to the next one
+        pool = self.pool(2)
+        (dead, _), (alive, _) = pool._workers
+        os.kill(dead, signal.SIGKILL)
+        self.wait(dead)
+        client, conn = self.connect()
+        self.assertEqual(pool.handoff(conn), alive)
+        conn.close()
+        self.assertEqual(self.recv_all(client), str(alive))
+        self.assertEqual(self.wait(alive), 0)
+        client.close()
+
+    def test_exited(self):
+        pool = self.pool(2)
+        (pid, _), (other, _) = pool._workers
+        os.kill(pid, signal.SIGKILL)
+        self.wait(pid)
+        pool.exited(pid)
+        self.assertEqual([p for p, _ in pool._workers], [other])
+
@@ -0,0 +1,66 @@
+import os, shutil, tempfile
+from unittest import TestCase
+
+from smc_sagews import sage_salvus, sage_server
+
+
+def setUpModule():
+    # log to a temporary file, not next to sage_server.py
+    global _logfile
+    _logfile = sage_server.LOGFILE
+    fd, sage_server.LOGFILE = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+
+def tearDownModule():
+    sage_server.logger.flush()
+    os.unlink(sage_server.LOGFILE)
+    sage_server.LOGFILE = _logfile
+
+
+class TestTimeitStats(TestCase):
+    def stats(self, samples):
+        return sage_salvus.TimeitStats(samples, 10, 0., 0.)
+
+    def test_stats(self):
+        stats = self.stats([1., 2., 3., 4., 5.])
+        self.assertEqual((stats.n, stats.mean, stats.min, stats.max), (5, 3., 1., 5.))
+        self.assertAlmostEqual(stats.stddev, 2.5**.5)
+        self.assertAlmostEqual(stats.ci, 2.776 * (2.5 / 5)**.5)
+        self.assertEqual((stats.percentiles[5], stats.percentiles[50], stats.percentiles[95]), (1.2, 3., 4.8))
+
+    def test_compare(self):
+        baseline = self.stats([1., 1.1, .9, 1., 1.]).summary()
+        c, lo, hi = self.stats([1., 1.1, .9, 1., 1.]).compare(baseline)
+        self.assertAlmostEqual(c, 0)
+        self.assertTrue(lo < 0 < hi)
+        self.assertAlmostEqual(lo, -hi)
+        c, lo, hi = self.stats([2., 2.2, 1.8, 2., 2.]).compare(baseline)
+        self.assertAlmostEqual(c, 1)
+        self.assertTrue(0 < lo < 1 < hi)
+        # without any variance, there is no interval
+        self.assertEqual(self.stats([2., 2.]).compare(self.stats([1., 1.]).summary()), (1., 1., 1.))
+        self.assertEqual(self.stats([1.5]).compare(self.stats([1., 1.]).summary()), (.5, .5, .5))
+
+    def test_baselines(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.assertEqual(sage_salvus.timeit_baselines('sort', path), [])
+            for i in range(3):
+                sage_salvus._timeit_save('sort', {'mean':i}, path)
+            self.assertEqual(sage_salvus.timeit_baselines('sort', path), [{'mean':0}, {'mean':1}, {'mean':2}])
+            self.assertRaises(ValueError, sage_salvus.timeit_baselines, '../sort', path)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestTimeitCode(TestCase):
+    def test_string_literals(self):
+        # the lines of the code are indented, but not those in string literals
+        v = []
+        code = "s = '''a\n  b\n'''\nt = 'c\\\nd'\nif s:\n    v.append((s, t))"
+        sage_salvus.timeit_stats(code, preparse=False, globals_dict={'v':v}, warmup=0, max_time=0)
+        self.assertEqual(v[0], ('a\n  b\n', 'cd'))
+
+    def test_indent(self):
+        self.assertEqual(sage_salvus._indent_code("x = '''\n'''\ny = (1,\n2)", '  '), "  x = '''\n'''\n  y = (1,\n  2)\n")
+        self.assertEqual(sage_salvus._indent_code("x = '''", '  '), "  x = '''\n")